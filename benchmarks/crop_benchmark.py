@@ -0,0 +1,83 @@
+"""
+Compares the per upload cost of the original crop path (one decode_and_crop_jpeg per window) against each
+image backend, which decode the upload once for every window.
+
+Run from the repository root with the API on the path:
+
+    PYTHONPATH=src/waterbowl_api python benchmarks/crop_benchmark.py --iterations 50
+"""
+import json
+from pathlib import Path
+from statistics import mean, median
+from time import perf_counter
+
+import click
+import tensorflow as tf
+from enums import CROP_WINDOWS, ImageBackendType
+from image_processing import get_image_backend
+
+default_picture = Path(__file__).parent.parent.joinpath(
+    "tests", "test_data", "waterbowl-test.jpg"
+)
+
+
+def legacy_crop_pictures(
+    picture_data: bytes, crop_windows: dict[str, list[int]]
+) -> dict[str, bytes]:
+    cropped_pictures = {}
+    for name, crop_window in crop_windows.items():
+        decoded_image = tf.image.decode_and_crop_jpeg(
+            contents=picture_data, crop_window=crop_window, channels=1
+        )
+        new_jpg = tf.image.encode_jpeg(decoded_image, format="grayscale", quality=100)
+        cropped_pictures[name] = new_jpg.numpy()
+    return cropped_pictures
+
+
+def time_crops(crop_function, picture_data: bytes, crop_windows, iterations: int):
+    # Warm up so graph tracing and allocator setup don't land in the first sample
+    crop_function(picture_data, crop_windows)
+    timings = []
+    for _ in range(iterations):
+        start = perf_counter()
+        crop_function(picture_data, crop_windows)
+        timings.append((perf_counter() - start) * 1000)
+    return {"mean_ms": mean(timings), "median_ms": median(timings)}
+
+
+@click.command()
+@click.option(
+    "--picture", type=click.Path(exists=True, path_type=Path), default=default_picture
+)
+@click.option("--iterations", type=int, default=25)
+@click.option(
+    "--extra-window",
+    type=int,
+    default=0,
+    help="Number of additional copies of the water bowl window to crop, to see how cost scales with N crops.",
+)
+def run_benchmark(picture: Path, iterations: int, extra_window: int):
+    picture_data = picture.read_bytes()
+    crop_windows = dict(CROP_WINDOWS)
+    for i in range(extra_window):
+        crop_windows[f"extra_{i}"] = crop_windows["water"]
+    results = {
+        "picture": str(picture),
+        "crops": len(crop_windows),
+        "iterations": iterations,
+        "legacy": time_crops(
+            legacy_crop_pictures, picture_data, crop_windows, iterations
+        ),
+    }
+    for backend in ImageBackendType:
+        results[backend] = time_crops(
+            get_image_backend(backend).crop_pictures,
+            picture_data,
+            crop_windows,
+            iterations,
+        )
+    click.echo(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,110 @@
+"""
+Compares how many pictures per second can be recorded in Postgres by the old create_pictures flow (insert and
+commit the metadata, insert and commit the picture, then refresh it) and by the single statement insert.
+
+Image processing is left out so only the database work is measured. The benchmark drops and recreates the
+picture tables, so it refuses to run unless they are named benchmark_*. Run it against a local Postgres
+container, for example:
+
+    docker run --rm -d -p 5432:5432 -e POSTGRES_PASSWORD=postgres postgres:15
+    PICTURES_TABLE=benchmark_pictures PICTURES_MODELING_DATA=benchmark_pictures_modeling_data \\
+        PYTHONPATH=src/waterbowl_api python benchmarks/ingest_benchmark.py --pictures 2000 --concurrency 8
+"""
+import asyncio
+import json
+import sys
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+from time import perf_counter
+
+import click
+from enums import PICTURES_MODELING_DATA, PICTURES_TABLE
+from picture_service import PictureService
+from postgres.database import AsyncSessionLocal, Base, engine
+from postgres.db_models import DBPicture, DBPictureMetadata
+
+
+def coro(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        return asyncio.run(f(*args, **kwargs))
+
+    return wrapper
+
+
+def saved_picture(index: int) -> tuple[Path, Path, datetime]:
+    return Path(f"water_{index}.jpeg"), Path(f"food_{index}.jpeg"), datetime.now()
+
+
+async def legacy_insert(index: int) -> None:
+    async with AsyncSessionLocal() as db:
+        metadata = DBPictureMetadata()
+        db.add(metadata)
+        await db.commit()
+        waterbowl_picture, food_picture, time = saved_picture(index)
+        db_picture = DBPicture(
+            metadata_id=metadata.id,
+            waterbowl_picture=str(waterbowl_picture),
+            food_picture=str(food_picture),
+            picture_timestamp=time,
+        )
+        db.add(db_picture)
+        await db.commit()
+        await db.refresh(db_picture)
+
+
+async def single_statement_insert(index: int) -> None:
+    async with AsyncSessionLocal() as db:
+        # pylint: disable-next=protected-access
+        await PictureService(db=db)._insert_pictures([saved_picture(index)])
+
+
+async def inserts_per_second(insert, pictures: int, concurrency: int) -> float:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    slots = asyncio.Semaphore(concurrency)
+
+    async def _insert(index: int) -> None:
+        async with slots:
+            await insert(index)
+
+    # Warm up the connection pool before timing
+    await asyncio.gather(*[_insert(-index) for index in range(1, concurrency + 1)])
+    start = perf_counter()
+    await asyncio.gather(*[_insert(index) for index in range(pictures)])
+    return pictures / (perf_counter() - start)
+
+
+@click.command()
+@click.option("--pictures", type=int, default=2000)
+@click.option("--concurrency", type=int, multiple=True, default=[1, 8])
+@coro
+async def run_benchmark(pictures: int, concurrency: tuple[int]):
+    if not (
+        PICTURES_TABLE.startswith("benchmark_")
+        and PICTURES_MODELING_DATA.startswith("benchmark_")
+    ):
+        click.echo(
+            "Set PICTURES_TABLE and PICTURES_MODELING_DATA to benchmark_* tables."
+        )
+        sys.exit(2)
+    results = {}
+    for workers in concurrency:
+        results[workers] = {
+            "legacy_inserts_per_second": await inserts_per_second(
+                legacy_insert, pictures, workers
+            ),
+            "single_statement_inserts_per_second": await inserts_per_second(
+                single_statement_insert, pictures, workers
+            ),
+        }
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await engine.dispose()
+    click.echo(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,332 @@
+"""
+Measures the API's main hot paths against a seeded Postgres and prints one JSON document that can be saved and
+compared across commits:
+
+- save_pictures: per upload cost of cropping and writing a synthetic camera JPEG
+- post_pictures: POST /pictures/ uploads per second at each concurrency
+- get_random_picture: p50/p99 latency of picking an unannotated picture
+- update_metadata: votes per second at each concurrency
+- batch_pictures: /batch-pictures/ time to first byte, total time and archive size
+
+Requests go over loopback to a uvicorn server running on the same event loop, so the responses are streamed as they
+would be in production while network latency is left out. The benchmark drops and recreates
+the picture tables, so it refuses to run unless they are named benchmark_*. Pictures are written to a temporary
+directory that is removed afterwards:
+
+    PICTURES_TABLE=benchmark_pictures PICTURES_MODELING_DATA=benchmark_pictures_modeling_data \\
+        PYTHONPATH=src/waterbowl_api python benchmarks/run_benchmarks.py --rows 10000 --output results.json
+"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from functools import wraps
+from io import BytesIO
+from pathlib import Path
+from statistics import mean, median, quantiles
+from time import perf_counter, time
+from typing import Optional
+from unittest import mock
+
+import click
+import uvicorn
+from app import create_app
+from enums import (
+    PICTURES_MODELING_DATA,
+    PICTURES_TABLE,
+    PictureRetrieveLimits,
+    PictureType,
+)
+from fastapi import UploadFile
+from httpx import AsyncClient
+from models import PictureUpdateRequest
+from picture_service import PictureService, save_pictures
+from PIL import Image
+from postgres.database import AsyncSessionLocal, Base, engine
+from sqlalchemy import text
+from storage import picture_storage
+
+root_dir = Path(__file__).parent.parent
+
+
+def coro(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        return asyncio.run(f(*args, **kwargs))
+
+    return wrapper
+
+
+def latency_summary(timings: list[float]) -> dict[str, float]:
+    return {
+        "mean_ms": mean(timings),
+        "p50_ms": median(timings),
+        "p99_ms": quantiles(timings, n=100)[98],
+    }
+
+
+def synthetic_jpeg(width: int = 2592, height: int = 1944) -> bytes:
+    # Noise compresses about as badly as a real camera frame, so decode and encode costs stay realistic
+    channels = [Image.effect_noise((width, height), 64) for _ in range(3)]
+    picture = BytesIO()
+    Image.merge("RGB", channels).save(picture, format="JPEG", quality=90)
+    return picture.getvalue()
+
+
+def commit_id() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=root_dir,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@asynccontextmanager
+async def serve_app():
+    server = uvicorn.Server(
+        uvicorn.Config(create_app(), host="127.0.0.1", port=0, log_level="warning")
+    )
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    _, port = server.servers[0].sockets[0].getsockname()
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        await serving
+
+
+async def seed_pictures(
+    rows: int, annotated_fraction: float, picture_data: bytes, pictures_dir: Path
+) -> None:
+    """
+    Seeds `rows` pictures, `annotated_fraction` of them with a water bowl vote split evenly between yes and no.
+    Every row gets its own crop files, hard linked to one real crop so seeding large tables stays cheap.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(
+            text(
+                f"""
+                INSERT INTO "{PICTURES_MODELING_DATA}"
+                    (water_in_bowl, food_in_bowl, cat_at_bowl, human_cat_yes, human_water_yes,
+                     human_food_yes, human_cat_no, human_water_no, human_food_no)
+                SELECT vote = 1, false, false, 0, (vote = 1)::int, 0, 0, (vote = 2)::int, 0
+                FROM (
+                    SELECT CASE
+                        WHEN random() >= :annotated_fraction THEN 0
+                        WHEN random() < 0.5 THEN 1
+                        ELSE 2
+                    END AS vote
+                    FROM generate_series(1, :rows)
+                ) AS seed
+                """
+            ),
+            {"rows": rows, "annotated_fraction": annotated_fraction},
+        )
+        await conn.execute(
+            text(
+                f"""
+                INSERT INTO "{PICTURES_TABLE}"
+                    (metadata_id, waterbowl_picture, food_picture, picture_timestamp)
+                SELECT id, :pictures_dir || '/water_' || id || '.jpeg',
+                    :pictures_dir || '/food_' || id || '.jpeg', now() - id * interval '1 minute'
+                FROM "{PICTURES_MODELING_DATA}"
+                """
+            ),
+            {"pictures_dir": str(pictures_dir)},
+        )
+        await conn.execute(text(f'ANALYZE "{PICTURES_MODELING_DATA}"'))
+        await conn.execute(text(f'ANALYZE "{PICTURES_TABLE}"'))
+    water_picture, food_picture, _ = await save_pictures(
+        UploadFile(filename="seed.jpeg", file=BytesIO(picture_data)), time()
+    )
+    for picture_id in range(1, rows + 1):
+        os.link(water_picture, pictures_dir.joinpath(f"water_{picture_id}.jpeg"))
+        os.link(food_picture, pictures_dir.joinpath(f"food_{picture_id}.jpeg"))
+
+
+async def time_save_pictures(picture_data: bytes, iterations: int) -> dict:
+    timings = []
+    for _ in range(iterations + 1):
+        upload = UploadFile(filename="benchmark.jpeg", file=BytesIO(picture_data))
+        start = perf_counter()
+        await save_pictures(upload, time())
+        timings.append((perf_counter() - start) * 1000)
+    # The first upload pays for starting the image workers
+    return latency_summary(timings[1:])
+
+
+async def time_post_pictures(
+    client: AsyncClient, picture_data: bytes, uploads: int, concurrency: int
+) -> dict:
+    slots = asyncio.Semaphore(concurrency)
+    statuses: dict[int, int] = {}
+
+    async def _upload() -> None:
+        async with slots:
+            response = await client.post(
+                "/pictures/",
+                files={"picture": ("benchmark.jpeg", picture_data, "image/jpeg")},
+                data={"timestamp": str(time())},
+            )
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    start = perf_counter()
+    await asyncio.gather(*[_upload() for _ in range(uploads)])
+    elapsed = perf_counter() - start
+    return {
+        "uploads_per_second": statuses.get(200, 0) / elapsed,
+        "status_counts": statuses,
+    }
+
+
+async def time_get_random_picture(iterations: int) -> dict:
+    timings = []
+    async with AsyncSessionLocal() as db:
+        service = PictureService(db=db)
+        await service.get_random_picture(limit=PictureRetrieveLimits.NO_ANNOTATION)
+        for _ in range(iterations):
+            start = perf_counter()
+            await service.get_random_picture(limit=PictureRetrieveLimits.NO_ANNOTATION)
+            timings.append((perf_counter() - start) * 1000)
+            db.expunge_all()
+    return latency_summary(timings)
+
+
+async def time_update_metadata(rows: int, votes: int, concurrency: int) -> dict:
+    slots = asyncio.Semaphore(concurrency)
+    vote = PictureUpdateRequest(human_water_yes=1)
+
+    async def _vote(metadata_id: int) -> None:
+        async with slots, AsyncSessionLocal() as db:
+            await PictureService(db=db).update_metadata(metadata_id, vote)
+            await db.commit()
+
+    start = perf_counter()
+    await asyncio.gather(*[_vote(index % rows + 1) for index in range(votes)])
+    return {"votes_per_second": votes / (perf_counter() - start)}
+
+
+async def time_batch_pictures(client: AsyncClient, limit: int, iterations: int) -> dict:
+    first_byte_timings = []
+    total_timings = []
+    archive_bytes = 0
+    for _ in range(iterations):
+        start = perf_counter()
+        first_byte = None
+        archive_bytes = 0
+        async with client.stream(
+            "GET",
+            "/batch-pictures/",
+            params={"picture_type": PictureType.WATER_BOWL, "limit": limit},
+        ) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_raw():
+                if first_byte is None:
+                    first_byte = perf_counter()
+                archive_bytes += len(chunk)
+        first_byte_timings.append(((first_byte or perf_counter()) - start) * 1000)
+        total_timings.append((perf_counter() - start) * 1000)
+    return {
+        "time_to_first_byte": latency_summary(first_byte_timings),
+        "total": latency_summary(total_timings),
+        "archive_bytes": archive_bytes,
+    }
+
+
+@click.command()
+@click.option("--rows", type=int, default=10_000)
+@click.option("--annotated-fraction", type=float, default=0.5)
+@click.option("--iterations", type=click.IntRange(min=2), default=50)
+@click.option("--uploads", type=int, default=100)
+@click.option("--votes", type=int, default=2000)
+@click.option("--concurrency", type=int, multiple=True, default=[1, 8])
+@click.option("--batch-limit", type=int, default=100)
+@click.option(
+    "--picture",
+    type=click.Path(exists=True, path_type=Path),
+    help="JPEG to upload instead of a generated camera sized frame.",
+)
+@click.option("--output", type=click.Path(path_type=Path))
+@coro
+async def run_benchmarks(
+    rows: int,
+    annotated_fraction: float,
+    iterations: int,
+    uploads: int,
+    votes: int,
+    concurrency: tuple[int],
+    batch_limit: int,
+    picture: Optional[Path],
+    output: Optional[Path],
+):
+    if not (
+        PICTURES_TABLE.startswith("benchmark_")
+        and PICTURES_MODELING_DATA.startswith("benchmark_")
+    ):
+        click.echo(
+            "Set PICTURES_TABLE and PICTURES_MODELING_DATA to benchmark_* tables."
+        )
+        sys.exit(2)
+    picture_data = picture.read_bytes() if picture else synthetic_jpeg()
+    results = {
+        "commit": commit_id(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "parameters": {
+            "rows": rows,
+            "annotated_fraction": annotated_fraction,
+            "iterations": iterations,
+            "uploads": uploads,
+            "votes": votes,
+            "concurrency": list(concurrency),
+            "batch_limit": batch_limit,
+            "picture_bytes": len(picture_data),
+        },
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.object(
+        picture_storage, "_pictures_dir", Path(tmp_dir)
+    ):
+        await seed_pictures(rows, annotated_fraction, picture_data, Path(tmp_dir))
+        async with serve_app() as base_url, AsyncClient(
+            base_url=base_url, timeout=None
+        ) as client:
+            results["save_pictures"] = await time_save_pictures(
+                picture_data, iterations
+            )
+            results["post_pictures"] = {
+                workers: await time_post_pictures(
+                    client, picture_data, uploads, workers
+                )
+                for workers in concurrency
+            }
+            results["get_random_picture"] = await time_get_random_picture(iterations)
+            results["update_metadata"] = {
+                workers: await time_update_metadata(rows, votes, workers)
+                for workers in concurrency
+            }
+            results["batch_pictures"] = await time_batch_pictures(
+                client, batch_limit, iterations
+            )
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await engine.dispose()
+    report = json.dumps(results, indent=2)
+    if output:
+        output.write_text(report)
+    click.echo(report)
+
+
+if __name__ == "__main__":
+    run_benchmarks()
@@ -0,0 +1,120 @@
+"""
+Compares p50/p99 latency of the picture sampling strategies against tables seeded with a given number of rows.
+
+The benchmark drops and recreates the picture tables, so it refuses to run unless they are named benchmark_*:
+
+    PICTURES_TABLE=benchmark_pictures PICTURES_MODELING_DATA=benchmark_pictures_modeling_data \\
+        PYTHONPATH=src/waterbowl_api python benchmarks/sampling_benchmark.py --rows 100000 --rows 1000000
+"""
+import asyncio
+import json
+import sys
+from functools import wraps
+from statistics import median, quantiles
+from time import perf_counter
+
+import click
+from enums import (
+    PICTURES_MODELING_DATA,
+    PICTURES_TABLE,
+    PictureRetrieveLimits,
+    PictureSamplingStrategy,
+)
+from picture_service import PictureService
+from postgres.database import AsyncSessionLocal, Base, engine
+from sampling import get_picture_sampler
+from sqlalchemy import text
+
+
+def coro(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        return asyncio.run(f(*args, **kwargs))
+
+    return wrapper
+
+
+async def seed_pictures(rows: int, annotated_fraction: float) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(
+            text(
+                f"""
+                INSERT INTO "{PICTURES_MODELING_DATA}"
+                    (water_in_bowl, food_in_bowl, cat_at_bowl, human_cat_yes, human_water_yes,
+                     human_food_yes, human_cat_no, human_water_no, human_food_no)
+                SELECT annotated, false, false, 0, annotated::int, 0, 0, 0, 0
+                FROM (
+                    SELECT random() < :annotated_fraction AS annotated
+                    FROM generate_series(1, :rows)
+                ) AS seed
+                """
+            ),
+            {"rows": rows, "annotated_fraction": annotated_fraction},
+        )
+        await conn.execute(
+            text(
+                f"""
+                INSERT INTO "{PICTURES_TABLE}"
+                    (metadata_id, waterbowl_picture, food_picture, picture_timestamp)
+                SELECT id, 'water_' || id || '.jpeg', 'food_' || id || '.jpeg',
+                    now() - id * interval '1 minute'
+                FROM "{PICTURES_MODELING_DATA}"
+                """
+            )
+        )
+        await conn.execute(text(f'ANALYZE "{PICTURES_MODELING_DATA}"'))
+        await conn.execute(text(f'ANALYZE "{PICTURES_TABLE}"'))
+
+
+async def time_strategy(
+    strategy: PictureSamplingStrategy, limit: PictureRetrieveLimits, iterations: int
+) -> dict[str, float]:
+    timings = []
+    async with AsyncSessionLocal() as db:
+        picture_service = PictureService(db=db, sampler=get_picture_sampler(strategy))
+        await picture_service.get_random_picture(limit=limit)
+        for _ in range(iterations):
+            start = perf_counter()
+            await picture_service.get_random_picture(limit=limit)
+            timings.append((perf_counter() - start) * 1000)
+            db.expunge_all()
+    return {
+        "p50_ms": median(timings),
+        "p99_ms": quantiles(timings, n=100)[98],
+    }
+
+
+@click.command()
+@click.option("--rows", type=int, multiple=True, default=[100_000, 1_000_000])
+@click.option("--iterations", type=click.IntRange(min=2), default=200)
+@click.option("--annotated-fraction", type=float, default=0.5)
+@coro
+async def run_benchmark(rows: tuple[int], iterations: int, annotated_fraction: float):
+    if not (
+        PICTURES_TABLE.startswith("benchmark_")
+        and PICTURES_MODELING_DATA.startswith("benchmark_")
+    ):
+        click.echo(
+            "Set PICTURES_TABLE and PICTURES_MODELING_DATA to benchmark_* tables."
+        )
+        sys.exit(2)
+    results = {}
+    for row_count in rows:
+        await seed_pictures(row_count, annotated_fraction)
+        results[row_count] = {
+            strategy: {
+                limit: await time_strategy(strategy, limit, iterations)
+                for limit in PictureRetrieveLimits
+            }
+            for strategy in PictureSamplingStrategy
+        }
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await engine.dispose()
+    click.echo(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,232 @@
+"""
+Measures how much server CPU time it takes to serve a gigabyte of pictures, the number that decides how many
+downloads a Raspberry Pi node can keep up with:
+
+- images_from_memory: /pictures/{id}/image with the image cache on, sent from memory
+- images_from_disk: the same with the image cache off, sent straight from the picture files
+- dataset_archive: repeated /batch-pictures/ downloads of a seeded sample, sent from the dataset cache
+
+The server runs in its own process, by default uvicorn, so its CPU time (read from /proc, including any worker
+processes it starts) isn't mixed up with the client's. Servers that offer the ASGI pathsend or zerocopysend
+extensions send files without copying them through Python; pass their command line, with a {port} placeholder,
+as --server-command to compare. Each result says how its bytes were sent. The benchmark drops and recreates the
+picture tables, so it refuses to run unless they are named benchmark_*:
+
+    PICTURES_TABLE=benchmark_pictures PICTURES_MODELING_DATA=benchmark_pictures_modeling_data \\
+        PYTHONPATH=src/waterbowl_api python benchmarks/serving_benchmark.py --output serving.json
+"""
+import asyncio
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from functools import wraps
+from pathlib import Path
+from time import perf_counter
+from typing import AsyncIterator, Optional
+from unittest import mock
+
+import click
+from enums import PICTURES_MODELING_DATA, PICTURES_TABLE, PictureType
+from httpx import AsyncClient, HTTPError
+from postgres.database import Base, engine
+from run_benchmarks import commit_id, seed_pictures, synthetic_jpeg
+from storage import picture_storage
+
+root_dir = Path(__file__).parent.parent
+DEFAULT_SERVER_COMMAND = (
+    f"{sys.executable} -m uvicorn --factory app:create_app --host 127.0.0.1 --port {{port}} "
+    "--log-level warning"
+)
+
+
+def coro(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        return asyncio.run(f(*args, **kwargs))
+
+    return wrapper
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def cpu_seconds(pid: int) -> float:
+    """
+    User and system CPU time used so far by a process and all of its children.
+    """
+    proc_dir = Path(f"/proc/{pid}")
+    try:
+        # utime and stime are the 14th and 15th fields, counted in clock ticks; the name before them may hold spaces
+        fields = proc_dir.joinpath("stat").read_text().rsplit(")", 1)[1].split()
+        children = proc_dir.joinpath("task", str(pid), "children").read_text().split()
+    except FileNotFoundError:
+        return 0
+    used = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return used + sum(cpu_seconds(int(child)) for child in children)
+
+
+async def transfer_methods(client: AsyncClient) -> dict[str, float]:
+    metrics = (await client.get("/metrics/")).text
+    prefix = "waterbowl_file_response_bytes_total{method="
+    return {
+        line[len(prefix) :].split('"')[1]: float(line.rsplit(" ", 1)[1])
+        for line in metrics.splitlines()
+        if line.startswith(prefix)
+    }
+
+
+@asynccontextmanager
+async def run_server(
+    command: str, env: dict[str, str]
+) -> AsyncIterator[tuple[int, AsyncClient]]:
+    port = free_port()
+    server = subprocess.Popen(
+        shlex.split(command.format(port=port)), env={**os.environ, **env}, cwd=root_dir
+    )
+    try:
+        async with AsyncClient(
+            base_url=f"http://127.0.0.1:{port}", timeout=None
+        ) as client:
+            for _ in range(300):
+                if server.poll() is not None:
+                    raise click.ClickException(
+                        f"{command} exited with {server.returncode}"
+                    )
+                try:
+                    await client.get("/metrics/")
+                    break
+                except HTTPError:
+                    await asyncio.sleep(0.1)
+            yield server.pid, client
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def time_downloads(
+    server_pid: int, client: AsyncClient, urls: list[str], concurrency: int
+) -> dict:
+    slots = asyncio.Semaphore(concurrency)
+    served_bytes = 0
+
+    async def _download(url: str) -> None:
+        nonlocal served_bytes
+        async with slots, client.stream("GET", url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_raw():
+                served_bytes += len(chunk)
+
+    methods_before = await transfer_methods(client)
+    cpu_before = cpu_seconds(server_pid)
+    start = perf_counter()
+    await asyncio.gather(*[_download(url) for url in urls])
+    elapsed = perf_counter() - start
+    used = cpu_seconds(server_pid) - cpu_before
+    methods_after = await transfer_methods(client)
+    gigabytes = served_bytes / 1e9
+    return {
+        "requests": len(urls),
+        "bytes": served_bytes,
+        "seconds": elapsed,
+        "gb_per_second": gigabytes / elapsed,
+        "cpu_seconds": used,
+        "cpu_seconds_per_gb": used / gigabytes if gigabytes else None,
+        "sent_by": {
+            method: sent - methods_before.get(method, 0)
+            for method, sent in methods_after.items()
+            if sent > methods_before.get(method, 0)
+        },
+    }
+
+
+@click.command()
+@click.option("--rows", type=int, default=200)
+@click.option("--requests", type=int, default=2000)
+@click.option("--concurrency", type=int, default=8)
+@click.option("--dataset-limit", type=int, default=100)
+@click.option("--dataset-downloads", type=int, default=20)
+@click.option("--server-command", default=DEFAULT_SERVER_COMMAND, show_default=True)
+@click.option("--output", type=click.Path(path_type=Path))
+@coro
+async def run_serving_benchmark(
+    rows: int,
+    requests: int,
+    concurrency: int,
+    dataset_limit: int,
+    dataset_downloads: int,
+    server_command: str,
+    output: Optional[Path],
+):
+    if not (
+        PICTURES_TABLE.startswith("benchmark_")
+        and PICTURES_MODELING_DATA.startswith("benchmark_")
+    ):
+        click.echo(
+            "Set PICTURES_TABLE and PICTURES_MODELING_DATA to benchmark_* tables."
+        )
+        sys.exit(2)
+    results = {
+        "commit": commit_id(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "parameters": {
+            "rows": rows,
+            "requests": requests,
+            "concurrency": concurrency,
+            "dataset_limit": dataset_limit,
+            "dataset_downloads": dataset_downloads,
+            "server_command": server_command,
+        },
+    }
+    image_urls = [f"/pictures/{index % rows + 1}/image" for index in range(requests)]
+    dataset_url = (
+        f"/batch-pictures/?picture_type={PictureType.WATER_BOWL}"
+        f"&limit={dataset_limit}&seed=1"
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.object(
+        picture_storage, "_pictures_dir", Path(tmp_dir)
+    ):
+        await seed_pictures(rows, 1, synthetic_jpeg(), Path(tmp_dir))
+        await engine.dispose()
+        server_env = {
+            "PICTURES_DIR": tmp_dir,
+            "DATASET_CACHE_DIR": str(Path(tmp_dir).joinpath("dataset-cache")),
+        }
+        for scenario, image_cache_bytes in [
+            ("images_from_memory", str(1024 * 1024 * 1024)),
+            ("images_from_disk", "0"),
+        ]:
+            async with run_server(
+                server_command,
+                {**server_env, "IMAGE_CACHE_MAX_BYTES": image_cache_bytes},
+            ) as (server_pid, client):
+                # One pass first, so the cache is warm and only steady state serving is measured
+                await time_downloads(server_pid, client, image_urls[:rows], concurrency)
+                results[scenario] = await time_downloads(
+                    server_pid, client, image_urls, concurrency
+                )
+        async with run_server(server_command, server_env) as (server_pid, client):
+            # The first download builds the archive, the rest are sent from the dataset cache
+            await time_downloads(server_pid, client, [dataset_url], 1)
+            results["dataset_archive"] = await time_downloads(
+                server_pid, client, [dataset_url] * dataset_downloads, concurrency
+            )
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await engine.dispose()
+    report = json.dumps(results, indent=2)
+    if output:
+        output.write_text(report)
+    click.echo(report)
+
+
+if __name__ == "__main__":
+    run_serving_benchmark()
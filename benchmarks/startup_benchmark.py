@@ -0,0 +1,86 @@
+"""
+Measures API import time, first crop latency and peak RSS for each image backend. Every backend runs in a fresh
+interpreter so lazily imported libraries are counted against the backend that loads them.
+
+Run from the repository root:
+
+    python benchmarks/startup_benchmark.py --runs 3
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from statistics import median
+
+import click
+from enums import ImageBackendType
+
+root_dir = Path(__file__).parent.parent
+default_picture = root_dir.joinpath("tests", "test_data", "waterbowl-test.jpg")
+
+child_script = """
+import json, resource, sys
+from time import perf_counter
+
+start = perf_counter()
+from waterbowl_api.app import app
+from enums import CROP_WINDOWS
+from image_processing import crop_pictures
+import_seconds = perf_counter() - start
+
+picture_data = open(sys.argv[1], "rb").read()
+start = perf_counter()
+crop_pictures(picture_data, CROP_WINDOWS)
+first_crop_seconds = perf_counter() - start
+
+print(json.dumps({
+    "import_seconds": import_seconds,
+    "first_crop_seconds": first_crop_seconds,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}))
+"""
+
+
+def run_child(backend: ImageBackendType, picture: Path, pictures_dir: str) -> dict:
+    env = {
+        **os.environ,
+        "IMAGE_BACKEND": str(backend),
+        "PICTURES_DIR": pictures_dir,
+        "PYTHONPATH": os.pathsep.join(
+            [
+                str(root_dir.joinpath("src")),
+                str(root_dir.joinpath("src", "waterbowl_api")),
+            ]
+        ),
+        "TF_CPP_MIN_LOG_LEVEL": "3",
+    }
+    output = subprocess.run(
+        [sys.executable, "-c", child_script, str(picture)],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+@click.command()
+@click.option(
+    "--picture", type=click.Path(exists=True, path_type=Path), default=default_picture
+)
+@click.option("--runs", type=int, default=3)
+def run_benchmark(picture: Path, runs: int):
+    results = {}
+    with tempfile.TemporaryDirectory() as pictures_dir:
+        for backend in ImageBackendType:
+            samples = [run_child(backend, picture, pictures_dir) for _ in range(runs)]
+            results[backend] = {
+                key: median(sample[key] for sample in samples) for key in samples[0]
+            }
+    click.echo(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    run_benchmark()
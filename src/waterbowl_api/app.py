@@ -1,9 +1,23 @@
 import os
 
 from blueprint import waterbowl_router
-from enums import PICTURES_DIR
+from enums import (
+    CAMERA_FRAME_HEIGHT,
+    CAMERA_FRAME_WIDTH,
+    CROP_WINDOWS,
+    DATASET_CACHE_DIR,
+    PICTURES_DIR,
+    PROFILING_ENABLED,
+    PROFILING_INTERVAL_SECONDS,
+    PROFILING_SAMPLE_RATE,
+    PROFILING_THRESHOLD_SECONDS,
+)
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from image_processing import check_crop_windows
+from middleware import ProfilingMiddleware, RequestMetricsMiddleware
+from profiler import profile_store
+from prometheus_client import make_asgi_app
 
 default_origins = [
     "http://levan.home",
@@ -17,12 +31,16 @@ default_origins = [
 def setup_local_files() -> None:
     if not PICTURES_DIR.exists():
         PICTURES_DIR.mkdir(parents=True)
+    if not DATASET_CACHE_DIR.exists():
+        DATASET_CACHE_DIR.mkdir(parents=True)
 
 
 def create_app() -> FastAPI:
+    check_crop_windows(CROP_WINDOWS, CAMERA_FRAME_WIDTH, CAMERA_FRAME_HEIGHT)
     setup_local_files()
     picture_app = FastAPI()
     picture_app.include_router(waterbowl_router)
+    picture_app.mount("/metrics", make_asgi_app())
     default_origins.extend(os.environ.get("ALLOWED_ORIGINS", []))
     picture_app.add_middleware(
         CORSMiddleware,
@@ -31,6 +49,15 @@ def create_app() -> FastAPI:
         allow_headers=["*"],
         expose_headers=["PictureMetadata"],
     )
+    picture_app.add_middleware(RequestMetricsMiddleware)
+    if PROFILING_ENABLED:
+        picture_app.add_middleware(
+            ProfilingMiddleware,
+            store=profile_store,
+            sample_rate=PROFILING_SAMPLE_RATE,
+            threshold=PROFILING_THRESHOLD_SECONDS,
+            interval=PROFILING_INTERVAL_SECONDS,
+        )
     return picture_app
 
 
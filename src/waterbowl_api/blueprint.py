@@ -5,15 +5,42 @@ from pathlib import Path as FilePath
 from typing import Optional
 
 import models
-from enums import PictureRetrieveLimits, PictureType
-from fastapi import APIRouter, Depends, File, Form, HTTPException, Path, UploadFile
-from fastapi.responses import FileResponse
+from dataset_cache import DatasetCache, dataset_cache
+from enums import (
+    IMAGE_WORKER_RETRY_AFTER,
+    PICTURE_BATCH_MAX_SIZE,
+    PICTURE_REDIRECTS,
+    PROFILING_ENABLED,
+    AnnotationStatus,
+    PictureRetrieveLimits,
+    PictureType,
+)
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Depends,
+    File,
+    Form,
+    Header,
+    HTTPException,
+    Path,
+    Response,
+    UploadFile,
+)
+from fastapi.responses import FileResponse, RedirectResponse
+from http_caching import file_etag, immutable_image_response
+from image_cache import image_cache
+from metrics import OPERATION_SECONDS
 from packaging_service import ZipPackager
 from picture_service import PictureService
-from postgres.database import Base, engine, get_db
-from postgres.db_models import DBPicture, DBPictureMetadata
+from postgres.database import Base, engine, get_db, upgrade_schema
+from postgres.db_models import DBPicture
+from prefetch import unannotated_picture_queue
+from profiler import profile_store
 from sqlalchemy.ext.asyncio import AsyncSession
-from starlette.responses import StreamingResponse
+from storage import PictureFileRange, picture_storage
+from workers import WorkerPoolFullException, image_worker_pool
+from zero_copy import ZeroCopyFileResponse
 
 waterbowl_router = APIRouter()
 
@@ -29,6 +56,12 @@ async def init_models():
         if os.environ.get("LOCAL"):
             await conn.run_sync(Base.metadata.drop_all)
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(upgrade_schema)
+
+
+@waterbowl_router.on_event("shutdown")
+async def shutdown_workers():
+    image_worker_pool.shutdown()
 
 
 @waterbowl_router.get("/health")
@@ -43,29 +76,113 @@ async def add_pictures_endpoint(
     timestamp: float = Form(),
 ) -> models.Picture:
     picture_service = PictureService(db=db)
-    db_picture = await picture_service.create_pictures(
-        picture=picture, timestamp=timestamp
-    )
+    try:
+        db_picture = await picture_service.create_pictures(
+            picture=picture, timestamp=timestamp
+        )
+    except WorkerPoolFullException as exc:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many pictures are being processed, try again later.",
+            headers={"Retry-After": str(IMAGE_WORKER_RETRY_AFTER)},
+        ) from exc
     return db_picture
 
 
-@waterbowl_router.get("/pictures/", response_class=FileResponse)
+@waterbowl_router.post("/pictures/batch", response_model=list[models.Picture])
+async def add_pictures_batch_endpoint(
+    db: AsyncSession = Depends(get_db),
+    pictures: list[UploadFile] = File(),
+    timestamps: list[float] = Form(),
+) -> list[models.Picture]:
+    if len(pictures) != len(timestamps):
+        raise HTTPException(
+            status_code=422, detail="Every picture needs exactly one timestamp."
+        )
+    if len(pictures) > PICTURE_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {PICTURE_BATCH_MAX_SIZE} pictures can be uploaded at once.",
+        )
+    picture_service = PictureService(db=db)
+    try:
+        db_pictures = await picture_service.create_pictures_batch(
+            list(zip(pictures, timestamps))
+        )
+    except WorkerPoolFullException as exc:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many pictures are being processed, try again later.",
+            headers={"Retry-After": str(IMAGE_WORKER_RETRY_AFTER)},
+        ) from exc
+    return db_pictures
+
+
+async def _uncached_picture_file(location: str) -> Optional[PictureFileRange]:
+    """
+    With the image cache turned off, where to send a picture from on disk without reading it into memory first.
+    None when the picture should go through the image cache, or can't be found.
+    """
+    if image_cache.enabled:
+        return None
+    try:
+        return await picture_storage.file_range(location)
+    except FileNotFoundError:
+        return None
+
+
+@waterbowl_router.get("/pictures/", response_class=Response)
 async def get_random_picture_endpoint(
+    background_tasks: BackgroundTasks,
     db: AsyncSession = Depends(get_db),
     picture_type: Optional[PictureType] = PictureType.WATER_BOWL,
     limit: Optional[PictureRetrieveLimits] = PictureRetrieveLimits.NO_ANNOTATION,
-) -> FileResponse:
-    picture_service = PictureService(db=db)
-    random_picture: DBPicture = await picture_service.get_random_picture(limit=limit)
-    if random_picture:
+) -> Response:
+    picture_data = None
+    with OPERATION_SECONDS.labels("get_random_picture").time():
+        if (
+            limit == PictureRetrieveLimits.NO_ANNOTATION
+            and unannotated_picture_queue.enabled
+        ):
+            picture_data = await unannotated_picture_queue.next(db)
+            background_tasks.add_task(unannotated_picture_queue.top_up, db)
+        if picture_data is None:
+            picture_service = PictureService(db=db)
+            random_picture: DBPicture = await picture_service.get_random_picture(
+                limit=limit
+            )
+            picture_data = random_picture.to_dict() if random_picture else None
+    if picture_data:
         file = (
-            FilePath(random_picture.waterbowl_picture)
+            picture_data["waterbowl_picture"]
             if picture_type == PictureType.WATER_BOWL
-            else FilePath(random_picture.food_picture)
+            else picture_data["food_picture"]
         )
-        if file.exists():
-            return FileResponse(
-                file, headers={"PictureMetadata": json.dumps(random_picture.to_dict())}
+        if PICTURE_REDIRECTS and (url := picture_storage.presigned_url(file)):
+            return RedirectResponse(
+                url,
+                status_code=307,
+                headers={"PictureMetadata": json.dumps(picture_data)},
+            )
+        if picture_file := await _uncached_picture_file(file):
+            return ZeroCopyFileResponse(
+                picture_file.path,
+                offset=picture_file.offset,
+                size=picture_file.size,
+                media_type="image/jpeg",
+                headers={
+                    "PictureMetadata": json.dumps(picture_data),
+                    "ETag": file_etag(picture_file),
+                },
+            )
+        if image := await image_cache.load(file):
+            return Response(
+                image.data,
+                media_type="image/jpeg",
+                headers={
+                    "PictureMetadata": json.dumps(picture_data),
+                    "ETag": image.etag,
+                },
             )
         raise HTTPException(
             status_code=404, detail="No picture file associated with this picture ID."
@@ -93,13 +210,49 @@ async def get_picture_metadata(
     picture_service = PictureService(db=db)
     picture: DBPicture = await picture_service.get_picture(picture_id)
     if picture:
-        picture_metadata: DBPictureMetadata = await picture_service.get_metadata(
-            picture.metadata_id
-        )
-        return picture_metadata.to_api_return(picture_id)
+        # Already loaded alongside the picture, so there's no need to look it up again
+        return picture.picture_metadata.to_api_return(picture_id)
     raise HTTPException(status_code=404, detail="Item not found")
 
 
+@waterbowl_router.get("/pictures/{picture_id}/image", response_class=Response)
+async def get_picture_image_endpoint(
+    picture_id: int = Path(),
+    picture_type: Optional[PictureType] = PictureType.WATER_BOWL,
+    db: AsyncSession = Depends(get_db),
+    if_none_match: Optional[str] = Header(default=None),
+    if_modified_since: Optional[str] = Header(default=None),
+    range_header: Optional[str] = Header(default=None, alias="Range"),
+    if_range: Optional[str] = Header(default=None),
+) -> Response:
+    """
+    Returns one of a picture's crops. Crops never change once saved, so they are served as immutable, with
+    support for conditional and range requests.
+    """
+    picture_service = PictureService(db=db)
+    picture: DBPicture = await picture_service.get_picture(picture_id)
+    if not picture:
+        raise HTTPException(status_code=404, detail="Item not found")
+    file = (
+        picture.waterbowl_picture
+        if picture_type == PictureType.WATER_BOWL
+        else picture.food_picture
+    )
+    if PICTURE_REDIRECTS and (url := picture_storage.presigned_url(file)):
+        return RedirectResponse(url, status_code=307)
+    if image := await _uncached_picture_file(file) or await image_cache.load(file):
+        return immutable_image_response(
+            image,
+            if_none_match=if_none_match,
+            if_modified_since=if_modified_since,
+            range_header=range_header,
+            if_range=if_range,
+        )
+    raise HTTPException(
+        status_code=404, detail="No picture file associated with this picture ID."
+    )
+
+
 @waterbowl_router.patch("/pictures/{picture_id}/", response_model=models.Picture)
 async def update_picture_endpoint(
     update_request: models.PictureUpdateRequest,
@@ -107,52 +260,116 @@ async def update_picture_endpoint(
     db: AsyncSession = Depends(get_db),
 ) -> models.Picture:
     picture_service = PictureService(db=db)
-    picture: DBPicture = await picture_service.get_picture(picture_id=picture_id)
+    picture: DBPicture = await picture_service.annotate_picture(
+        picture_id=picture_id, updates=update_request
+    )
     if picture:
-        await picture_service.update_metadata(
-            picture.metadata_id, updates=update_request
-        )
+        unannotated_picture_queue.discard(picture.id)
         return picture
     raise HTTPException(status_code=404, detail="Item not found")
 
 
+@waterbowl_router.post(
+    "/annotations/batch", response_model=list[models.AnnotationBatchResult]
+)
+async def annotate_pictures_batch_endpoint(
+    batch_request: models.AnnotationBatchRequest,
+    db: AsyncSession = Depends(get_db),
+) -> list[models.AnnotationBatchResult]:
+    picture_service = PictureService(db=db)
+    updated_picture_ids = await picture_service.update_metadata_batch(
+        [
+            (
+                annotation.picture_id,
+                models.PictureUpdateRequest(**annotation.dict(exclude={"picture_id"})),
+            )
+            for annotation in batch_request.annotations
+        ]
+    )
+    for picture_id in updated_picture_ids:
+        unannotated_picture_queue.discard(picture_id)
+    return [
+        models.AnnotationBatchResult(
+            picture_id=annotation.picture_id,
+            status=AnnotationStatus.UPDATED
+            if annotation.picture_id in updated_picture_ids
+            else AnnotationStatus.NOT_FOUND,
+        )
+        for annotation in batch_request.annotations
+    ]
+
+
 @waterbowl_router.get("/batch-pictures/")
 async def get_batch_picture_endpoint(
     db: AsyncSession = Depends(get_db),
     picture_type: Optional[PictureType] = PictureType.WATER_BOWL,
     picture_class: Optional[bool] = None,
     limit: Optional[int] = 100,
-) -> StreamingResponse:
+    seed: Optional[int] = None,
+    if_none_match: Optional[str] = Header(default=None),
+) -> Response:
     """
     Returns a .zip file containing a directory of classified images split between positive and negative classes,
     and a json file with image information.
+
+    Passing a seed makes the sample repeatable: the finished archive is cached and served with an ETag until
+    any picture metadata changes.
     """
     picture_service = PictureService(db=db)
+    cache_key = None
+    if seed is not None and dataset_cache.enabled:
+        cache_key = DatasetCache.make_key(
+            picture_type=picture_type,
+            picture_class=picture_class,
+            limit=limit,
+            seed=seed,
+            dataset_version=await picture_service.get_dataset_version(),
+        )
+        cache_headers = {"ETag": DatasetCache.make_etag(cache_key)}
+        if DatasetCache.etag_matches(if_none_match, cache_key):
+            return Response(status_code=304, headers=cache_headers)
+        if cached_archive := dataset_cache.get(cache_key):
+            return ZeroCopyFileResponse(
+                cached_archive,
+                media_type="application/x-zip-compressed",
+                filename=f"{picture_type}_{seed}.zip",
+                headers=cache_headers,
+            )
     positive_pictures: list[DBPicture] = []
     negative_pictures: list[DBPicture] = []
     if picture_class is True or picture_class is None:
         positive_pictures = await picture_service.get_annotated_pictures(
-            limit=limit, picture_type=picture_type, picture_class=True
+            limit=limit, picture_type=picture_type, picture_class=True, seed=seed
         )
     if picture_class is False or picture_class is None:
         negative_pictures = await picture_service.get_annotated_pictures(
-            limit=limit, picture_type=picture_type, picture_class=False
+            limit=limit, picture_type=picture_type, picture_class=False, seed=seed
         )
     if not positive_pictures and not negative_pictures:
         raise HTTPException(status_code=404, detail="No items found with given limit.")
     picture_metadata = []
     positive_picture_files = []
     negative_picture_files = []
-    for picture in [*positive_pictures, *negative_pictures]:
-        file = (
-            FilePath(picture.waterbowl_picture)
+    picture_locations = {
+        picture.id: (
+            picture.waterbowl_picture
             if picture_type == PictureType.WATER_BOWL
-            else FilePath(picture.food_picture)
+            else picture.food_picture
         )
-        if file.exists():
-            picture_data = picture.to_dict(flat=True)
-            picture_data.update({"filename": file.name})
-            picture_metadata.append(picture_data)
+        for picture in [*positive_pictures, *negative_pictures]
+    }
+    # Checked together in one worker thread instead of a blocking stat per picture on the event loop
+    existing_locations = await picture_storage.existing_pictures(
+        set(picture_locations.values())
+    )
+    for picture in [*positive_pictures, *negative_pictures]:
+        if picture_locations[picture.id] not in existing_locations:
+            continue
+        # Kept as the stored string, as a Path would fold the // out of an s3:// location
+        file = picture_locations[picture.id]
+        picture_data = picture.to_dict(flat=True)
+        picture_data.update({"filename": FilePath(file).name})
+        picture_metadata.append(picture_data)
         if picture_type == PictureType.WATER_BOWL:
             if picture.picture_metadata.water_in_bowl is True:
                 positive_picture_files.append(file)
@@ -163,13 +380,50 @@ async def get_batch_picture_endpoint(
                 positive_picture_files.append(file)
             else:
                 negative_picture_files.append(file)
-    async with ZipPackager.generate_dataset_zip(
+    if cache_key:
+        cached_archive = await dataset_cache.get_or_build(
+            cache_key,
+            ZipPackager.stream_dataset_zip(
+                positive_picture_files=positive_picture_files,
+                negative_picture_files=negative_picture_files,
+                picture_metadata=picture_metadata,
+                class_name=picture_type,
+            ),
+        )
+        return ZeroCopyFileResponse(
+            cached_archive,
+            media_type="application/x-zip-compressed",
+            filename=f"{picture_type}_{seed}.zip",
+            headers=cache_headers,
+        )
+    return ZipPackager.dataset_zip_response(
         positive_picture_files=positive_picture_files,
         negative_picture_files=negative_picture_files,
         picture_metadata=picture_metadata,
         class_name=picture_type,
-    ) as zip_package:
-        response = StreamingResponse(
-            zip_package.open("rb"), media_type="application/x-zip-compressed"
-        )
-        return response
+    )
+
+
+def require_profiling() -> None:
+    # Profiles hold stack samples from inside the app, so they are only served while profiling is switched on
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+@waterbowl_router.get("/profiles/", dependencies=[Depends(require_profiling)])
+async def list_profiles_endpoint() -> list[dict]:
+    return [
+        {"name": profile.name, "size": profile.stat().st_size}
+        for profile in profile_store.list()
+    ]
+
+
+@waterbowl_router.get(
+    "/profiles/{profile_name}",
+    response_class=FileResponse,
+    dependencies=[Depends(require_profiling)],
+)
+async def get_profile_endpoint(profile_name: str = Path()) -> FileResponse:
+    if profile := profile_store.get(profile_name):
+        return FileResponse(profile, media_type="text/plain", filename=profile.name)
+    raise HTTPException(status_code=404, detail="Profile not found")
@@ -0,0 +1,275 @@
+"""
+Compacts the crops of annotated pictures taken more than --older-than-days ago into pack files, so the pictures
+that are now only read by dataset exports stop costing an inode and a directory entry each. Each pack holds up to
+--batch-size pictures or PICTURE_PACK_MAX_BYTES, written in id order. A pack is synced to disk before its picture
+rows are pointed at it, and the same statement records the original crops to remove on the pack's row, so they
+are only ever listed once nothing needs them. A run that stops part way leaves that list behind, and the next run
+removes them first, keeping any crop a picture row still points at, so an interrupted run can simply be started
+again. Meant to be run on a schedule, e.g. nightly from cron:
+
+    python src/waterbowl_api/compact_pictures.py --older-than-days 30
+"""
+import asyncio
+import logging
+import sys
+from datetime import datetime, timedelta
+from functools import wraps
+from pathlib import Path
+
+import click
+from enums import PICTURE_COMPACTION_AGE_DAYS, PICTURE_PACK_MAX_BYTES
+from postgres.database import AsyncSessionLocal, engine
+from postgres.db_models import (
+    DBPicture,
+    DBPictureMetadata,
+    DBPicturePack,
+    human_annotated,
+)
+from sqlalchemy import Integer, String, column, or_, select, update, values
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from storage import LocalPictureStorage, PackedLocation, PackWriter, picture_storage
+
+logger = logging.getLogger(__name__)
+
+
+def coro(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        return asyncio.run(f(*args, **kwargs))
+
+    return wrapper
+
+
+def _fill_pack(
+    pack: PackWriter, pictures: list[tuple[int, list[str]]], max_bytes: int
+) -> tuple[dict[int, list[tuple[str, int, int]]], int]:
+    """
+    Appends each picture's crops to `pack` until it reaches `max_bytes`. Returns the location, offset and length
+    of every packed crop by picture id, and the id of the last picture that was packed or skipped.
+    """
+    packed: dict[int, list[tuple[str, int, int]]] = {}
+    last_id = 0
+    for picture_id, locations in pictures:
+        if packed and pack.size >= max_bytes:
+            break
+        start = pack.size
+        try:
+            packed[picture_id] = [
+                (location, *pack.append(location)) for location in locations
+            ]
+        except FileNotFoundError:
+            logger.warning("Skipping picture %s, a crop is missing", picture_id)
+            pack.truncate(start)
+        last_id = picture_id
+    return packed, last_id
+
+
+async def _remove_originals(
+    db: AsyncSession, storage: LocalPictureStorage, pack_id: int, locations: list[str]
+) -> None:
+    await storage.delete_pictures(*locations)
+    await db.execute(
+        update(DBPicturePack)
+        .where(DBPicturePack.id == pack_id)
+        .values(pending_deletions=None)
+    )
+    await db.commit()
+
+
+async def _finish_pending_deletions(
+    db: AsyncSession, storage: LocalPictureStorage
+) -> None:
+    """
+    Removes the originals that an interrupted run recorded but didn't get to, except any that a picture row still
+    points at.
+    """
+    unfinished_packs = (
+        await db.execute(
+            select(DBPicturePack.id, DBPicturePack.pending_deletions).where(
+                DBPicturePack.pending_deletions.is_not(None)
+            )
+        )
+    ).all()
+    for pack_id, pending_deletions in unfinished_packs:
+        referenced = set()
+        for waterbowl_picture, food_picture in await db.execute(
+            select(DBPicture.waterbowl_picture, DBPicture.food_picture).where(
+                DBPicture.at_any_of(pending_deletions)
+            )
+        ):
+            referenced.update([waterbowl_picture, food_picture])
+        kept = [location for location in pending_deletions if location in referenced]
+        if kept:
+            logger.warning(
+                "Keeping %s originals listed by pack %s, pictures still point at them",
+                len(kept),
+                pack_id,
+            )
+        logger.info("Removing the originals left over from pack %s", pack_id)
+        await _remove_originals(
+            db,
+            storage,
+            pack_id,
+            [location for location in pending_deletions if location not in referenced],
+        )
+
+
+async def compact_pictures(
+    db: AsyncSession,
+    storage: LocalPictureStorage,
+    older_than: datetime,
+    batch_size: int = 1000,
+    max_pack_bytes: int = PICTURE_PACK_MAX_BYTES,
+    dry_run: bool = False,
+) -> int:
+    """
+    Packs the crops of every annotated picture taken before `older_than` that isn't packed yet, and returns how
+    many pictures were (or, for a dry run, would be) packed.
+    """
+    metadata = DBPictureMetadata
+    compacted = 0
+    last_id = 0
+    if not dry_run:
+        await _finish_pending_deletions(db, storage)
+    while True:
+        pictures = (
+            await db.execute(
+                select(
+                    DBPicture.id, DBPicture.waterbowl_picture, DBPicture.food_picture
+                )
+                .join(DBPicture.picture_metadata)
+                .where(
+                    DBPicture.id > last_id,
+                    DBPicture.picture_timestamp < older_than,
+                    ~DBPicture.waterbowl_picture.startswith(PackedLocation.PREFIX),
+                    or_(
+                        human_annotated(
+                            metadata.human_water_yes, metadata.human_water_no
+                        ),
+                        human_annotated(
+                            metadata.human_food_yes, metadata.human_food_no
+                        ),
+                        human_annotated(metadata.human_cat_yes, metadata.human_cat_no),
+                    ),
+                )
+                .order_by(DBPicture.id)
+                .limit(batch_size)
+            )
+        ).all()
+        if not pictures:
+            return compacted
+        if dry_run:
+            compacted += len(pictures)
+            last_id = pictures[-1].id
+            continue
+        pack = await run_in_threadpool(storage.create_pack)
+        try:
+            packed, last_id = await run_in_threadpool(
+                _fill_pack,
+                pack,
+                [
+                    (picture.id, [picture.waterbowl_picture, picture.food_picture])
+                    for picture in pictures
+                ],
+                max_pack_bytes,
+            )
+            if not packed:
+                await run_in_threadpool(pack.discard)
+                continue
+            pack_row = DBPicturePack(size=pack.size, picture_count=len(packed))
+            db.add(pack_row)
+            await db.flush()
+            await run_in_threadpool(pack.seal, storage.pack_path(pack_row.id))
+        except BaseException:
+            await run_in_threadpool(pack.discard)
+            raise
+        batch = (
+            values(
+                column("picture_id", Integer),
+                column("waterbowl_picture", String),
+                column("food_picture", String),
+                name="batch",
+            )
+            .data(
+                [
+                    (
+                        picture_id,
+                        *[
+                            str(
+                                PackedLocation(
+                                    pack_id=pack_row.id,
+                                    offset=offset,
+                                    length=length,
+                                    filename=Path(location).name,
+                                )
+                            )
+                            for location, offset, length in crops
+                        ],
+                    )
+                    for picture_id, crops in packed.items()
+                ]
+            )
+            .alias("batch")
+        )
+        pictures_table = DBPicture.__table__
+        packs_table = DBPicturePack.__table__
+        packed_pictures = (
+            update(pictures_table)
+            .where(pictures_table.c.id == batch.c.picture_id)
+            .values(
+                waterbowl_picture=batch.c.waterbowl_picture,
+                food_picture=batch.c.food_picture,
+            )
+            .returning(pictures_table.c.id)
+            .cte("packed_pictures")
+        )
+        originals = [location for crops in packed.values() for location, _, _ in crops]
+        # One statement, so the originals are listed for removal exactly when the pictures stop pointing at them,
+        # even though the engine commits every statement on its own
+        await db.execute(
+            update(packs_table)
+            .where(packs_table.c.id == pack_row.id)
+            .values(pending_deletions=originals)
+            .add_cte(packed_pictures)
+        )
+        await db.commit()
+        await _remove_originals(db, storage, pack_row.id, originals)
+        compacted += len(packed)
+        logger.info(
+            "Packed %s pictures into pack %s, %s so far",
+            len(packed),
+            pack_row.id,
+            compacted,
+        )
+
+
+@click.command()
+@click.option(
+    "--older-than-days",
+    type=click.IntRange(min=0),
+    default=PICTURE_COMPACTION_AGE_DAYS,
+    show_default=True,
+)
+@click.option("--batch-size", type=click.IntRange(min=1), default=1000)
+@click.option("--dry-run", is_flag=True, help="Count the pictures to pack.")
+@coro
+async def run_compaction(older_than_days: int, batch_size: int, dry_run: bool):
+    logging.basicConfig(level=logging.INFO)
+    if not isinstance(picture_storage, LocalPictureStorage):
+        click.echo("Only pictures in local storage can be packed.")
+        sys.exit(2)
+    async with AsyncSessionLocal() as db:
+        compacted = await compact_pictures(
+            db,
+            picture_storage,
+            older_than=datetime.now() - timedelta(days=older_than_days),
+            batch_size=batch_size,
+            dry_run=dry_run,
+        )
+    await engine.dispose()
+    click.echo(f"{'Would pack' if dry_run else 'Packed'} {compacted} pictures.")
+
+
+if __name__ == "__main__":
+    run_compaction()  # pylint: disable=no-value-for-parameter
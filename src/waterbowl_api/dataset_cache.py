@@ -0,0 +1,113 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+from enums import DATASET_CACHE_DIR, DATASET_CACHE_MAX_BYTES
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+
+class DatasetCache:
+    """
+    On disk cache of finished dataset archives, keyed by everything that decides an archive's contents.
+
+    Archives are written to a temporary file and renamed into place, so readers only ever see complete files.
+    Each hit bumps the archive's mtime, and once the cache grows past `max_bytes` the least recently used
+    archives are removed.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._build_locks: dict[str, asyncio.Lock] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_bytes > 0
+
+    @staticmethod
+    def make_key(**key_parts: Any) -> str:
+        key_data = json.dumps(key_parts, sort_keys=True, default=str)
+        return hashlib.sha256(key_data.encode()).hexdigest()
+
+    @staticmethod
+    def make_etag(key: str) -> str:
+        return f'"{key}"'
+
+    @classmethod
+    def etag_matches(cls, if_none_match: Optional[str], key: str) -> bool:
+        if not if_none_match:
+            return False
+        etags = [etag.strip() for etag in if_none_match.split(",")]
+        return "*" in etags or cls.make_etag(key) in [
+            etag.removeprefix("W/") for etag in etags
+        ]
+
+    def _archive_path(self, key: str) -> Path:
+        return self._cache_dir.joinpath(f"{key}.zip")
+
+    def get(self, key: str) -> Optional[Path]:
+        archive = self._archive_path(key)
+        try:
+            os.utime(archive)
+        except FileNotFoundError:
+            return None
+        return archive
+
+    def _write_archive(self, key: str, archive_chunks: Iterator[bytes]) -> Path:
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        archive = self._archive_path(key)
+        partial_archive = archive.with_suffix(f".{os.getpid()}.partial")
+        try:
+            with open(partial_archive, "wb") as archive_file:
+                for chunk in archive_chunks:
+                    archive_file.write(chunk)
+            partial_archive.replace(archive)
+        finally:
+            partial_archive.unlink(missing_ok=True)
+        self._evict(keep=archive)
+        return archive
+
+    def _evict(self, keep: Path) -> None:
+        archives = []
+        for archive in self._cache_dir.glob("*.zip"):
+            try:
+                archives.append((archive.stat(), archive))
+            except FileNotFoundError:
+                continue
+        cache_size = sum(archive_stat.st_size for archive_stat, _ in archives)
+        for archive_stat, archive in sorted(
+            archives, key=lambda item: item[0].st_mtime
+        ):
+            if cache_size <= self._max_bytes:
+                break
+            if archive == keep:
+                continue
+            logger.debug("Evicting cached dataset %s", archive.name)
+            archive.unlink(missing_ok=True)
+            cache_size -= archive_stat.st_size
+
+    async def get_or_build(self, key: str, archive_chunks: Iterator[bytes]) -> Path:
+        """
+        Returns the cached archive for `key`, building it from `archive_chunks` off the event loop when it isn't
+        cached yet. Concurrent requests for the same key wait for a single build.
+        """
+        lock = self._build_locks.setdefault(key, asyncio.Lock())
+        try:
+            async with lock:
+                if archive := self.get(key):
+                    return archive
+                return await run_in_threadpool(self._write_archive, key, archive_chunks)
+        finally:
+            if not lock.locked():
+                self._build_locks.pop(key, None)
+
+
+dataset_cache = DatasetCache(
+    cache_dir=DATASET_CACHE_DIR, max_bytes=DATASET_CACHE_MAX_BYTES
+)
@@ -7,11 +7,59 @@ POSTGRES_ADDRESS = os.environ.get("POSTGRES_ADDRESS", "localhost:5432")
 POSTGRES_DATABASE = os.environ.get("POSTGRES_DATABASE", "postgres")
 POSTGRES_USER = os.environ.get("POSTGRES_USER", "postgres")
 POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD", "postgres")
+POSTGRES_POOL_SIZE = int(os.environ.get("POSTGRES_POOL_SIZE", 5))
+POSTGRES_MAX_OVERFLOW = int(os.environ.get("POSTGRES_MAX_OVERFLOW", 10))
+POSTGRES_POOL_TIMEOUT = float(os.environ.get("POSTGRES_POOL_TIMEOUT", 30))
+POSTGRES_POOL_RECYCLE = int(os.environ.get("POSTGRES_POOL_RECYCLE", -1))
+POSTGRES_POOL_PRE_PING = os.environ.get("POSTGRES_POOL_PRE_PING") == "true"
+POSTGRES_STATEMENT_CACHE_SIZE = int(
+    os.environ.get("POSTGRES_STATEMENT_CACHE_SIZE", 100)
+)
 PICTURES_DIR = Path(os.environ.get("PICTURES_DIR", "pictures"))
+PICTURE_FSYNC = os.environ.get("PICTURE_FSYNC") == "true"
+PICTURE_STORAGE = os.environ.get("PICTURE_STORAGE", "local")
+PICTURE_STORAGE_LAYOUT = os.environ.get("PICTURE_STORAGE_LAYOUT", "sharded")
+S3_BUCKET = os.environ.get("S3_BUCKET", "waterbowl-pictures")
+S3_PREFIX = os.environ.get("S3_PREFIX", "pictures/")
+# Set for MinIO or any other S3 compatible server; AWS credentials come from the usual AWS_* variables
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+S3_REGION = os.environ.get("S3_REGION")
+S3_MAX_CONNECTIONS = int(os.environ.get("S3_MAX_CONNECTIONS", 20))
+S3_MULTIPART_THRESHOLD = int(os.environ.get("S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+S3_PRESIGNED_URL_SECONDS = int(os.environ.get("S3_PRESIGNED_URL_SECONDS", 300))
+PICTURE_REDIRECTS = os.environ.get("PICTURE_REDIRECTS") == "true"
+PICTURE_PACK_MAX_BYTES = int(
+    os.environ.get("PICTURE_PACK_MAX_BYTES", 256 * 1024 * 1024)
+)
+PICTURE_COMPACTION_AGE_DAYS = int(os.environ.get("PICTURE_COMPACTION_AGE_DAYS", 30))
 PICTURES_TABLE = os.environ.get("PICTURES_TABLE", "test_pictures")
 PICTURES_MODELING_DATA = os.environ.get(
     "PICTURES_MODELING_DATA", "test_pictures_modeling_data"
 )
+PICTURE_PACKS_TABLE = os.environ.get("PICTURE_PACKS_TABLE", "test_picture_packs")
+DATASET_CACHE_DIR = Path(os.environ.get("DATASET_CACHE_DIR", "dataset-cache"))
+DATASET_CACHE_MAX_BYTES = int(
+    os.environ.get("DATASET_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024)
+)
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+IMAGE_BACKEND = os.environ.get("IMAGE_BACKEND", "pillow")
+IMAGE_WORKER_TYPE = os.environ.get("IMAGE_WORKER_TYPE", "thread")
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 2))
+IMAGE_WORKER_QUEUE_SIZE = int(os.environ.get("IMAGE_WORKER_QUEUE_SIZE", 8))
+IMAGE_WORKER_RETRY_AFTER = int(os.environ.get("IMAGE_WORKER_RETRY_AFTER", 5))
+PICTURE_SAMPLING_STRATEGY = os.environ.get("PICTURE_SAMPLING_STRATEGY", "id_probe")
+PICTURE_TABLESAMPLE_PERCENT = float(os.environ.get("PICTURE_TABLESAMPLE_PERCENT", 1))
+PREFETCH_QUEUE_SIZE = int(os.environ.get("PREFETCH_QUEUE_SIZE", 64))
+PREFETCH_RECENTLY_SERVED = int(os.environ.get("PREFETCH_RECENTLY_SERVED", 256))
+PICTURE_BATCH_MAX_SIZE = int(os.environ.get("PICTURE_BATCH_MAX_SIZE", 32))
+ANNOTATION_BATCH_MAX_SIZE = int(os.environ.get("ANNOTATION_BATCH_MAX_SIZE", 1000))
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED") == "true"
+PROFILING_SAMPLE_RATE = float(os.environ.get("PROFILING_SAMPLE_RATE", 0.01))
+PROFILING_THRESHOLD_SECONDS = float(os.environ.get("PROFILING_THRESHOLD_SECONDS", 1))
+PROFILING_INTERVAL_SECONDS = float(os.environ.get("PROFILING_INTERVAL_SECONDS", 0.005))
+PROFILING_HEADER = "X-Profile-Request"
+PROFILES_DIR = Path(os.environ.get("PROFILES_DIR", "profiles"))
+PROFILES_MAX_COUNT = int(os.environ.get("PROFILES_MAX_COUNT", 50))
 FOOD_BOWL_CROP_WINDOW = [
     250,
     450,
@@ -24,6 +72,16 @@ WATER_BOWL_CROP_WINDOW = [
     700,
     700,
 ]  # [crop_y, crop_x, crop_height, crop_width]
+WATER_BOWL_CROP = "water"
+FOOD_BOWL_CROP = "food"
+# Named crops taken from every upload, one for each picture column of the pictures table
+CROP_WINDOWS = {
+    WATER_BOWL_CROP: WATER_BOWL_CROP_WINDOW,
+    FOOD_BOWL_CROP: FOOD_BOWL_CROP_WINDOW,
+}
+# Size of the frames the camera uploads, which every crop window has to fit inside
+CAMERA_FRAME_WIDTH = int(os.environ.get("CAMERA_FRAME_WIDTH", 2592))
+CAMERA_FRAME_HEIGHT = int(os.environ.get("CAMERA_FRAME_HEIGHT", 1944))
 
 
 class PictureType(StrEnum):
@@ -31,6 +89,37 @@ class PictureType(StrEnum):
     FOOD_BOWL = "food_bowl"
 
 
+class ImageBackendType(StrEnum):
+    PILLOW = "pillow"
+    TENSORFLOW = "tensorflow"
+
+
+class ImageWorkerType(StrEnum):
+    THREAD = "thread"
+    PROCESS = "process"
+
+
+class PictureStorageType(StrEnum):
+    LOCAL = "local"
+    S3 = "s3"
+
+
+class PictureStorageLayout(StrEnum):
+    FLAT = "flat"
+    SHARDED = "sharded"
+
+
+class PictureSamplingStrategy(StrEnum):
+    RANDOM_ORDER = "random_order"
+    ID_PROBE = "id_probe"
+    TABLESAMPLE = "tablesample"
+
+
+class AnnotationStatus(StrEnum):
+    UPDATED = "updated"
+    NOT_FOUND = "not_found"
+
+
 class PictureRetrieveLimits(StrEnum):
     HUMAN_ANNOTATED = "human_annotated"
     NO_ANNOTATION = "no_annotation"
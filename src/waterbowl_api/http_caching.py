@@ -0,0 +1,137 @@
+import hashlib
+import re
+from datetime import timezone
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Union
+
+from image_cache import CachedImage
+from starlette.responses import Response
+from storage import PictureFileRange
+from zero_copy import ZeroCopyFileResponse
+
+# Crops are never rewritten after they are saved, so any copy can be reused for as long as a cache likes
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+_BYTE_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+class RangeNotSatisfiableException(Exception):
+    pass
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    etags = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in etags or etag in [candidate.removeprefix("W/") for candidate in etags]
+
+
+def modified_since(if_modified_since: Optional[str], last_modified: float) -> bool:
+    if not if_modified_since:
+        return True
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return True
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    # HTTP dates only have whole seconds
+    return int(last_modified) > since.timestamp()
+
+
+def byte_range(range_header: str, size: int) -> Optional[tuple[int, int]]:
+    """
+    First and last byte positions of a single `bytes=` range, or None when the header should be ignored and the
+    whole body sent, as it should for malformed or multi part ranges.
+    """
+    match = _BYTE_RANGE.fullmatch(range_header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if not first:
+        suffix_length = int(last)
+        if suffix_length == 0 or size == 0:
+            raise RangeNotSatisfiableException()
+        return max(size - suffix_length, 0), size - 1
+    if last and int(last) < int(first):
+        return None
+    if int(first) >= size:
+        raise RangeNotSatisfiableException()
+    return int(first), min(int(last), size - 1) if last else size - 1
+
+
+def file_etag(picture_file: PictureFileRange) -> str:
+    # Without reading the picture, so it can be sent straight from disk; the bytes at a location never change
+    file_id = f"{picture_file.path}:{picture_file.offset}:{picture_file.size}:{picture_file.last_modified}"
+    return f'"{hashlib.md5(file_id.encode(), usedforsecurity=False).hexdigest()}"'
+
+
+def _image_body(
+    image: Union[CachedImage, PictureFileRange],
+    first: int,
+    last: int,
+    status_code: int,
+    headers: dict[str, str],
+) -> Response:
+    if isinstance(image, PictureFileRange):
+        return ZeroCopyFileResponse(
+            image.path,
+            offset=image.offset + first,
+            size=last - first + 1,
+            status_code=status_code,
+            media_type="image/jpeg",
+            headers=headers,
+        )
+    return Response(
+        image.data[first : last + 1],
+        status_code=status_code,
+        media_type="image/jpeg",
+        headers=headers,
+    )
+
+
+def immutable_image_response(
+    image: Union[CachedImage, PictureFileRange],
+    if_none_match: Optional[str] = None,
+    if_modified_since: Optional[str] = None,
+    range_header: Optional[str] = None,
+    if_range: Optional[str] = None,
+) -> Response:
+    """
+    Serves a picture that never changes with long lived caching headers, either from memory or straight from
+    its file on disk. Answers conditional requests with a 304 and single byte ranges with a 206.
+    """
+    if isinstance(image, PictureFileRange):
+        etag, size = file_etag(image), image.size
+    else:
+        etag, size = image.etag, len(image.data)
+    last_modified = formatdate(image.last_modified, usegmt=True)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+    # If-Modified-Since is only considered when there is no If-None-Match
+    if (
+        etag_matches(if_none_match, etag)
+        if if_none_match is not None
+        else not modified_since(if_modified_since, image.last_modified)
+    ):
+        return Response(status_code=304, headers=headers)
+    if range_header and if_range in (None, etag, last_modified):
+        try:
+            requested_range = byte_range(range_header, size)
+        except RangeNotSatisfiableException:
+            return Response(
+                status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"}
+            )
+        if requested_range:
+            first, last = requested_range
+            return _image_body(
+                image,
+                first,
+                last,
+                status_code=206,
+                headers={**headers, "Content-Range": f"bytes {first}-{last}/{size}"},
+            )
+    return _image_body(image, 0, size - 1, status_code=200, headers=headers)
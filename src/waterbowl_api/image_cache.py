@@ -0,0 +1,109 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+from enums import IMAGE_CACHE_MAX_BYTES
+from metrics import IMAGE_CACHE_BYTES, IMAGE_CACHE_LOOKUPS
+from storage import picture_storage
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class CachedImage:
+    data: bytes
+    etag: str
+    last_modified: float
+
+
+class ImageCache:
+    """
+    In memory LRU of cropped picture bytes, bounded by their total size rather than the number of entries.
+
+    Crops are never rewritten once saved, so a cached copy can't go stale. Misses are read from picture storage
+    off the event loop and cached; a picture larger than the whole cache is served but not kept.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max(max_bytes, 0)
+        self._images: OrderedDict[str, CachedImage] = OrderedDict()
+        self._size = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_bytes > 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._images)
+
+    def __contains__(self, path: Union[str, Path]) -> bool:
+        return str(path) in self._images
+
+    def clear(self) -> None:
+        self._images.clear()
+        self._size = 0
+        IMAGE_CACHE_BYTES.set(0)
+
+    @staticmethod
+    def make_etag(data: bytes) -> str:
+        return f'"{hashlib.md5(data, usedforsecurity=False).hexdigest()}"'
+
+    def get(self, path: Union[str, Path]) -> Optional[CachedImage]:
+        image = self._images.get(str(path))
+        if image is not None:
+            self._images.move_to_end(str(path))
+        return image
+
+    def put(
+        self, path: Union[str, Path], data: bytes, last_modified: float
+    ) -> CachedImage:
+        image = CachedImage(
+            data=data, etag=self.make_etag(data), last_modified=last_modified
+        )
+        if len(data) > self._max_bytes:
+            return image
+        if (replaced := self._images.pop(str(path), None)) is not None:
+            self._size -= len(replaced.data)
+        self._images[str(path)] = image
+        self._size += len(data)
+        while self._size > self._max_bytes:
+            evicted_path, evicted = self._images.popitem(last=False)
+            logger.debug("Evicting cached image %s", evicted_path)
+            self._size -= len(evicted.data)
+        IMAGE_CACHE_BYTES.set(self._size)
+        return image
+
+    async def load(self, path: Union[str, Path]) -> Optional[CachedImage]:
+        """
+        Returns the picture at `path` from memory, or reads and caches it on a miss. None if the file is gone.
+        """
+        if image := self.get(path):
+            IMAGE_CACHE_LOOKUPS.labels("hit").inc()
+            return image
+        IMAGE_CACHE_LOOKUPS.labels("miss").inc()
+        try:
+            data, picture_info = await picture_storage.read(str(path))
+        except FileNotFoundError:
+            return None
+        return self.put(path, data, picture_info.last_modified)
+
+    async def warm(self, paths: Iterable[Union[str, Path]]) -> None:
+        if not self.enabled:
+            return
+        for path in paths:
+            if path not in self:
+                try:
+                    data, picture_info = await picture_storage.read(str(path))
+                except FileNotFoundError:
+                    continue
+                self.put(path, data, picture_info.last_modified)
+
+
+image_cache = ImageCache(max_bytes=IMAGE_CACHE_MAX_BYTES)
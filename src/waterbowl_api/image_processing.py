@@ -0,0 +1,123 @@
+from abc import ABC, abstractmethod
+from functools import cache
+from io import BytesIO
+
+from enums import IMAGE_BACKEND, ImageBackendType
+from PIL import Image
+
+
+def _bounding_window(crop_windows: list[list[int]]) -> list[int]:
+    top = min(window[0] for window in crop_windows)
+    left = min(window[1] for window in crop_windows)
+    bottom = max(window[0] + window[2] for window in crop_windows)
+    right = max(window[1] + window[3] for window in crop_windows)
+    return [top, left, bottom - top, right - left]
+
+
+def check_crop_windows(
+    crop_windows: dict[str, list[int]], width: int, height: int
+) -> None:
+    """
+    Raises ValueError for any window that doesn't lie wholly inside a `width` x `height` picture.
+    """
+    for name, (crop_y, crop_x, crop_height, crop_width) in crop_windows.items():
+        if (
+            min(crop_y, crop_x) < 0
+            or min(crop_height, crop_width) <= 0
+            or crop_y + crop_height > height
+            or crop_x + crop_width > width
+        ):
+            raise ValueError(
+                f"Crop window {name} {[crop_y, crop_x, crop_height, crop_width]} "
+                f"is outside a {width}x{height} picture"
+            )
+
+
+class ImageBackend(ABC):
+    @abstractmethod
+    def crop_pictures(
+        self, picture_data: bytes, crop_windows: dict[str, list[int]]
+    ) -> dict[str, bytes]:
+        """
+        Crops a raw JPEG into one grayscale JPEG per named crop window.
+
+        Implementations decode the upload once and slice every window out of that single decoded image, so
+        adding another window costs an encode rather than another decode. A window that doesn't fit inside the
+        picture raises ValueError.
+        """
+
+
+class PillowImageBackend(ImageBackend):
+    def crop_pictures(
+        self, picture_data: bytes, crop_windows: dict[str, list[int]]
+    ) -> dict[str, bytes]:
+        if not crop_windows:
+            return {}
+        with Image.open(BytesIO(picture_data)) as picture:
+            # Pillow would pad a window that runs off the picture, so check them as decode_and_crop_jpeg does
+            check_crop_windows(crop_windows, *picture.size)
+            # Ask libjpeg for the luminance channel directly instead of decoding colour and converting
+            picture.draft("L", picture.size)
+            picture.load()
+            decoded_picture = picture if picture.mode == "L" else picture.convert("L")
+            cropped_pictures: dict[str, bytes] = {}
+            for name, (crop_y, crop_x, crop_height, crop_width) in crop_windows.items():
+                cropped_image = decoded_picture.crop(
+                    (crop_x, crop_y, crop_x + crop_width, crop_y + crop_height)
+                )
+                new_jpg = BytesIO()
+                cropped_image.save(new_jpg, format="JPEG", quality=100)
+                cropped_pictures[name] = new_jpg.getvalue()
+        return cropped_pictures
+
+
+class TensorflowImageBackend(ImageBackend):
+    def crop_pictures(
+        self, picture_data: bytes, crop_windows: dict[str, list[int]]
+    ) -> dict[str, bytes]:
+        # TensorFlow takes seconds and hundreds of MB to import, so only pay for it when this backend is used
+        import tensorflow as tf  # pylint: disable=import-outside-toplevel
+
+        if not crop_windows:
+            return {}
+        # Only reads the JPEG header, and gives the same error as the Pillow backend for a window off the picture
+        height, width, _ = tf.image.extract_jpeg_shape(picture_data).numpy()
+        check_crop_windows(crop_windows, width, height)
+        bounds = _bounding_window(list(crop_windows.values()))
+        decoded_region = tf.image.decode_and_crop_jpeg(
+            contents=picture_data, crop_window=bounds, channels=1
+        )
+        cropped_pictures: dict[str, bytes] = {}
+        for name, (crop_y, crop_x, crop_height, crop_width) in crop_windows.items():
+            cropped_image = decoded_region[
+                crop_y - bounds[0] : crop_y - bounds[0] + crop_height,
+                crop_x - bounds[1] : crop_x - bounds[1] + crop_width,
+            ]
+            new_jpg = tf.image.encode_jpeg(
+                cropped_image, format="grayscale", quality=100
+            )
+            cropped_pictures[name] = new_jpg.numpy()
+        return cropped_pictures
+
+
+image_backends: dict[ImageBackendType, type[ImageBackend]] = {
+    ImageBackendType.PILLOW: PillowImageBackend,
+    ImageBackendType.TENSORFLOW: TensorflowImageBackend,
+}
+
+
+@cache
+def get_image_backend(backend: ImageBackendType = IMAGE_BACKEND) -> ImageBackend:
+    return image_backends[ImageBackendType(backend)]()
+
+
+def crop_pictures(
+    picture_data: bytes, crop_windows: dict[str, list[int]]
+) -> dict[str, bytes]:
+    """
+    Crops a raw JPEG with the configured image backend.
+
+    Runs inside the image worker pool, so it must stay a module level function that only takes and returns
+    picklable values.
+    """
+    return get_image_backend().crop_pictures(picture_data, crop_windows)
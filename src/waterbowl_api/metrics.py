@@ -0,0 +1,138 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+IMAGE_WORKER_QUEUE_DEPTH = Gauge(
+    "waterbowl_image_worker_queue_depth",
+    "Image jobs waiting for a free worker.",
+)
+IMAGE_WORKER_ACTIVE_JOBS = Gauge(
+    "waterbowl_image_worker_active_jobs",
+    "Image jobs accepted by the worker pool, queued or running.",
+)
+IMAGE_WORKER_JOB_SECONDS = Histogram(
+    "waterbowl_image_worker_job_seconds",
+    "Time from submitting an image job until its result is available.",
+)
+IMAGE_WORKER_REJECTIONS = Counter(
+    "waterbowl_image_worker_rejections_total",
+    "Image jobs rejected because the worker pool queue was full.",
+)
+IMAGE_CACHE_BYTES = Gauge(
+    "waterbowl_image_cache_bytes",
+    "Bytes of cropped pictures held in the in memory image cache.",
+)
+IMAGE_CACHE_LOOKUPS = Counter(
+    "waterbowl_image_cache_lookups_total",
+    "Picture reads served from the in memory image cache (hit) or from disk (miss).",
+    ["result"],
+)
+FILE_RESPONSE_BYTES = Counter(
+    "waterbowl_file_response_bytes_total",
+    "File bytes sent in responses, by how they were handed to the server: pathsend and zerocopysend leave the "
+    "copy to the server, chunked reads them through Python.",
+    ["method"],
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "waterbowl_db_pool_checked_out",
+    "Database connections currently checked out of the pool.",
+)
+DB_POOL_CHECKED_IN = Gauge(
+    "waterbowl_db_pool_checked_in",
+    "Idle database connections held by the pool.",
+)
+DB_POOL_OVERFLOW = Gauge(
+    "waterbowl_db_pool_overflow",
+    "Database connections open beyond the pool size.",
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "waterbowl_db_pool_wait_seconds",
+    "Time spent waiting to check a connection out of the pool, including opening new connections.",
+    buckets=(
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+        30,
+    ),
+)
+DB_POOL_TIMEOUTS = Counter(
+    "waterbowl_db_pool_timeouts_total",
+    "Connection checkouts that gave up because the pool stayed exhausted.",
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "waterbowl_http_request_seconds",
+    "Time from receiving a request until its response body has been sent, by route template.",
+    ["method", "route", "status"],
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "waterbowl_http_requests_in_flight",
+    "Requests currently being handled, by route template.",
+    ["method", "route"],
+)
+PICTURE_UPLOAD_BYTES = Histogram(
+    "waterbowl_picture_upload_bytes",
+    "Size of each uploaded camera frame.",
+    buckets=(64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6, 16e6),
+)
+PICTURE_WRITE_SECONDS = Histogram(
+    "waterbowl_picture_write_seconds",
+    "Time to write one upload's crops to storage, by stage: writing the files or syncing them to disk.",
+    ["stage"],
+    buckets=(
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+    ),
+)
+OPERATION_SECONDS = Histogram(
+    "waterbowl_operation_seconds",
+    "Time spent in the expensive steps behind the API, by operation.",
+    ["operation"],
+)
+DB_QUERY_SECONDS = Histogram(
+    "waterbowl_db_query_seconds",
+    "Time to execute a database statement, by the statement's leading keyword.",
+    ["statement"],
+    buckets=(
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+    ),
+)
+DATASET_ZIP_SECONDS = Histogram(
+    "waterbowl_dataset_zip_seconds",
+    "Time to build a dataset zip, from its first byte until the archive is finished or abandoned.",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+DATASET_ZIP_BYTES = Counter(
+    "waterbowl_dataset_zip_bytes_total",
+    "Bytes of dataset zip produced, whether streamed to a client or written to the cache.",
+)
@@ -0,0 +1,97 @@
+import random
+from time import perf_counter
+
+from enums import PROFILING_HEADER
+from metrics import HTTP_REQUEST_SECONDS, HTTP_REQUESTS_IN_FLIGHT
+from profiler import ProfileStore, StackSampler
+from starlette.concurrency import run_in_threadpool
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+UNMATCHED_ROUTE = "unmatched"
+
+
+class RequestMetricsMiddleware:
+    """
+    Records the latency and in-flight count of every HTTP request, labelled with the template of the route that
+    handles it (`/pictures/{picture_id}/` rather than `/pictures/42/`) so the number of label values stays fixed.
+    Plain ASGI rather than BaseHTTPMiddleware, so streamed responses are timed until their last chunk is sent.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    @staticmethod
+    def _route_template(scope: Scope) -> str:
+        for route in scope["app"].routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return UNMATCHED_ROUTE
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        route = self._route_template(scope)
+        status = "500"
+
+        async def _send(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        in_flight = HTTP_REQUESTS_IN_FLIGHT.labels(method, route)
+        in_flight.inc()
+        start = perf_counter()
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            in_flight.dec()
+            HTTP_REQUEST_SECONDS.labels(method, route, status).observe(
+                perf_counter() - start
+            )
+
+
+class ProfilingMiddleware:
+    """
+    Runs a stack sampler around a random `sample_rate` share of requests, plus any request carrying the
+    `X-Profile-Request` header, and saves the profile when the request took at least `threshold` seconds.
+    Requests that asked for a profile through the header always have it saved.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        store: ProfileStore,
+        sample_rate: float,
+        threshold: float,
+        interval: float,
+    ):
+        self.app = app
+        self._store = store
+        self._sample_rate = sample_rate
+        self._threshold = threshold
+        self._interval = interval
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        requested = PROFILING_HEADER.lower().encode() in dict(scope["headers"])
+        if not requested and random.random() >= self._sample_rate:
+            await self.app(scope, receive, send)
+            return
+        sampler = StackSampler(interval=self._interval)
+        sampler.start()
+        start = perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            duration = perf_counter() - start
+            folded_stacks = await run_in_threadpool(sampler.stop)
+            if requested or duration >= self._threshold:
+                name = self._store.make_name(scope["method"], scope["path"], duration)
+                await run_in_threadpool(self._store.save, name, folded_stacks)
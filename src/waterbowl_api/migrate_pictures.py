@@ -0,0 +1,201 @@
+"""
+Moves crops saved under an older layout to where the configured picture storage layout puts them, and points
+their picture rows at the new locations. Pictures are handled in batches of --batch-size: each crop is hard
+linked into place, the batch's rows are rewritten with one UPDATE, and only then are the old files removed. A run
+can be interrupted at any point and simply started again: each run first removes the old links that a stopped
+run left behind, found as files sharing an inode with a file that a picture row points at.
+
+    PICTURE_STORAGE_LAYOUT=sharded python src/waterbowl_api/migrate_pictures.py --batch-size 1000
+"""
+import asyncio
+import logging
+import os
+import sys
+from functools import wraps
+from pathlib import Path
+
+import click
+from postgres.database import AsyncSessionLocal, engine
+from postgres.db_models import DBPicture
+from sqlalchemy import Integer, String, column, select, update, values
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from storage import LocalPictureStorage, PackedLocation, picture_storage
+
+logger = logging.getLogger(__name__)
+
+
+def coro(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        return asyncio.run(f(*args, **kwargs))
+
+    return wrapper
+
+
+def _relocate_batch(
+    storage: LocalPictureStorage, moves: dict[int, dict[str, str]]
+) -> dict[int, dict[str, str]]:
+    relocated = {}
+    for picture_id, locations in moves.items():
+        try:
+            for location, new_location in locations.items():
+                storage.relocate_picture(location, new_location)
+        except FileNotFoundError:
+            logger.warning("Skipping picture %s, a crop is missing", picture_id)
+            continue
+        relocated[picture_id] = locations
+    return relocated
+
+
+def _linked_pictures(pictures_dir: Path) -> list[list[str]]:
+    """
+    Groups the picture files under `pictures_dir` that are links to the same file, as relocating a picture leaves
+    them until its old location is removed.
+    """
+    links: dict[tuple[int, int], list[str]] = {}
+    for directory, subdirectories, filenames in os.walk(pictures_dir):
+        if directory == str(pictures_dir) and "packs" in subdirectories:
+            subdirectories.remove("packs")
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            stat_result = os.lstat(path)
+            if stat_result.st_nlink > 1:
+                links.setdefault((stat_result.st_dev, stat_result.st_ino), []).append(
+                    path
+                )
+    return [paths for paths in links.values() if len(paths) > 1]
+
+
+async def _remove_leftover_links(
+    db: AsyncSession, storage: LocalPictureStorage
+) -> None:
+    """
+    Removes the links an interrupted run left beside the one each picture row points at: the old locations of
+    pictures it had already moved, and the new ones of pictures it hadn't, which the next batch links again.
+    """
+    linked_pictures = await run_in_threadpool(_linked_pictures, storage.pictures_dir)
+    if not linked_pictures:
+        return
+    referenced = set()
+    for waterbowl_picture, food_picture in await db.execute(
+        select(DBPicture.waterbowl_picture, DBPicture.food_picture).where(
+            DBPicture.at_any_of([path for paths in linked_pictures for path in paths])
+        )
+    ):
+        referenced.update([waterbowl_picture, food_picture])
+    leftovers = [
+        path
+        for paths in linked_pictures
+        if referenced.intersection(paths)
+        for path in paths
+        if path not in referenced
+    ]
+    if leftovers:
+        logger.info("Removing %s old links left by an earlier run", len(leftovers))
+        await storage.delete_pictures(*leftovers)
+
+
+async def migrate_picture_layout(
+    db: AsyncSession,
+    storage: LocalPictureStorage,
+    batch_size: int = 1000,
+    dry_run: bool = False,
+) -> int:
+    """
+    Relocates every picture whose crops aren't where `storage` would save them, and returns how many pictures
+    were (or, for a dry run, would be) moved.
+    """
+    migrated = 0
+    last_id = 0
+    if not dry_run:
+        await _remove_leftover_links(db, storage)
+    while True:
+        pictures = (
+            await db.execute(
+                select(
+                    DBPicture.id,
+                    DBPicture.waterbowl_picture,
+                    DBPicture.food_picture,
+                    DBPicture.picture_timestamp,
+                )
+                .where(DBPicture.id > last_id)
+                .order_by(DBPicture.id)
+                .limit(batch_size)
+            )
+        ).all()
+        if not pictures:
+            return migrated
+        last_id = pictures[-1].id
+        moves: dict[int, dict[str, str]] = {}
+        for picture in pictures:
+            locations = [picture.waterbowl_picture, picture.food_picture]
+            # Packs aren't laid out by time, so packed pictures stay where they are
+            if any(PackedLocation.parse(location) for location in locations):
+                continue
+            new_locations = [
+                storage.location(Path(location).name, picture.picture_timestamp)
+                for location in locations
+            ]
+            if new_locations != locations:
+                moves[picture.id] = dict(zip(locations, new_locations))
+        if dry_run or not moves:
+            migrated += len(moves)
+            continue
+        relocated = await run_in_threadpool(_relocate_batch, storage, moves)
+        if not relocated:
+            continue
+        batch = (
+            values(
+                column("picture_id", Integer),
+                column("waterbowl_picture", String),
+                column("food_picture", String),
+                name="batch",
+            )
+            .data(
+                [
+                    (picture_id, *locations.values())
+                    for picture_id, locations in relocated.items()
+                ]
+            )
+            .alias("batch")
+        )
+        pictures_table = DBPicture.__table__
+        await db.execute(
+            update(pictures_table)
+            .where(pictures_table.c.id == batch.c.picture_id)
+            .values(
+                waterbowl_picture=batch.c.waterbowl_picture,
+                food_picture=batch.c.food_picture,
+            )
+        )
+        await db.commit()
+        await storage.delete_pictures(
+            *[location for locations in relocated.values() for location in locations]
+        )
+        migrated += len(relocated)
+        logger.info("Migrated %s pictures, up to id %s", migrated, last_id)
+
+
+@click.command()
+@click.option("--batch-size", type=click.IntRange(min=1), default=1000)
+@click.option("--dry-run", is_flag=True, help="Count the pictures to move.")
+@coro
+async def run_migration(batch_size: int, dry_run: bool):
+    logging.basicConfig(level=logging.INFO)
+    if not isinstance(picture_storage, LocalPictureStorage):
+        click.echo("Only pictures in local storage can be migrated.")
+        sys.exit(2)
+    async with AsyncSessionLocal() as db:
+        migrated = await migrate_picture_layout(
+            db, picture_storage, batch_size=batch_size, dry_run=dry_run
+        )
+    await engine.dispose()
+    click.echo(
+        f"{'Would move' if dry_run else 'Moved'} {migrated} pictures to the "
+        f"{picture_storage.layout} layout."
+    )
+
+
+if __name__ == "__main__":
+    run_migration()  # pylint: disable=no-value-for-parameter
@@ -1,7 +1,8 @@
 from datetime import datetime
 from typing import Optional
 
-from pydantic import BaseModel
+from enums import ANNOTATION_BATCH_MAX_SIZE, AnnotationStatus
+from pydantic import BaseModel, conlist
 
 
 class Picture(BaseModel):
@@ -38,3 +39,18 @@ class PictureUpdateRequest(BaseModel):
     human_cat_no: Optional[int] = 0
     human_water_no: Optional[int] = 0
     human_food_no: Optional[int] = 0
+
+
+class AnnotationBatchItem(PictureUpdateRequest):
+    picture_id: int
+
+
+class AnnotationBatchRequest(BaseModel):
+    annotations: conlist(
+        AnnotationBatchItem, min_items=1, max_items=ANNOTATION_BATCH_MAX_SIZE
+    )
+
+
+class AnnotationBatchResult(BaseModel):
+    picture_id: int
+    status: AnnotationStatus
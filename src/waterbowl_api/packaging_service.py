@@ -1,57 +1,179 @@
 import csv
-import json
-import os
-import shutil
+import io
+import zipfile
 from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Any, Optional
+from time import localtime, perf_counter
+from typing import Any, Iterator, Optional, Union
 from uuid import uuid4
 
 import aiofiles
+import aiofiles.tempfile
 from enums import PictureType
+from metrics import DATASET_ZIP_BYTES, DATASET_ZIP_SECONDS
+from starlette.background import BackgroundTask
+from starlette.responses import StreamingResponse
+from storage import picture_storage
+
+STREAM_CHUNK_SIZE = 64 * 1024
+# Regular file, rw-r--r--, as ZipInfo.from_file would record for a saved crop
+PICTURE_FILE_MODE = 0o100644
+
+
+class _ZipStreamBuffer(io.RawIOBase):
+    """
+    Write-only, unseekable sink for ZipFile. Because it can't seek, ZipFile writes sizes and CRCs in data
+    descriptors after each member instead of going back to patch the local headers, so whatever has been written
+    so far can be handed to the client straight away.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> Iterator[bytes]:
+        if self._chunks:
+            yield b"".join(self._chunks)
+            self._chunks.clear()
 
 
 class ZipPackager:
+    @staticmethod
+    def _metadata_csv(picture_metadata: list[dict[str, Any]]) -> str:
+        data_file = io.StringIO()
+        csv_writer = csv.writer(data_file)
+        for i, metadata in enumerate(picture_metadata):
+            if i == 0:
+                csv_writer.writerow(metadata.keys())
+            csv_writer.writerow(metadata.values())
+        return data_file.getvalue()
+
+    @classmethod
+    def stream_dataset_zip(
+        cls,
+        positive_picture_files: Optional[list[Union[str, Path]]],
+        negative_picture_files: Optional[list[Union[str, Path]]],
+        picture_metadata: list[dict[str, Any]],
+        class_name: PictureType,
+        chunk_size: int = STREAM_CHUNK_SIZE,
+    ) -> Iterator[bytes]:
+        """
+        Yields a zip archive of the given pictures, split into positive and negative class directories, plus a
+        picture_data.csv file. Pictures are read straight from their current location and stored uncompressed
+        (JPEGs don't compress), so memory use stays at roughly one chunk no matter how large the dataset is.
+        """
+        buffer = _ZipStreamBuffer()
+        archived_names: set[str] = set()
+        start = perf_counter()
+        try:
+            with zipfile.ZipFile(
+                buffer, "w", compression=zipfile.ZIP_STORED
+            ) as archive:
+                for class_dir, picture_files in [
+                    (f"{class_name}_true", positive_picture_files),
+                    (f"{class_name}_false", negative_picture_files),
+                ]:
+                    if not picture_files:
+                        continue
+                    archive.mkdir(class_dir)
+                    # Packed pictures are read in pack order, so a pack is streamed front to back
+                    for picture_file in sorted(
+                        picture_files,
+                        key=lambda picture_file: picture_storage.read_order(
+                            str(picture_file)
+                        ),
+                    ):
+                        archive_name = f"{class_dir}/{Path(picture_file).name}"
+                        # Same as extracting into a directory: a repeated filename is only stored once
+                        if archive_name in archived_names:
+                            continue
+                        archived_names.add(archive_name)
+                        with picture_storage.open_picture(str(picture_file)) as (
+                            in_file,
+                            picture_info,
+                        ):
+                            zip_info = zipfile.ZipInfo(
+                                archive_name,
+                                date_time=localtime(picture_info.last_modified)[:6],
+                            )
+                            zip_info.file_size = picture_info.size
+                            zip_info.external_attr = PICTURE_FILE_MODE << 16
+                            with archive.open(zip_info, "w") as out_file:
+                                while chunk := in_file.read(chunk_size):
+                                    out_file.write(chunk)
+                                    yield from buffer.drain()
+                        yield from buffer.drain()
+                archive.writestr(
+                    "picture_data.csv", cls._metadata_csv(picture_metadata)
+                )
+            yield from buffer.drain()
+        finally:
+            DATASET_ZIP_SECONDS.observe(perf_counter() - start)
+            DATASET_ZIP_BYTES.inc(buffer.tell())
+
+    @classmethod
+    def dataset_zip_response(
+        cls,
+        positive_picture_files: Optional[list[Union[str, Path]]],
+        negative_picture_files: Optional[list[Union[str, Path]]],
+        picture_metadata: list[dict[str, Any]],
+        class_name: PictureType,
+    ) -> StreamingResponse:
+        """
+        Streams a dataset zip as the response body. The response owns the archive stream and closes it once the
+        body has been sent or the client has gone away, so no picture file is left open between requests.
+        """
+        dataset_name = f"{class_name}_{uuid4()}"
+        archive_stream = cls.stream_dataset_zip(
+            positive_picture_files=positive_picture_files,
+            negative_picture_files=negative_picture_files,
+            picture_metadata=picture_metadata,
+            class_name=class_name,
+        )
+        return StreamingResponse(
+            archive_stream,
+            media_type="application/x-zip-compressed",
+            headers={
+                "Content-Disposition": f'attachment; filename="{dataset_name}.zip"'
+            },
+            background=BackgroundTask(archive_stream.close),
+        )
+
     @classmethod
     @asynccontextmanager
     async def generate_dataset_zip(
         cls,
-        positive_picture_files: Optional[list[Path]],
-        negative_picture_files: Optional[list[Path]],
+        positive_picture_files: Optional[list[Union[str, Path]]],
+        negative_picture_files: Optional[list[Union[str, Path]]],
         picture_metadata: list[dict[str, Any]],
         class_name: PictureType,
-        dataset_name: str = str(uuid4()),
+        dataset_name: Optional[str] = None,
     ) -> Path:
+        """
+        Writes a dataset zip to a private temporary directory that is removed when the context exits, so the
+        archive must be fully consumed inside the `async with` block.
+        """
+        dataset_name = dataset_name or str(uuid4())
         async with aiofiles.tempfile.TemporaryDirectory() as tmp_dir:
-            tmp_dir_path = Path(tmp_dir)
-            if positive_picture_files:
-                positive_class_dir = tmp_dir_path.joinpath(f"{class_name}_true")
-                os.mkdir(positive_class_dir)
-            else:
-                positive_picture_files = []
-            if negative_picture_files:
-                negative_class_dir = tmp_dir_path.joinpath(f"{class_name}_false")
-                os.mkdir(negative_class_dir)
-            else:
-                negative_picture_files = []
-            for picture_file in positive_picture_files:
-                shutil.copyfile(
-                    picture_file, positive_class_dir.joinpath(picture_file.name)
-                )
-            for picture_file in negative_picture_files:
-                shutil.copyfile(
-                    picture_file, negative_class_dir.joinpath(picture_file.name)
-                )
-            with open(tmp_dir_path.joinpath("picture_data.csv"), "w+") as data_file:
-                csv_writer = csv.writer(data_file)
-                for i, metadata in enumerate(picture_metadata):
-                    if i == 0:
-                        csv_writer.writerow(metadata.keys())
-                    csv_writer.writerow(metadata.values())
-            archive = Path(
-                shutil.make_archive(
-                    base_name=dataset_name, format="zip", root_dir=tmp_dir_path
-                )
-            )
+            archive = Path(tmp_dir).joinpath(f"{dataset_name}.zip")
+            async with aiofiles.open(archive, "wb") as archive_file:
+                for chunk in cls.stream_dataset_zip(
+                    positive_picture_files=positive_picture_files,
+                    negative_picture_files=negative_picture_files,
+                    picture_metadata=picture_metadata,
+                    class_name=class_name,
+                ):
+                    await archive_file.write(chunk)
             yield archive
-            archive.unlink(missing_ok=True)
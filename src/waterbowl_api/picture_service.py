@@ -1,25 +1,40 @@
+import asyncio
 import logging
 from datetime import datetime
-from pathlib import Path
-from typing import Optional, Tuple, Union, cast
+from functools import cache
+from typing import Collection, Optional, Tuple, Union, cast
 
-import aiofiles
 import shortuuid
-import tensorflow as tf
 from enums import (
-    FOOD_BOWL_CROP_WINDOW,
-    PICTURES_DIR,
-    WATER_BOWL_CROP_WINDOW,
+    CROP_WINDOWS,
+    FOOD_BOWL_CROP,
+    WATER_BOWL_CROP,
     PictureRetrieveLimits,
     PictureType,
 )
 from fastapi import UploadFile
+from image_processing import crop_pictures
+from metrics import OPERATION_SECONDS, PICTURE_UPLOAD_BYTES
 from models import PictureUpdateRequest
-from postgres.db_models import DBPicture, DBPictureMetadata
-from sqlalchemy import Column, and_, false, or_, select, true, update
+from postgres.db_models import (
+    DBPicture,
+    DBPictureMetadata,
+    annotated_as,
+    human_annotated,
+    unannotated,
+)
+from sampling import PictureSampler, get_picture_sampler
+from sqlalchemy import ARRAY, Column, DateTime, Integer, Select, String, and_, bindparam
+from sqlalchemy import cast as sql_cast
+from sqlalchemy import column, false, insert, select, update
 from sqlalchemy.engine import Result
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased, contains_eager
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql.elements import ColumnElement
 from sqlalchemy.sql.expression import func
+from storage import picture_storage
+from workers import image_worker_pool
 
 logger = logging.getLogger(__name__)
 
@@ -31,57 +46,166 @@ class PostgresException(Exception):
 
 async def save_pictures(
     in_file: UploadFile, timestamp: float
-) -> Tuple[Path, Path, datetime]:
-    new_images: list[Path] = []
+) -> Tuple[str, str, datetime]:
     in_file_data = await in_file.read()
-    for crop_window in [WATER_BOWL_CROP_WINDOW, FOOD_BOWL_CROP_WINDOW]:
-        file_suffix = f"{timestamp}_{shortuuid.uuid()}.jpeg"
-        filename = (
-            f"water_{file_suffix}"
-            if crop_window == WATER_BOWL_CROP_WINDOW
-            else f"food_{file_suffix}"
-        )
-        time = datetime.fromtimestamp(timestamp)
-        raw_picture_path = PICTURES_DIR.joinpath(filename)
-        async with aiofiles.open(raw_picture_path, "w+b") as out_file:
-            decoded_image = tf.image.decode_and_crop_jpeg(
-                contents=in_file_data, crop_window=crop_window, channels=1
-            )
-            new_jpg = tf.image.encode_jpeg(
-                decoded_image, format="grayscale", quality=100
-            )
-            tf.io.write_file(filename=out_file.name, contents=new_jpg)
-        new_images.append(raw_picture_path)
-    return *new_images, time
+    PICTURE_UPLOAD_BYTES.observe(len(in_file_data))
+    with OPERATION_SECONDS.labels("crop_pictures").time():
+        cropped_pictures = await image_worker_pool.submit(
+            crop_pictures, in_file_data, CROP_WINDOWS
+        )
+    time = datetime.fromtimestamp(timestamp)
+    filenames = {
+        crop_name: f"{crop_name}_{timestamp}_{shortuuid.uuid()}.jpeg"
+        for crop_name in cropped_pictures
+    }
+    with OPERATION_SECONDS.labels("write_pictures").time():
+        saved_pictures = await picture_storage.write_pictures(
+            {
+                filenames[crop_name]: cropped_picture
+                for crop_name, cropped_picture in cropped_pictures.items()
+            },
+            taken_at=time,
+        )
+    return (
+        saved_pictures[filenames[WATER_BOWL_CROP]],
+        saved_pictures[filenames[FOOD_BOWL_CROP]],
+        time,
+    )
+
+
+async def save_picture_batch(
+    uploads: list[tuple[UploadFile, float]]
+) -> list[Tuple[str, str, datetime]]:
+    """
+    Crops and saves a batch of uploads in parallel, keeping at most one job per image worker in flight so a single
+    batch can't fill the pool's queue by itself. If any upload fails, the crops already saved are removed.
+    """
+    worker_slots = asyncio.Semaphore(image_worker_pool.max_workers)
+
+    async def _save(in_file: UploadFile, timestamp: float):
+        async with worker_slots:
+            return await save_pictures(in_file=in_file, timestamp=timestamp)
+
+    results = await asyncio.gather(
+        *[_save(in_file, timestamp) for in_file, timestamp in uploads],
+        return_exceptions=True,
+    )
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        for result in results:
+            if not isinstance(result, BaseException):
+                await picture_storage.delete_pictures(result[0], result[1])
+        raise errors[0]
+    return results
+
+
+@cache
+def _insert_pictures_statement() -> Select:
+    """
+    Inserts one metadata row and one picture row per saved picture. The pictures are passed as arrays and
+    unnested in the database, so the statement text is the same for any batch size and is only compiled and
+    prepared once.
+    """
+    metadata_table = DBPictureMetadata.__table__
+    pictures_table = DBPicture.__table__
+    new_metadata = (
+        insert(metadata_table)
+        .from_select(
+            [metadata_table.c.water_in_bowl],
+            select(false()).select_from(
+                func.generate_series(1, bindparam("picture_count", type_=Integer))
+            ),
+        )
+        .returning(*metadata_table.c)
+        .cte("new_metadata")
+    )
+    # Every new metadata row is identical, so it doesn't matter which picture each one is paired with
+    numbered_metadata = select(
+        new_metadata.c.id,
+        func.row_number()  # pylint: disable=not-callable
+        .over(order_by=new_metadata.c.id)
+        .label("position"),
+    ).cte("numbered_metadata")
+    saved = (
+        func.unnest(
+            sql_cast(bindparam("waterbowl_pictures"), ARRAY(String)),
+            sql_cast(bindparam("food_pictures"), ARRAY(String)),
+            sql_cast(bindparam("picture_timestamps"), ARRAY(DateTime)),
+        )
+        .table_valued(
+            column("waterbowl_picture", String),
+            column("food_picture", String),
+            column("picture_timestamp", DateTime),
+            with_ordinality="position",
+        )
+        .render_derived(name="saved_pictures")
+    )
+    new_pictures = (
+        insert(pictures_table)
+        .from_select(
+            ["metadata_id", "waterbowl_picture", "food_picture", "picture_timestamp"],
+            select(
+                numbered_metadata.c.id,
+                saved.c.waterbowl_picture,
+                saved.c.food_picture,
+                saved.c.picture_timestamp,
+            ).join(saved, saved.c.position == numbered_metadata.c.position),
+        )
+        .returning(*pictures_table.c)
+        .cte("new_pictures")
+    )
+    return select(DBPicture, DBPictureMetadata).from_statement(
+        select(new_pictures, new_metadata).join(
+            new_metadata, new_metadata.c.id == new_pictures.c.metadata_id
+        )
+    )
 
 
 class PictureService:
-    def __init__(self, db: AsyncSession):
+    def __init__(self, db: AsyncSession, sampler: Optional[PictureSampler] = None):
         self._db = db
-
-    async def create_metadata(self) -> DBPictureMetadata:
-        db_picture_metadata = DBPictureMetadata()
-        self._db.add(db_picture_metadata)
-        await self._db.commit()
-        return db_picture_metadata
+        self._sampler = sampler or get_picture_sampler()
 
     async def create_pictures(self, picture: UploadFile, timestamp: float) -> DBPicture:
-        waterbowl_picture, food_picture, time = await save_pictures(
-            in_file=picture, timestamp=timestamp
-        )
-        metadata = await self.create_metadata()
-        time = datetime.fromtimestamp(timestamp)
-        db_picture = DBPicture(
-            metadata_id=metadata.id,
-            waterbowl_picture=f"{waterbowl_picture}",
-            food_picture=f"{food_picture}",
-            picture_timestamp=time,
-        )
-        self._db.add(db_picture)
-        await self._db.commit()
-        await self._db.refresh(db_picture)
+        saved_picture = await save_pictures(in_file=picture, timestamp=timestamp)
+        [db_picture] = await self._insert_pictures([saved_picture])
         return db_picture
 
+    async def create_pictures_batch(
+        self, uploads: list[tuple[UploadFile, float]]
+    ) -> list[DBPicture]:
+        """
+        Saves a batch of uploads and inserts all of their metadata and picture rows with one statement. Returns
+        the new pictures in upload order.
+        """
+        return await self._insert_pictures(await save_picture_batch(uploads))
+
+    async def _insert_pictures(
+        self, saved_pictures: list[Tuple[str, str, datetime]]
+    ) -> list[DBPicture]:
+        """
+        Inserts the metadata and picture rows for saved crops in one statement, so either every picture is
+        created or none are, and no metadata row is ever left without its picture.
+        """
+        statement = _insert_pictures_statement()
+        parameters = {
+            "picture_count": len(saved_pictures),
+            "waterbowl_pictures": [str(picture[0]) for picture in saved_pictures],
+            "food_pictures": [str(picture[1]) for picture in saved_pictures],
+            "picture_timestamps": [picture[2] for picture in saved_pictures],
+        }
+        created_pictures: dict[str, DBPicture] = {}
+        for db_picture, picture_metadata in await self._db.execute(
+            statement, parameters
+        ):
+            set_committed_value(db_picture, "picture_metadata", picture_metadata)
+            created_pictures[db_picture.waterbowl_picture] = db_picture
+        await self._db.commit()
+        return [
+            created_pictures[str(waterbowl_picture)]
+            for waterbowl_picture, _, _ in saved_pictures
+        ]
+
     async def _get_single_item(
         self, item_type: type, item_id: int
     ) -> Union[DBPicture, DBPictureMetadata]:
@@ -105,77 +229,162 @@ class PictureService:
             logger.debug("No picture found with id %s", picture_id)
         return picture
 
+    @staticmethod
+    def _get_limit_criteria(limit: Optional[PictureRetrieveLimits]):
+        if limit == PictureRetrieveLimits.NO_ANNOTATION:
+            return unannotated(
+                DBPictureMetadata.human_water_yes, DBPictureMetadata.human_water_no
+            )
+        if limit == PictureRetrieveLimits.HUMAN_ANNOTATED:
+            return human_annotated(
+                DBPictureMetadata.human_water_yes, DBPictureMetadata.human_water_no
+            )
+        return None
+
     async def get_random_picture(
         self, limit: PictureRetrieveLimits = None
     ) -> Optional[DBPicture]:
-        statement = (
-            select(DBPicture)
-            .order_by(func.random())  # pylint: disable=not-callable
-            .limit(1)
-        )
-        if limit:
-            if limit == PictureRetrieveLimits.NO_ANNOTATION:
-                statement = (
-                    select(DBPicture, DBPictureMetadata)
-                    .join(DBPicture.picture_metadata)
-                    .filter(
-                        and_(
-                            DBPictureMetadata.human_water_yes == 0,
-                            DBPictureMetadata.human_water_no == 0,
-                        )
-                    )
-                    .order_by(func.random())  # pylint: disable=not-callable
-                    .limit(1)
-                )
-            if limit == PictureRetrieveLimits.HUMAN_ANNOTATED:
-                statement = (
-                    select(DBPicture, DBPictureMetadata)
-                    .join(DBPicture.picture_metadata)
-                    .filter(
-                        or_(
-                            DBPictureMetadata.human_water_yes > 0,
-                            DBPictureMetadata.human_water_no > 0,
-                        )
-                    )
-                    .order_by(func.random())  # pylint: disable=not-callable
-                    .limit(1)
-                )
-        result: Result = await self._db.execute(statement)
-        if pictures := result.fetchone():
-            picture = pictures[0]
-            return picture
-        return None
+        return await self._sampler.sample(
+            self._db, criteria=self._get_limit_criteria(limit)
+        )
+
+    async def get_random_pictures(
+        self,
+        count: int,
+        limit: PictureRetrieveLimits = None,
+        exclude_ids: Collection[int] = (),
+    ) -> list[DBPicture]:
+        criteria = self._get_limit_criteria(limit)
+        if exclude_ids:
+            exclusion = DBPicture.id.not_in(exclude_ids)
+            criteria = exclusion if criteria is None else and_(criteria, exclusion)
+        return await self._sampler.sample_many(self._db, count=count, criteria=criteria)
+
+    @staticmethod
+    def _vote_values(votes: dict[str, ColumnElement]) -> dict[str, ColumnElement]:
+        """
+        SET values for new vote counts, plus the labels they imply. Every expression on the right of SET reads
+        the row as it was before the update, and Postgres serialises concurrent updates to the same row, so
+        parallel votes are never lost.
+        """
+        return {
+            **votes,
+            "water_in_bowl": votes["human_water_yes"] > votes["human_water_no"],
+            "food_in_bowl": votes["human_food_yes"] > votes["human_food_no"],
+            "cat_at_bowl": votes["human_cat_yes"] > votes["human_cat_no"],
+        }
 
     async def update_metadata(
         self, metadata_id: int, updates: PictureUpdateRequest
     ) -> DBPictureMetadata:
-        metadata = await self.get_metadata(metadata_id)
-        updated_human_water_yes = metadata.human_water_yes + updates.human_water_yes
-        updated_human_water_no = metadata.human_water_no + updates.human_water_no
-        updated_human_food_yes = metadata.human_food_yes + updates.human_food_yes
-        updated_human_food_no = metadata.human_food_no + updates.human_food_no
-        updated_human_cat_yes = metadata.human_cat_yes + updates.human_cat_yes
-        updated_human_cat_no = metadata.human_cat_no + updates.human_cat_no
-        updated_water_in_bowl = updated_human_water_yes > updated_human_water_no
-        updated_food_in_bowl = updated_human_food_yes > updated_human_food_no
-        updated_cat_at_bowl = updated_human_cat_yes > updated_human_cat_no
+        """
+        Adds the requested votes to the stored counts and recomputes the labels in one UPDATE.
+        """
+        votes = {
+            vote_column: getattr(DBPictureMetadata, vote_column) + (delta or 0)
+            for vote_column, delta in updates.dict().items()
+        }
         statement = (
             update(DBPictureMetadata)
             .where(DBPictureMetadata.id == metadata_id)
-            .values(
-                water_in_bowl=updated_water_in_bowl,
-                food_in_bowl=updated_food_in_bowl,
-                cat_at_bowl=updated_cat_at_bowl,
-                human_cat_yes=updated_human_cat_yes,
-                human_water_yes=updated_human_water_yes,
-                human_food_yes=updated_human_food_yes,
-                human_cat_no=updated_human_cat_no,
-                human_water_no=updated_human_water_no,
-                human_food_no=updated_human_food_no,
+            .values(**self._vote_values(votes))
+            .returning(DBPictureMetadata)
+            .execution_options(populate_existing=True)
+        )
+        return await self._db.scalar(statement)
+
+    async def annotate_picture(
+        self, picture_id: int, updates: PictureUpdateRequest
+    ) -> Optional[DBPicture]:
+        """
+        Adds votes to a picture's metadata and returns the picture with its updated metadata, in one query: the
+        UPDATE runs in a CTE and the picture is selected joined to the rows it returns.
+        """
+        metadata_table = DBPictureMetadata.__table__
+        votes = {
+            vote_column: metadata_table.c[vote_column] + (delta or 0)
+            for vote_column, delta in updates.dict().items()
+        }
+        updated_metadata = (
+            update(metadata_table)
+            .where(
+                metadata_table.c.id
+                == select(DBPicture.metadata_id)
+                .where(DBPicture.id == picture_id)
+                .scalar_subquery()
             )
+            .values(**self._vote_values(votes))
+            .returning(*metadata_table.c)
+            .cte("updated_metadata")
         )
-        await self._db.execute(statement=statement)
-        return metadata
+        # The statement can't see the CTE's changes in the metadata table itself, so the relationship has to be
+        # filled from the CTE rather than by its usual joined load
+        updated = aliased(DBPictureMetadata, updated_metadata)
+        statement = (
+            select(DBPicture)
+            .join(DBPicture.picture_metadata.of_type(updated))
+            .options(contains_eager(DBPicture.picture_metadata.of_type(updated)))
+            .execution_options(populate_existing=True)
+        )
+        return await self._db.scalar(statement)
+
+    async def update_metadata_batch(
+        self, updates: list[tuple[int, PictureUpdateRequest]]
+    ) -> set[int]:
+        """
+        Applies votes for many pictures with one UPDATE joined against the unnested vote arrays, and returns the
+        ids of the pictures that were found. Votes for the same picture are summed first, as an UPDATE ... FROM
+        only applies one joined row to each target row. Each column is bound as one array, so a batch of any size
+        stays well under the bind parameter limit of a single statement.
+        """
+        vote_columns = list(PictureUpdateRequest.__fields__)
+        summed_votes: dict[int, dict[str, int]] = {}
+        for picture_id, update_request in updates:
+            picture_votes = summed_votes.setdefault(
+                picture_id, dict.fromkeys(vote_columns, 0)
+            )
+            for vote_column, delta in update_request.dict().items():
+                picture_votes[vote_column] += delta or 0
+        batch = (
+            func.unnest(
+                sql_cast(bindparam("picture_ids", list(summed_votes)), ARRAY(Integer)),
+                *[
+                    sql_cast(
+                        bindparam(
+                            f"{vote_column}_votes",
+                            [
+                                picture_votes[vote_column]
+                                for picture_votes in summed_votes.values()
+                            ],
+                        ),
+                        ARRAY(Integer),
+                    )
+                    for vote_column in vote_columns
+                ],
+            )
+            .table_valued(
+                column("picture_id", Integer),
+                *[column(vote_column, Integer) for vote_column in vote_columns],
+            )
+            .render_derived(name="batch")
+        )
+        # Core tables rather than ORM entities, as an ORM UPDATE can't return columns of the joined pictures table
+        metadata_table = DBPictureMetadata.__table__
+        pictures_table = DBPicture.__table__
+        votes = {
+            vote_column: metadata_table.c[vote_column] + batch.c[vote_column]
+            for vote_column in vote_columns
+        }
+        statement = (
+            update(metadata_table)
+            .where(
+                metadata_table.c.id == pictures_table.c.metadata_id,
+                pictures_table.c.id == batch.c.picture_id,
+            )
+            .values(**self._vote_values(votes))
+            .returning(pictures_table.c.id)
+        )
+        return set(await self._db.scalars(statement))
 
     def _get_annotation_type(
         self, picture_type: PictureType, picture_class: Optional[bool]
@@ -199,9 +408,23 @@ class PictureService:
                 else DBPictureMetadata.human_cat_no
             )
 
-    async def get_annotated_pictures(
-        self, limit: int, picture_type: PictureType, picture_class: bool
-    ) -> list[DBPicture]:
+    async def get_dataset_version(self) -> Optional[datetime]:
+        """
+        The latest metadata change, which moves whenever a picture is added or annotated and so identifies the
+        state that any dataset export is built from.
+        """
+        statement = select(
+            func.max(DBPictureMetadata.updated_at)  # pylint: disable=not-callable
+        )
+        return await self._db.scalar(statement)
+
+    def _annotated_pictures_statement(
+        self,
+        limit: int,
+        picture_type: PictureType,
+        picture_class: bool,
+        seed: Optional[int] = None,
+    ) -> Select:
         if limit < 0:
             limit = None
         if picture_type == PictureType.WATER_BOWL:
@@ -213,22 +436,39 @@ class PictureService:
         metadata_annotation_type = self._get_annotation_type(
             picture_type=picture_type, picture_class=picture_class
         )
-        if picture_class is True:
-            statement = (
-                select(DBPicture)
-                .join(DBPicture.picture_metadata)
-                .filter(and_(metadata_type == true(), metadata_annotation_type > 0))
-                .order_by(func.random())  # pylint: disable=not-callable
-                .limit(limit)
+        # A seed gives a repeatable shuffle, so the same request returns the same sample while the data is unchanged
+        ordering = (
+            func.random()  # pylint: disable=not-callable
+            if seed is None
+            else func.md5(
+                func.concat(DBPicture.id, ":", seed)  # pylint: disable=not-callable
             )
-        else:
-            statement = (
-                select(DBPicture)
-                .join(DBPicture.picture_metadata)
-                .filter(and_(metadata_type == false(), metadata_annotation_type > 0))
-                .order_by(func.random())  # pylint: disable=not-callable
-                .limit(limit)
+        )
+        return (
+            select(DBPicture)
+            .join(DBPicture.picture_metadata)
+            .filter(
+                annotated_as(
+                    metadata_type, metadata_annotation_type, picture_class is True
+                )
             )
+            .order_by(ordering)
+            .limit(limit)
+        )
+
+    async def get_annotated_pictures(
+        self,
+        limit: int,
+        picture_type: PictureType,
+        picture_class: bool,
+        seed: Optional[int] = None,
+    ) -> list[DBPicture]:
+        statement = self._annotated_pictures_statement(
+            limit=limit,
+            picture_type=picture_type,
+            picture_class=picture_class,
+            seed=seed,
+        )
         result: Result = await self._db.execute(statement)
         if pictures := result.fetchall():
             pictures = [picture[0] for picture in pictures]
@@ -1,18 +1,131 @@
-from enums import POSTGRES_ADDRESS, POSTGRES_DATABASE, POSTGRES_PASSWORD, POSTGRES_USER
+from time import perf_counter
+
+from enums import (
+    POSTGRES_ADDRESS,
+    POSTGRES_DATABASE,
+    POSTGRES_MAX_OVERFLOW,
+    POSTGRES_PASSWORD,
+    POSTGRES_POOL_PRE_PING,
+    POSTGRES_POOL_RECYCLE,
+    POSTGRES_POOL_SIZE,
+    POSTGRES_POOL_TIMEOUT,
+    POSTGRES_STATEMENT_CACHE_SIZE,
+    POSTGRES_USER,
+)
+from metrics import (
+    DB_POOL_CHECKED_IN,
+    DB_POOL_CHECKED_OUT,
+    DB_POOL_OVERFLOW,
+    DB_POOL_TIMEOUTS,
+    DB_POOL_WAIT_SECONDS,
+    DB_QUERY_SECONDS,
+)
+from sqlalchemy import event, exc, inspect, text
+from sqlalchemy.engine import Connection
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-database_url = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_ADDRESS}/{POSTGRES_DATABASE}"
-
-engine = create_async_engine(database_url).execution_options(
-    isolation_level="AUTOCOMMIT"
+database_url = (
+    f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_ADDRESS}/{POSTGRES_DATABASE}"
+    f"?prepared_statement_cache_size={POSTGRES_STATEMENT_CACHE_SIZE}"
 )
 
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """
+    Queue pool that records how long each checkout waits for a connection and how often it gives up.
+    """
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            DB_POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            DB_POOL_WAIT_SECONDS.observe(perf_counter() - start)
+
+
+engine = create_async_engine(
+    database_url,
+    poolclass=InstrumentedPool,
+    pool_size=POSTGRES_POOL_SIZE,
+    max_overflow=POSTGRES_MAX_OVERFLOW,
+    pool_timeout=POSTGRES_POOL_TIMEOUT,
+    pool_recycle=POSTGRES_POOL_RECYCLE,
+    pool_pre_ping=POSTGRES_POOL_PRE_PING,
+).execution_options(isolation_level="AUTOCOMMIT")
+
+# Read from the pool at scrape time, so the gauges can't drift from its real state
+DB_POOL_CHECKED_OUT.set_function(engine.pool.checkedout)
+DB_POOL_CHECKED_IN.set_function(engine.pool.checkedin)
+DB_POOL_OVERFLOW.set_function(lambda: max(engine.pool.overflow(), 0))
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_times", []).append(perf_counter())
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _observe_query_time(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info["query_start_times"].pop()
+    keyword = statement.lstrip().split(maxsplit=1)[0].upper() if statement else ""
+    DB_QUERY_SECONDS.labels(keyword).observe(perf_counter() - start)
+
+
+@event.listens_for(engine.sync_engine, "handle_error")
+def _discard_query_timer(exception_context):
+    if exception_context.connection is not None:
+        start_times = exception_context.connection.info.get("query_start_times")
+        if start_times:
+            start_times.pop()
+
+
 AsyncSessionLocal = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
 Base = declarative_base()
 
 
+def upgrade_schema(connection: Connection) -> None:
+    """
+    create_all only creates missing tables, so add any columns and indexes declared after a table was first
+    created. New columns need a server default (or be nullable) to be added to a table that already has rows.
+    """
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_columns = {
+            column["name"] for column in inspector.get_columns(table.name)
+        }
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            default = ""
+            if column.server_default is not None:
+                default_value = column.server_default.arg
+                default = (
+                    f" DEFAULT '{default_value}'"
+                    if isinstance(default_value, str)
+                    else f" DEFAULT {default_value.compile(dialect=connection.dialect)}"
+                )
+            connection.execute(
+                text(
+                    f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}{default}'
+                )
+            )
+        existing_indexes = {
+            index["name"] for index in inspector.get_indexes(table.name)
+        }
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(connection)
+
+
 async def get_db():
     db = AsyncSessionLocal()
     try:
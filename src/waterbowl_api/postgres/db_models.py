@@ -1,13 +1,76 @@
-from enums import PICTURES_MODELING_DATA, PICTURES_TABLE
+from enums import PICTURE_PACKS_TABLE, PICTURES_MODELING_DATA, PICTURES_TABLE
 from models import PictureMetadata
 from postgres.database import Base
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Identity, Integer, String
+from sqlalchemy import (
+    ARRAY,
+    BigInteger,
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Identity,
+    Index,
+    Integer,
+    String,
+    and_,
+    any_,
+    false,
+    func,
+    literal,
+    or_,
+    true,
+)
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql.elements import ColumnElement
+
+
+def unannotated(human_yes: Column, human_no: Column) -> ColumnElement:
+    return and_(human_yes == 0, human_no == 0)
+
+
+def human_annotated(human_yes: Column, human_no: Column) -> ColumnElement:
+    return or_(human_yes > 0, human_no > 0)
+
+
+def annotated_as(label: Column, human_votes: Column, value: bool) -> ColumnElement:
+    return and_(label == (true() if value else false()), human_votes > 0)
+
+
+def annotation_indexes(
+    name: str, label: Column, human_yes: Column, human_no: Column
+) -> list[Index]:
+    """
+    Partial indexes over the metadata ids matching each annotation filter the API runs. Queries must build their
+    filters with the same predicate functions, as Postgres only uses a partial index when it can prove the query's
+    WHERE clause implies the index predicate.
+    """
+    index_prefix = f"ix_{PICTURES_MODELING_DATA}_{name}"
+    return [
+        Index(
+            f"{index_prefix}_unannotated",
+            "id",
+            postgresql_where=unannotated(human_yes, human_no),
+        ),
+        Index(
+            f"{index_prefix}_annotated",
+            "id",
+            postgresql_where=human_annotated(human_yes, human_no),
+        ),
+        Index(
+            f"{index_prefix}_yes",
+            "id",
+            postgresql_where=annotated_as(label, human_yes, True),
+        ),
+        Index(
+            f"{index_prefix}_no",
+            "id",
+            postgresql_where=annotated_as(label, human_no, False),
+        ),
+    ]
 
 
 class DBPictureMetadata(Base):
     __tablename__ = PICTURES_MODELING_DATA
-    __table_args__ = {"keep_existing": True}
     __mapper_args__ = {"eager_defaults": True}
 
     id = Column(Integer, Identity(start=1, cycle=True), primary_key=True, index=True)
@@ -20,6 +83,20 @@ class DBPictureMetadata(Base):
     human_cat_no = Column(Integer, default=0)
     human_water_no = Column(Integer, default=0)
     human_food_no = Column(Integer, default=0)
+    # clock_timestamp() rather than now() so updates inside one transaction still move it forward
+    updated_at = Column(
+        DateTime,
+        server_default=func.clock_timestamp(),  # pylint: disable=not-callable
+        onupdate=func.clock_timestamp(),  # pylint: disable=not-callable
+        index=True,
+    )
+
+    __table_args__ = (
+        *annotation_indexes("water", water_in_bowl, human_water_yes, human_water_no),
+        *annotation_indexes("food", food_in_bowl, human_food_yes, human_food_no),
+        *annotation_indexes("cat", cat_at_bowl, human_cat_yes, human_cat_no),
+        {"keep_existing": True},
+    )
 
     def __eq__(self, other):
         """Overrides the default implementation"""
@@ -51,7 +128,9 @@ class DBPicture(Base):
     __mapper_args__ = {"eager_defaults": True}
 
     id = Column(Integer, Identity(start=1, cycle=True), primary_key=True, index=True)
-    metadata_id = Column(Integer, ForeignKey(f"{PICTURES_MODELING_DATA}.id"))
+    metadata_id = Column(
+        Integer, ForeignKey(f"{PICTURES_MODELING_DATA}.id"), index=True
+    )
     waterbowl_picture = Column(String)
     food_picture = Column(String)
     picture_timestamp = Column(DateTime)
@@ -60,6 +139,17 @@ class DBPicture(Base):
         "DBPictureMetadata", foreign_keys=[metadata_id], lazy="joined"
     )
 
+    @classmethod
+    def at_any_of(cls, locations: list[str]) -> ColumnElement:
+        """
+        Matches the pictures with either crop at one of `locations`, which are sent as a single array parameter
+        however many there are.
+        """
+        any_location = any_(literal(locations, ARRAY(String)))
+        return or_(
+            cls.waterbowl_picture == any_location, cls.food_picture == any_location
+        )
+
     def __eq__(self, other):
         """Overrides the default implementation"""
         if isinstance(other, DBPicture):
@@ -79,3 +169,23 @@ class DBPicture(Base):
         else:
             base_dict.update({"picture_metadata": self.picture_metadata.to_dict()})
         return base_dict
+
+
+class DBPicturePack(Base):
+    """
+    A pack file holding the crops of older annotated pictures back to back. Packed pictures are located by
+    pack id, offset and length, all kept in their picture row, so reading one needs no lookup here.
+    """
+
+    __tablename__ = PICTURE_PACKS_TABLE
+    __table_args__ = {"keep_existing": True}
+    __mapper_args__ = {"eager_defaults": True}
+
+    id = Column(Integer, Identity(start=1), primary_key=True)
+    size = Column(BigInteger, default=0)
+    picture_count = Column(Integer, default=0)
+    # Original crops still to be removed once the pack's pictures point at it, finished by the next run if one stops
+    pending_deletions = Column(ARRAY(String), nullable=True)
+    created_at = Column(
+        DateTime, server_default=func.now()  # pylint: disable=not-callable
+    )
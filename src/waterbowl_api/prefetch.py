@@ -0,0 +1,125 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Optional
+
+from enums import (
+    PICTURE_REDIRECTS,
+    PREFETCH_QUEUE_SIZE,
+    PREFETCH_RECENTLY_SERVED,
+    PictureRetrieveLimits,
+)
+from image_cache import image_cache
+from picture_service import PictureService
+from sqlalchemy.ext.asyncio import AsyncSession
+from storage import picture_storage
+
+logger = logging.getLogger(__name__)
+
+
+class UnannotatedPictureQueue:
+    """
+    In-process queue of unannotated pictures ready to hand to the labeling UI.
+
+    Serving a picture pops the next candidate from memory. The queue is refilled in batches, skipping pictures
+    that are already queued or were recently served, so two labelers are unlikely to be shown the same picture.
+    Annotating a picture through this process invalidates its queued entry. Annotations made by other replicas
+    are only picked up on the next refill, so a queued picture can occasionally be served after it was labelled.
+    """
+
+    def __init__(self, size: int, recently_served_size: int):
+        self._size = max(size, 0)
+        self._candidates: deque[dict[str, Any]] = deque()
+        self._queued_ids: set[int] = set()
+        self._recently_served: deque[int] = deque(maxlen=max(recently_served_size, 0))
+        self._refill_lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._size > 0
+
+    @property
+    def needs_refill(self) -> bool:
+        return len(self._queued_ids) <= self._size // 2
+
+    def __len__(self) -> int:
+        return len(self._queued_ids)
+
+    def clear(self) -> None:
+        self._candidates.clear()
+        self._queued_ids.clear()
+        self._recently_served.clear()
+
+    def discard(self, picture_id: int) -> None:
+        # Left in the deque and skipped when popped, to keep invalidation O(1)
+        self._queued_ids.discard(picture_id)
+
+    def pop(self) -> Optional[dict[str, Any]]:
+        while self._candidates:
+            candidate = self._candidates.popleft()
+            if candidate["id"] in self._queued_ids:
+                self._queued_ids.remove(candidate["id"])
+                self._recently_served.append(candidate["id"])
+                return candidate
+        return None
+
+    async def refill(self, db: AsyncSession) -> None:
+        if self._refill_lock.locked():
+            return
+        async with self._refill_lock:
+            missing = self._size - len(self._queued_ids)
+            if missing <= 0:
+                return
+            pictures = await PictureService(db=db).get_random_pictures(
+                count=missing,
+                limit=PictureRetrieveLimits.NO_ANNOTATION,
+                exclude_ids={*self._queued_ids, *self._recently_served},
+            )
+            for picture in pictures:
+                if picture.id not in self._queued_ids:
+                    self._queued_ids.add(picture.id)
+                    self._candidates.append(picture.to_dict())
+            logger.debug(
+                "Queued %s unannotated pictures, %s ready", len(pictures), len(self)
+            )
+
+    async def next(self, db: AsyncSession) -> Optional[dict[str, Any]]:
+        """
+        Pops the next candidate, refilling first with the caller's session if the queue has run dry.
+        """
+        if candidate := self.pop():
+            return candidate
+        async with self._refill_lock:
+            # Wait for any refill already in flight before deciding we need our own
+            pass
+        if not self._queued_ids:
+            await self.refill(db)
+        return self.pop()
+
+    async def warm_images(self) -> None:
+        """
+        Reads the crops of every queued candidate into the image cache, so they are served from memory. Skipped
+        when clients are redirected to download pictures from storage themselves.
+        """
+        if PICTURE_REDIRECTS and picture_storage.presigns_urls:
+            return
+        await image_cache.warm(
+            path
+            for candidate in list(self._candidates)
+            if candidate["id"] in self._queued_ids
+            for path in [candidate["waterbowl_picture"], candidate["food_picture"]]
+        )
+
+    async def top_up(self, db: AsyncSession) -> None:
+        """
+        Meant to run after a response has been sent: refills the queue if it is half empty, then warms the
+        image cache for whatever is queued.
+        """
+        if self.needs_refill:
+            await self.refill(db)
+        await self.warm_images()
+
+
+unannotated_picture_queue = UnannotatedPictureQueue(
+    size=PREFETCH_QUEUE_SIZE, recently_served_size=PREFETCH_RECENTLY_SERVED
+)
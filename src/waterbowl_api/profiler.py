@@ -0,0 +1,121 @@
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from enums import PROFILES_DIR, PROFILES_MAX_COUNT
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SUFFIX = ".folded"
+
+
+class StackSampler:
+    """
+    Samples the stack of every other thread at a fixed interval from a background thread, and counts the samples
+    per stack in the folded format flamegraph.pl and speedscope read: one `thread;outer;...;inner count` line per
+    distinct stack.
+
+    The event loop thread runs whatever task is ready, so samples taken while a profiled request is awaiting will
+    show other requests' work. Image worker threads are sampled too, so time spent cropping shows up.
+    """
+
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._samples: Counter[str] = Counter()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _folded_stack(thread_name: str, frame) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            )
+            frame = frame.f_back
+        stack.append(thread_name)
+        return ";".join(reversed(stack))
+
+    def _sample(self) -> None:
+        own_id = threading.get_ident()
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        while not self._stopped.wait(self._interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                thread_name = thread_names.get(thread_id)
+                if thread_name is None:
+                    thread_names = {
+                        thread.ident: thread.name for thread in threading.enumerate()
+                    }
+                    thread_name = thread_names.get(thread_id, str(thread_id))
+                self._samples[self._folded_stack(thread_name, frame)] += 1
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._sample, name="stack-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> str:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self._samples.most_common()
+        )
+
+
+class ProfileStore:
+    """
+    Keeps the most recent `max_profiles` profiles in `profiles_dir`, deleting the oldest as new ones are saved.
+    """
+
+    def __init__(self, profiles_dir: Path, max_profiles: int):
+        self._profiles_dir = profiles_dir
+        self._max_profiles = max_profiles
+
+    def save(self, name: str, folded_stacks: str) -> Path:
+        self._profiles_dir.mkdir(parents=True, exist_ok=True)
+        profile = self._profiles_dir.joinpath(f"{name}{PROFILE_SUFFIX}")
+        profile.write_text(folded_stacks)
+        for old_profile in self.list()[self._max_profiles :]:
+            logger.debug("Removing old profile %s", old_profile.name)
+            old_profile.unlink(missing_ok=True)
+        return profile
+
+    def list(self) -> list[Path]:
+        """
+        Saved profiles, newest first.
+        """
+        if not self._profiles_dir.exists():
+            return []
+        return sorted(
+            self._profiles_dir.glob(f"*{PROFILE_SUFFIX}"),
+            key=lambda profile: profile.name,
+            reverse=True,
+        )
+
+    def get(self, name: str) -> Optional[Path]:
+        # Only ever hand out files the store itself lists, so a name can't point outside the profiles directory
+        for profile in self.list():
+            if profile.name == name:
+                return profile
+        return None
+
+    @staticmethod
+    def make_name(method: str, path: str, duration: float) -> str:
+        timestamp = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        route = "".join(
+            character if character.isalnum() else "_" for character in path.strip("/")
+        )
+        return f"{timestamp}_{method}_{route or 'root'}_{int(duration * 1000)}ms"
+
+
+profile_store = ProfileStore(profiles_dir=PROFILES_DIR, max_profiles=PROFILES_MAX_COUNT)
@@ -0,0 +1,186 @@
+import random
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from enums import (
+    PICTURE_SAMPLING_STRATEGY,
+    PICTURE_TABLESAMPLE_PERCENT,
+    PictureSamplingStrategy,
+)
+from postgres.db_models import DBPicture
+from sqlalchemy import Integer, Select, cast, inspect, select, tablesample, true
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.elements import ColumnElement
+from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.util import ClauseAdapter
+
+
+class PictureSampler(ABC):
+    """
+    Picks one random picture whose metadata matches `criteria`, or any picture when there is no criteria.
+    """
+
+    @staticmethod
+    def _filtered(
+        picture=DBPicture, criteria: Optional[ColumnElement] = None
+    ) -> Select:
+        statement = select(picture)
+        if criteria is not None:
+            if picture is not DBPicture:
+                # Criteria are written against DBPicture, so point any picture columns in them at the alias
+                criteria = ClauseAdapter(inspect(picture).selectable).traverse(criteria)
+            statement = statement.join(picture.picture_metadata).filter(criteria)
+        return statement
+
+    @abstractmethod
+    async def sample(
+        self, db: AsyncSession, criteria: Optional[ColumnElement] = None
+    ) -> Optional[DBPicture]:
+        pass
+
+    async def sample_many(
+        self, db: AsyncSession, count: int, criteria: Optional[ColumnElement] = None
+    ) -> list[DBPicture]:
+        """
+        Up to `count` distinct random pictures matching `criteria`.
+        """
+        pictures: dict[int, DBPicture] = {}
+        for _ in range(count):
+            if picture := await self.sample(db, criteria=criteria):
+                pictures[picture.id] = picture
+        return list(pictures.values())
+
+
+class RandomOrderSampler(PictureSampler):
+    """
+    Uniform, but sorts every matching row on each call, so it gets slower as the table grows.
+    """
+
+    async def sample(
+        self, db: AsyncSession, criteria: Optional[ColumnElement] = None
+    ) -> Optional[DBPicture]:
+        statement = (
+            self._filtered(criteria=criteria)
+            .order_by(func.random())  # pylint: disable=not-callable
+            .limit(1)
+        )
+        return await db.scalar(statement)
+
+    async def sample_many(
+        self, db: AsyncSession, count: int, criteria: Optional[ColumnElement] = None
+    ) -> list[DBPicture]:
+        statement = (
+            self._filtered(criteria=criteria)
+            .order_by(func.random())  # pylint: disable=not-callable
+            .limit(count)
+        )
+        return list(await db.scalars(statement))
+
+
+class IdProbeSampler(PictureSampler):
+    """
+    Picks a random id between the smallest and largest picture id and walks the primary key index to the first
+    match at or after it, wrapping around to the first match overall when the probe lands past the last one.
+    Each probe reads a handful of index entries instead of the whole table. Pictures that follow a long run of
+    non-matching ids are somewhat more likely to be picked, which is fine for choosing what to label next.
+    """
+
+    @staticmethod
+    def _probe_id():
+        min_id = select(
+            func.min(DBPicture.id)  # pylint: disable=not-callable
+        ).scalar_subquery()
+        max_id = select(
+            func.max(DBPicture.id)  # pylint: disable=not-callable
+        ).scalar_subquery()
+        # The cast keeps comparisons against the probe integer ones that the primary key index can serve
+        return cast(
+            min_id
+            + func.floor(
+                func.random() * (max_id - min_id + 1)  # pylint: disable=not-callable
+            ),
+            Integer,
+        )
+
+    async def sample(
+        self, db: AsyncSession, criteria: Optional[ColumnElement] = None
+    ) -> Optional[DBPicture]:
+        # An uncorrelated subquery, so Postgres draws the random id once rather than once per row
+        probe_id = select(self._probe_id()).scalar_subquery()
+        statement = self._filtered(criteria=criteria).order_by(DBPicture.id).limit(1)
+        if picture := await db.scalar(statement.where(DBPicture.id >= probe_id)):
+            return picture
+        return await db.scalar(statement)
+
+    async def sample_many(
+        self, db: AsyncSession, count: int, criteria: Optional[ColumnElement] = None
+    ) -> list[DBPicture]:
+        """
+        Runs `count` probes in one round trip: each generated probe id drives a LATERAL index walk to the next
+        match. Probes that land past the last match or on an already picked picture are dropped, so fewer than
+        `count` pictures may come back. If every probe misses, a single wrapping probe is made as in `sample`, so
+        a picture is always returned while any match exists.
+        """
+        probes = (
+            select(self._probe_id().label("probe_id"))
+            .select_from(func.generate_series(1, count))
+            .subquery("probes")
+        )
+        candidate = (
+            self._filtered(criteria=criteria)
+            .with_only_columns(DBPicture.id)
+            .where(DBPicture.id >= probes.c.probe_id)
+            .order_by(DBPicture.id)
+            .limit(1)
+            .lateral("candidate")
+        )
+        candidate_ids = (
+            select(candidate.c.id).select_from(probes).join(candidate, true())
+        )
+        statement = select(DBPicture).where(DBPicture.id.in_(candidate_ids))
+        pictures = list(await db.scalars(statement))
+        if not pictures:
+            picture = await self.sample(db, criteria=criteria)
+            return [picture] if picture else []
+        random.shuffle(pictures)
+        return pictures
+
+
+class TablesampleSampler(PictureSampler):
+    """
+    Reads a random `percent` of the picture table's pages with TABLESAMPLE SYSTEM and picks one matching row
+    from those. When the sample holds no match, which is likely for rare filters or tiny tables, it falls back
+    to an id probe.
+    """
+
+    def __init__(self, percent: float):
+        self._percent = percent
+        self._fallback = IdProbeSampler()
+
+    async def sample(
+        self, db: AsyncSession, criteria: Optional[ColumnElement] = None
+    ) -> Optional[DBPicture]:
+        sampled_picture = aliased(
+            DBPicture,
+            tablesample(DBPicture, func.system(self._percent)),
+        )
+        statement = (
+            self._filtered(picture=sampled_picture, criteria=criteria)
+            .order_by(func.random())  # pylint: disable=not-callable
+            .limit(1)
+        )
+        if picture := await db.scalar(statement):
+            return picture
+        return await self._fallback.sample(db, criteria=criteria)
+
+
+def get_picture_sampler(
+    strategy: PictureSamplingStrategy = PICTURE_SAMPLING_STRATEGY,
+) -> PictureSampler:
+    strategy = PictureSamplingStrategy(strategy)
+    if strategy == PictureSamplingStrategy.RANDOM_ORDER:
+        return RandomOrderSampler()
+    if strategy == PictureSamplingStrategy.TABLESAMPLE:
+        return TablesampleSampler(percent=PICTURE_TABLESAMPLE_PERCENT)
+    return IdProbeSampler()
@@ -0,0 +1,616 @@
+import errno
+import io
+import logging
+import mmap
+import os
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from functools import cache
+from io import BytesIO
+from pathlib import Path
+from time import perf_counter
+from typing import BinaryIO, Collection, Iterator, Optional
+from urllib.parse import urlsplit
+from uuid import uuid4
+
+from enums import (
+    PICTURE_FSYNC,
+    PICTURE_STORAGE,
+    PICTURE_STORAGE_LAYOUT,
+    PICTURES_DIR,
+    S3_BUCKET,
+    S3_ENDPOINT_URL,
+    S3_MAX_CONNECTIONS,
+    S3_MULTIPART_THRESHOLD,
+    S3_PREFIX,
+    S3_PRESIGNED_URL_SECONDS,
+    S3_REGION,
+    PictureStorageLayout,
+    PictureStorageType,
+)
+from metrics import PICTURE_WRITE_SECONDS
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class PictureInfo:
+    size: int
+    last_modified: float
+
+
+@dataclass(frozen=True)
+class PictureFileRange:
+    """
+    The bytes of a picture on the local disk: `size` bytes of `path` from `offset`.
+    """
+
+    path: Path
+    offset: int
+    size: int
+    last_modified: float
+
+
+@dataclass(frozen=True)
+class PackedLocation:
+    """
+    Where a picture sits inside a pack file, written out as pack:<pack id>/<offset>/<length>/<filename> so the
+    picture row alone is enough to read it, and Path(location).name is still the original filename.
+    """
+
+    pack_id: int
+    offset: int
+    length: int
+    filename: str
+
+    PREFIX = "pack:"
+
+    def __str__(self) -> str:
+        return (
+            f"{self.PREFIX}{self.pack_id}/{self.offset}/{self.length}/{self.filename}"
+        )
+
+    @classmethod
+    def parse(cls, location: str) -> Optional["PackedLocation"]:
+        if not location.startswith(cls.PREFIX):
+            return None
+        pack_id, offset, length, filename = location.removeprefix(cls.PREFIX).split(
+            "/", 3
+        )
+        return cls(
+            pack_id=int(pack_id),
+            offset=int(offset),
+            length=int(length),
+            filename=filename,
+        )
+
+
+class _PackedPictureReader(io.RawIOBase):
+    """
+    Reads one picture out of a memory mapped pack without copying the rest of the pack.
+    """
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._view[self._position : self._position + len(buffer)]
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def readall(self) -> bytes:
+        data = bytes(self._view[self._position :])
+        self._position = len(self._view)
+        return data
+
+    def close(self) -> None:
+        self._view.release()
+        super().close()
+
+
+class PackWriter:
+    """
+    Appends pictures to a new pack file. Nothing is visible under the pack's final name until `seal` has flushed
+    it to disk, and `discard` removes an unsealed pack.
+    """
+
+    def __init__(self, partial_path: Path):
+        partial_path.parent.mkdir(parents=True, exist_ok=True)
+        self._partial_path = partial_path
+        self._pack_file = open(partial_path, "wb")
+
+    @property
+    def size(self) -> int:
+        return self._pack_file.tell()
+
+    def append(self, location: str) -> tuple[int, int]:
+        """
+        Copies the picture at `location` to the end of the pack and returns its offset and length.
+        """
+        offset = self.size
+        with open(location, "rb") as picture_file:
+            shutil.copyfileobj(picture_file, self._pack_file)
+        return offset, self.size - offset
+
+    def truncate(self, size: int) -> None:
+        self._pack_file.seek(size)
+        self._pack_file.truncate()
+
+    def seal(self, pack_path: Path) -> None:
+        self._pack_file.flush()
+        os.fsync(self._pack_file.fileno())
+        self._pack_file.close()
+        self._partial_path.replace(pack_path)
+        LocalPictureStorage._sync(pack_path.parent)
+
+    def discard(self) -> None:
+        self._pack_file.close()
+        self._partial_path.unlink(missing_ok=True)
+
+
+class PictureStorage(ABC):
+    """
+    Where cropped pictures are kept. A picture is addressed by its location, the string stored in the picture
+    table, and the layout decides where a new picture goes: flat keeps every crop side by side, sharded files
+    them under the hour the picture was taken (YYYY/MM/DD/HH) so no directory grows past a few hundred entries.
+
+    Backends implement blocking calls; the async methods run them in a worker thread, one hop per call.
+    """
+
+    presigns_urls = False
+
+    def __init__(self, layout: PictureStorageLayout = PictureStorageLayout.SHARDED):
+        self._layout = PictureStorageLayout(layout)
+
+    @property
+    def layout(self) -> PictureStorageLayout:
+        return self._layout
+
+    def picture_key(self, filename: str, taken_at: datetime) -> str:
+        if self._layout == PictureStorageLayout.SHARDED:
+            return f"{taken_at:%Y/%m/%d/%H}/{filename}"
+        return filename
+
+    def location(self, filename: str, taken_at: datetime) -> str:
+        return self._location(self.picture_key(filename, taken_at))
+
+    @abstractmethod
+    def _location(self, key: str) -> str:
+        pass
+
+    @abstractmethod
+    def _write_pictures(self, pictures: dict[str, bytes]) -> None:
+        """
+        Saves every `location: data` pair, or none of them if any write fails.
+        """
+
+    @abstractmethod
+    def _delete_pictures(self, locations: Collection[str]) -> None:
+        pass
+
+    @abstractmethod
+    def picture_exists(self, location: str) -> bool:
+        pass
+
+    @abstractmethod
+    def open_picture(self, location: str) -> Iterator[tuple[BinaryIO, PictureInfo]]:
+        """
+        Context manager that opens a picture for reading. Raises FileNotFoundError if there is no such picture.
+        """
+
+    def read_picture(self, location: str) -> tuple[bytes, PictureInfo]:
+        with self.open_picture(location) as (picture_file, picture_info):
+            return picture_file.read(), picture_info
+
+    def existing_picture_set(self, locations: Collection[str]) -> set[str]:
+        return {location for location in locations if self.picture_exists(location)}
+
+    def read_order(self, location: str) -> tuple[str, int]:
+        """
+        Sort key that visits pictures in the order they are laid out, for reading many of them in a row.
+        """
+        return location, 0
+
+    def picture_file_range(self, location: str) -> Optional[PictureFileRange]:
+        """
+        Where the picture's bytes sit on the local disk, for backends that keep them there, so they can be sent
+        straight from the file. Raises FileNotFoundError if there is no such picture.
+        """
+        return None
+
+    def presigned_url(self, location: str) -> Optional[str]:
+        """
+        A short lived URL clients can download the picture from directly, for backends that offer one.
+        """
+        return None
+
+    async def write_pictures(
+        self, pictures: dict[str, bytes], taken_at: datetime
+    ) -> dict[str, str]:
+        """
+        Writes each `filename: data` pair and returns the saved locations by filename.
+        """
+        locations = {
+            filename: self.location(filename, taken_at) for filename in pictures
+        }
+        await run_in_threadpool(
+            self._write_pictures,
+            {locations[filename]: data for filename, data in pictures.items()},
+        )
+        return locations
+
+    async def delete_pictures(self, *locations: str) -> None:
+        await run_in_threadpool(self._delete_pictures, locations)
+
+    async def read(self, location: str) -> tuple[bytes, PictureInfo]:
+        return await run_in_threadpool(self.read_picture, location)
+
+    async def existing_pictures(self, locations: Collection[str]) -> set[str]:
+        return await run_in_threadpool(self.existing_picture_set, locations)
+
+    async def file_range(self, location: str) -> Optional[PictureFileRange]:
+        return await run_in_threadpool(self.picture_file_range, location)
+
+
+class LocalPictureStorage(PictureStorage):
+    """
+    Keeps pictures under `pictures_dir`. Each file is written to a temporary name and renamed into place, so
+    readers never see a partial picture. With `fsync`, the files from one write are flushed together and each
+    directory is synced once, rather than once per file, before any of them is reported saved.
+
+    Any path is readable, so pictures saved under an older layout keep working until they are migrated. Pictures
+    compacted into pack files under packs/ are read through a memory map of their pack, shared by every reader.
+    """
+
+    def __init__(
+        self,
+        pictures_dir: Path,
+        fsync: bool = False,
+        layout: PictureStorageLayout = PictureStorageLayout.SHARDED,
+    ):
+        super().__init__(layout=layout)
+        self._pictures_dir = pictures_dir
+        self._fsync = fsync
+        self._pack_maps: dict[Path, mmap.mmap] = {}
+        self._pack_maps_lock = threading.Lock()
+
+    @property
+    def pictures_dir(self) -> Path:
+        return self._pictures_dir
+
+    def _location(self, key: str) -> str:
+        return str(self._pictures_dir.joinpath(key))
+
+    @staticmethod
+    def _sync(path: Path) -> None:
+        descriptor = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+    def _write_pictures(self, pictures: dict[str, bytes]) -> None:
+        start = perf_counter()
+        written: list[tuple[Path, Path]] = []
+        try:
+            for location, data in pictures.items():
+                picture_path = Path(location)
+                partial_path = picture_path.with_name(f".{picture_path.name}.partial")
+                picture_path.parent.mkdir(parents=True, exist_ok=True)
+                written.append((partial_path, picture_path))
+                with open(partial_path, "wb") as picture_file:
+                    picture_file.write(data)
+            PICTURE_WRITE_SECONDS.labels("write").observe(perf_counter() - start)
+            if self._fsync:
+                start = perf_counter()
+                for partial_path, _ in written:
+                    self._sync(partial_path)
+            for partial_path, picture_path in written:
+                partial_path.replace(picture_path)
+            if self._fsync:
+                for directory in {picture_path.parent for _, picture_path in written}:
+                    self._sync(directory)
+                PICTURE_WRITE_SECONDS.labels("fsync").observe(perf_counter() - start)
+        except BaseException:
+            for partial_path, picture_path in written:
+                partial_path.unlink(missing_ok=True)
+                picture_path.unlink(missing_ok=True)
+            raise
+
+    def _delete_pictures(self, locations: Collection[str]) -> None:
+        for location in locations:
+            # A packed picture's bytes stay in its pack, which is never rewritten
+            if PackedLocation.parse(location) is None:
+                Path(location).unlink(missing_ok=True)
+
+    def pack_path(self, pack_id: int) -> Path:
+        return self._pictures_dir.joinpath("packs", f"{pack_id:08d}.pack")
+
+    def create_pack(self) -> PackWriter:
+        return PackWriter(
+            self._pictures_dir.joinpath("packs", f".{uuid4()}.pack.partial")
+        )
+
+    def _pack_map(self, pack_path: Path) -> mmap.mmap:
+        # Packs never change once sealed, so one read only map per pack is shared for the life of the process
+        with self._pack_maps_lock:
+            if (pack_map := self._pack_maps.get(pack_path)) is None:
+                with open(pack_path, "rb") as pack_file:
+                    pack_map = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._pack_maps[pack_path] = pack_map
+            return pack_map
+
+    def picture_exists(self, location: str) -> bool:
+        if packed := PackedLocation.parse(location):
+            try:
+                pack_size = self.pack_path(packed.pack_id).stat().st_size
+            except FileNotFoundError:
+                return False
+            return packed.offset + packed.length <= pack_size
+        return Path(location).exists()
+
+    def read_order(self, location: str) -> tuple[str, int]:
+        if packed := PackedLocation.parse(location):
+            return str(self.pack_path(packed.pack_id)), packed.offset
+        return location, 0
+
+    def picture_file_range(self, location: str) -> PictureFileRange:
+        if packed := PackedLocation.parse(location):
+            pack_path = self.pack_path(packed.pack_id)
+            try:
+                pack_stat = pack_path.stat()
+            except FileNotFoundError as exc:
+                raise FileNotFoundError(location) from exc
+            if packed.offset + packed.length > pack_stat.st_size:
+                raise FileNotFoundError(location)
+            return PictureFileRange(
+                path=pack_path,
+                offset=packed.offset,
+                size=packed.length,
+                last_modified=pack_stat.st_mtime,
+            )
+        picture_stat = os.stat(location)
+        return PictureFileRange(
+            path=Path(location),
+            offset=0,
+            size=picture_stat.st_size,
+            last_modified=picture_stat.st_mtime,
+        )
+
+    @contextmanager
+    def open_picture(self, location: str) -> Iterator[tuple[BinaryIO, PictureInfo]]:
+        if packed := PackedLocation.parse(location):
+            pack_path = self.pack_path(packed.pack_id)
+            try:
+                pack_map = self._pack_map(pack_path)
+            except (FileNotFoundError, ValueError) as exc:
+                raise FileNotFoundError(location) from exc
+            if packed.offset + packed.length > len(pack_map):
+                raise FileNotFoundError(location)
+            # Read the whole picture in ahead of the first access rather than a page fault at a time
+            page_start = packed.offset - packed.offset % mmap.PAGESIZE
+            pack_map.madvise(
+                mmap.MADV_WILLNEED,
+                page_start,
+                packed.offset + packed.length - page_start,
+            )
+            with _PackedPictureReader(
+                memoryview(pack_map)[packed.offset : packed.offset + packed.length]
+            ) as picture_file:
+                yield picture_file, PictureInfo(
+                    size=packed.length, last_modified=pack_path.stat().st_mtime
+                )
+            return
+        with open(location, "rb") as picture_file:
+            picture_stat = os.fstat(picture_file.fileno())
+            yield picture_file, PictureInfo(
+                size=picture_stat.st_size, last_modified=picture_stat.st_mtime
+            )
+
+    def relocate_picture(self, location: str, new_location: str) -> None:
+        """
+        Makes the picture at `location` also available at `new_location`, leaving the original in place until it
+        is deleted. Safe to repeat after an interrupted attempt.
+        """
+        new_path = Path(new_location)
+        new_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(location, new_path)
+        except FileNotFoundError:
+            # Already moved for another picture sharing the same crop
+            if not new_path.exists():
+                raise
+        except FileExistsError:
+            if not os.path.samefile(location, new_path):
+                raise
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+            shutil.copy2(location, new_path)
+        if self._fsync:
+            self._sync(new_path.parent)
+
+
+class S3PictureStorage(PictureStorage):
+    """
+    Keeps pictures in an S3 compatible bucket, such as MinIO, so any number of replicas can share them. Locations
+    are s3://bucket/key URLs.
+
+    One client is shared by every thread, holding up to `max_connections` pooled connections. Uploads larger
+    than `multipart_threshold` are sent in parallel parts. Objects are only visible once fully uploaded, and if
+    one picture of a write fails the ones already uploaded are deleted again.
+    """
+
+    presigns_urls = True
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: Optional[str] = None,
+        region: Optional[str] = None,
+        max_connections: int = 20,
+        multipart_threshold: int = 8 * 1024 * 1024,
+        presigned_url_seconds: int = 300,
+        layout: PictureStorageLayout = PictureStorageLayout.SHARDED,
+    ):
+        # boto3 is only needed by deployments that use this backend
+        # pylint: disable=import-outside-toplevel
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        super().__init__(layout=layout)
+        self._bucket = bucket
+        self._prefix = prefix
+        self._max_connections = max(max_connections, 1)
+        self._presigned_url_seconds = presigned_url_seconds
+        self._client = boto3.session.Session().client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            config=Config(
+                max_pool_connections=self._max_connections,
+                retries={"mode": "standard"},
+            ),
+        )
+        self._transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_threshold,
+            max_concurrency=self._max_connections,
+        )
+
+    def _location(self, key: str) -> str:
+        return f"s3://{self._bucket}/{self._prefix}{key}"
+
+    @staticmethod
+    def _bucket_key(location: str) -> tuple[str, str]:
+        url = urlsplit(location)
+        if url.scheme != "s3" or not url.path.lstrip("/"):
+            # Saved before pictures moved to object storage, so there is nothing to find here
+            raise FileNotFoundError(location)
+        return url.netloc, url.path.lstrip("/")
+
+    def _is_missing(self, exc: Exception) -> bool:
+        return isinstance(exc, self._client.exceptions.ClientError) and exc.response[
+            "Error"
+        ]["Code"] in ("404", "NoSuchKey")
+
+    def _write_pictures(self, pictures: dict[str, bytes]) -> None:
+        start = perf_counter()
+        uploaded: list[str] = []
+        try:
+            for location, data in pictures.items():
+                bucket, key = self._bucket_key(location)
+                self._client.upload_fileobj(
+                    BytesIO(data),
+                    bucket,
+                    key,
+                    ExtraArgs={"ContentType": "image/jpeg"},
+                    Config=self._transfer_config,
+                )
+                uploaded.append(location)
+        except BaseException:
+            self._delete_pictures(uploaded)
+            raise
+        PICTURE_WRITE_SECONDS.labels("write").observe(perf_counter() - start)
+
+    def _delete_pictures(self, locations: Collection[str]) -> None:
+        keys_by_bucket: dict[str, list[str]] = {}
+        for location in locations:
+            try:
+                bucket, key = self._bucket_key(location)
+            except FileNotFoundError:
+                continue
+            keys_by_bucket.setdefault(bucket, []).append(key)
+        for bucket, keys in keys_by_bucket.items():
+            # DeleteObjects takes at most 1000 keys per request
+            for first in range(0, len(keys), 1000):
+                self._client.delete_objects(
+                    Bucket=bucket,
+                    Delete={
+                        "Objects": [{"Key": key} for key in keys[first : first + 1000]],
+                        "Quiet": True,
+                    },
+                )
+
+    def picture_exists(self, location: str) -> bool:
+        try:
+            bucket, key = self._bucket_key(location)
+            self._client.head_object(Bucket=bucket, Key=key)
+        except FileNotFoundError:
+            return False
+        except self._client.exceptions.ClientError as exc:
+            if self._is_missing(exc):
+                return False
+            raise
+        return True
+
+    def existing_picture_set(self, locations: Collection[str]) -> set[str]:
+        # Each check is a round trip, so run them side by side over the pooled connections
+        locations = list(locations)
+        with ThreadPoolExecutor(max_workers=self._max_connections) as executor:
+            exists = list(executor.map(self.picture_exists, locations))
+        return {location for location, found in zip(locations, exists) if found}
+
+    @contextmanager
+    def open_picture(self, location: str) -> Iterator[tuple[BinaryIO, PictureInfo]]:
+        bucket, key = self._bucket_key(location)
+        try:
+            picture_object = self._client.get_object(Bucket=bucket, Key=key)
+        except self._client.exceptions.ClientError as exc:
+            if self._is_missing(exc):
+                raise FileNotFoundError(location) from exc
+            raise
+        with closing(picture_object["Body"]) as picture_body:
+            yield picture_body, PictureInfo(
+                size=picture_object["ContentLength"],
+                last_modified=picture_object["LastModified"].timestamp(),
+            )
+
+    def presigned_url(self, location: str) -> Optional[str]:
+        try:
+            bucket, key = self._bucket_key(location)
+        except FileNotFoundError:
+            return None
+        return self._client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket, "Key": key},
+            ExpiresIn=self._presigned_url_seconds,
+        )
+
+
+@cache
+def get_picture_storage(
+    storage_type: PictureStorageType = PICTURE_STORAGE,
+) -> PictureStorage:
+    storage_type = PictureStorageType(storage_type)
+    if storage_type == PictureStorageType.S3:
+        return S3PictureStorage(
+            bucket=S3_BUCKET,
+            prefix=S3_PREFIX,
+            endpoint_url=S3_ENDPOINT_URL,
+            region=S3_REGION,
+            max_connections=S3_MAX_CONNECTIONS,
+            multipart_threshold=S3_MULTIPART_THRESHOLD,
+            presigned_url_seconds=S3_PRESIGNED_URL_SECONDS,
+            layout=PICTURE_STORAGE_LAYOUT,
+        )
+    return LocalPictureStorage(
+        pictures_dir=PICTURES_DIR, fsync=PICTURE_FSYNC, layout=PICTURE_STORAGE_LAYOUT
+    )
+
+
+picture_storage = get_picture_storage()
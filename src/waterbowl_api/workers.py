@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from time import perf_counter
+from typing import Any, Callable, Optional
+
+from enums import (
+    IMAGE_WORKER_QUEUE_SIZE,
+    IMAGE_WORKER_TYPE,
+    IMAGE_WORKERS,
+    ImageWorkerType,
+)
+from metrics import (
+    IMAGE_WORKER_ACTIVE_JOBS,
+    IMAGE_WORKER_JOB_SECONDS,
+    IMAGE_WORKER_QUEUE_DEPTH,
+    IMAGE_WORKER_REJECTIONS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPoolFullException(Exception):
+    pass
+
+
+class ImageWorkerPool:
+    """
+    Bounded pool that runs CPU heavy image work off the event loop.
+
+    At most `max_workers` jobs run at once and at most `max_queue_size` more wait for a worker; anything beyond
+    that is rejected with a WorkerPoolFullException so callers can shed load instead of piling up requests.
+    """
+
+    def __init__(
+        self,
+        worker_type: ImageWorkerType = ImageWorkerType.THREAD,
+        max_workers: int = 2,
+        max_queue_size: int = 8,
+    ):
+        self._worker_type = ImageWorkerType(worker_type)
+        self._max_workers = max(max_workers, 1)
+        self._max_queue_size = max(max_queue_size, 0)
+        self._executor: Optional[Executor] = None
+        self._active_jobs = 0
+
+    @property
+    def max_workers(self) -> int:
+        return self._max_workers
+
+    @property
+    def active_jobs(self) -> int:
+        return self._active_jobs
+
+    @property
+    def queue_depth(self) -> int:
+        return max(self._active_jobs - self._max_workers, 0)
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self._worker_type == ImageWorkerType.PROCESS:
+                # Forking a process that has already loaded native image libraries is unsafe, so always spawn
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self._max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._max_workers, thread_name_prefix="image-worker"
+                )
+        return self._executor
+
+    def _update_gauges(self) -> None:
+        IMAGE_WORKER_ACTIVE_JOBS.set(self._active_jobs)
+        IMAGE_WORKER_QUEUE_DEPTH.set(self.queue_depth)
+
+    async def submit(self, func: Callable[..., Any], *args: Any) -> Any:
+        if self._active_jobs >= self._max_workers + self._max_queue_size:
+            IMAGE_WORKER_REJECTIONS.inc()
+            logger.warning(
+                "Image worker pool full, rejecting job (%s active)", self._active_jobs
+            )
+            raise WorkerPoolFullException("Image worker pool is full.")
+        self._active_jobs += 1
+        self._update_gauges()
+        start = perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self._active_jobs -= 1
+            self._update_gauges()
+            IMAGE_WORKER_JOB_SECONDS.observe(perf_counter() - start)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
+image_worker_pool = ImageWorkerPool(
+    worker_type=IMAGE_WORKER_TYPE,
+    max_workers=IMAGE_WORKERS,
+    max_queue_size=IMAGE_WORKER_QUEUE_SIZE,
+)
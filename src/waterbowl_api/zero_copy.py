@@ -0,0 +1,102 @@
+import os
+from typing import Optional, Union
+
+import anyio
+from metrics import FILE_RESPONSE_BYTES
+from starlette.responses import FileResponse
+from starlette.types import Receive, Scope, Send
+
+PATHSEND = "http.response.pathsend"
+ZEROCOPYSEND = "http.response.zerocopysend"
+
+
+class ZeroCopyFileResponse(FileResponse):
+    """
+    FileResponse that leaves copying the file to the ASGI server where it can. A whole file is handed over by path
+    to servers offering the pathsend extension, and any part of one as an open file to servers offering
+    zerocopysend, which pass it to os.sendfile. Other servers get the bytes read in chunks, as FileResponse does.
+
+    Sends `size` bytes of the file from `offset`, the rest of the file by default.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, os.PathLike],
+        *args,
+        offset: int = 0,
+        size: Optional[int] = None,
+        **kwargs,
+    ):
+        self.offset = offset
+        self.size = size
+        super().__init__(path, *args, **kwargs)
+        if size is not None:
+            self.headers.setdefault("content-length", str(size))
+
+    def set_stat_headers(self, stat_result: os.stat_result) -> None:
+        if self.size is None:
+            self.size = stat_result.st_size - self.offset
+        self.headers.setdefault("content-length", str(self.size))
+        super().set_stat_headers(stat_result)
+
+    async def _send_chunks(self, send: Send) -> None:
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            await file.seek(self.offset)
+            remaining = self.size
+            more_body = True
+            while more_body:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                remaining -= len(chunk)
+                more_body = remaining > 0 and len(chunk) > 0
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": more_body,
+                    }
+                )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if self.stat_result is None:
+            try:
+                self.stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+            except FileNotFoundError as exc:
+                raise RuntimeError(f"File at path {self.path} does not exist.") from exc
+            self.set_stat_headers(self.stat_result)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        extensions = scope.get("extensions") or {}
+        if self.send_header_only:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif (
+            PATHSEND in extensions
+            and self.offset == 0
+            and self.size == self.stat_result.st_size
+        ):
+            FILE_RESPONSE_BYTES.labels("pathsend").inc(self.size)
+            await send({"type": PATHSEND, "path": os.path.abspath(self.path)})
+        elif ZEROCOPYSEND in extensions:
+            FILE_RESPONSE_BYTES.labels("zerocopysend").inc(self.size)
+            file = await anyio.to_thread.run_sync(open, self.path, "rb")
+            try:
+                await send(
+                    {
+                        "type": ZEROCOPYSEND,
+                        "file": file,
+                        "offset": self.offset,
+                        "count": self.size,
+                        "more_body": False,
+                    }
+                )
+            finally:
+                file.close()
+        else:
+            FILE_RESPONSE_BYTES.labels("chunked").inc(self.size)
+            await self._send_chunks(send)
+        if self.background is not None:
+            await self.background()
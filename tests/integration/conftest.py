@@ -8,11 +8,14 @@ import pytest
 import pytest_asyncio
 from enums import POSTGRES_ADDRESS, POSTGRES_DATABASE, POSTGRES_PASSWORD, POSTGRES_USER
 from fastapi import UploadFile
+from image_cache import image_cache
 from postgres.database import Base
 from postgres.db_models import DBPicture, DBPictureMetadata
-from sqlalchemy import Table
+from prefetch import unannotated_picture_queue
+from sqlalchemy import Table, event
 from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from storage import picture_storage
 
 database_uri = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_ADDRESS}/{POSTGRES_DATABASE}"
 engine = create_async_engine(database_uri)
@@ -30,6 +33,16 @@ def event_loop():
     loop.close()
 
 
+@pytest.fixture(autouse=True)
+def clear_unannotated_picture_queue():
+    # The queue and image cache outlive a request, but every test starts from empty tables
+    unannotated_picture_queue.clear()
+    image_cache.clear()
+    yield
+    unannotated_picture_queue.clear()
+    image_cache.clear()
+
+
 @pytest_asyncio.fixture
 async def postgres_connection() -> AsyncConnection:
     async with engine.begin() as conn:
@@ -55,17 +68,13 @@ async def postgres_tables(postgres_engine: AsyncConnection) -> tuple[Table, Tabl
     ]
 
 
-@pytest.fixture
-def add_picture(
-    postgres: AsyncSession,
-    test_water_bowl_picture_file: Path,
-    test_food_bowl_picture_file: Path,
-) -> AsyncGenerator[DBPicture, None]:
-    water_bowl = test_water_bowl_picture_file
-    food_bowl = test_food_bowl_picture_file
+def picture_factory(
+    session: AsyncSession,
+    water_bowl: Path,
+    food_bowl: Path,
+    created_pictures: list[DBPicture],
+):
     now = datetime.now()
-    session = postgres
-    created_pictures = []
 
     async def _add_picture(
         water_bowl: str = str(water_bowl),
@@ -106,12 +115,78 @@ def add_picture(
         await session.refresh(new_picture)
         return new_picture
 
-    yield _add_picture
+    return _add_picture
+
+
+@pytest.fixture
+def add_picture(
+    postgres: AsyncSession,
+    test_water_bowl_picture_file: Path,
+    test_food_bowl_picture_file: Path,
+) -> AsyncGenerator[DBPicture, None]:
+    session = postgres
+    created_pictures = []
+
+    yield picture_factory(
+        session=session,
+        water_bowl=test_water_bowl_picture_file,
+        food_bowl=test_food_bowl_picture_file,
+        created_pictures=created_pictures,
+    )
     if created_pictures:
         for picture in created_pictures:
             session.sync_session.delete(picture)
 
 
+@pytest_asyncio.fixture
+async def committed_postgres() -> AsyncGenerator[sessionmaker, None]:
+    """
+    Unlike `postgres`, which runs every test inside one connection, this commits the schema and any data so that
+    concurrent requests can each use their own session and connection. Yields a session factory that, like the
+    app's, autocommits every statement.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    yield sessionmaker(
+        bind=engine.execution_options(isolation_level="AUTOCOMMIT"),
+        expire_on_commit=False,
+        class_=AsyncSession,
+    )
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+
+@pytest.fixture
+def executed_statements() -> list[str]:
+    """
+    Records every statement sent to the test database while the test runs, to catch N+1 query regressions.
+    """
+    statements = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", _record)
+    yield statements
+    event.remove(engine.sync_engine, "before_cursor_execute", _record)
+
+
+@pytest_asyncio.fixture
+async def add_committed_picture(
+    committed_postgres: sessionmaker,
+    test_water_bowl_picture_file: Path,
+    test_food_bowl_picture_file: Path,
+) -> AsyncGenerator[DBPicture, None]:
+    async with committed_postgres() as session:
+        yield picture_factory(
+            session=session,
+            water_bowl=test_water_bowl_picture_file,
+            food_bowl=test_food_bowl_picture_file,
+            created_pictures=[],
+        )
+
+
 @pytest.fixture
 def add_multiple_pictures(
     postgres: AsyncSession,
@@ -186,6 +261,5 @@ def picture_upload(test_raw_picture_file):
 
 @pytest.fixture
 def mock_picture_service_dirs(test_picture_storage):
-    with mock.patch("picture_service.PICTURES_DIR") as pictures_dir:
-        pictures_dir.joinpath = test_picture_storage.joinpath
+    with mock.patch.object(picture_storage, "_pictures_dir", test_picture_storage):
         yield
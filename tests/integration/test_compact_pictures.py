@@ -0,0 +1,212 @@
+import shutil
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+from compact_pictures import compact_pictures
+from postgres.db_models import DBPicture, DBPicturePack
+from sqlalchemy import Update, select
+from storage import LocalPictureStorage, PackedLocation, PackWriter
+
+
+@pytest.mark.asyncio
+async def test_compact_pictures(
+    postgres,
+    add_picture,
+    test_picture_storage,
+    test_water_bowl_picture_file,
+    test_food_bowl_picture_file,
+):
+    old = datetime.now() - timedelta(days=60)
+
+    async def _add_picture(name: str, **kwargs):
+        water_bowl = test_picture_storage.joinpath(f"water_{name}.jpeg")
+        food_bowl = test_picture_storage.joinpath(f"food_{name}.jpeg")
+        shutil.copy(test_water_bowl_picture_file, water_bowl)
+        shutil.copy(test_food_bowl_picture_file, food_bowl)
+        return await add_picture(
+            water_bowl=str(water_bowl), food_bowl=str(food_bowl), **kwargs
+        )
+
+    old_pictures = [
+        await _add_picture(str(index), timestamp=old, human_water_yes=1)
+        for index in range(3)
+    ]
+    # Not annotated yet, or still recent, so left as they are
+    unannotated_picture = await _add_picture("unannotated", timestamp=old)
+    recent_picture = await _add_picture("recent", human_food_no=1)
+    # Crops are missing, so this picture is skipped
+    missing_picture = await add_picture(
+        water_bowl=str(test_picture_storage.joinpath("missing_water.jpeg")),
+        food_bowl=str(test_picture_storage.joinpath("missing_food.jpeg")),
+        timestamp=old,
+        human_cat_yes=1,
+    )
+    storage = LocalPictureStorage(pictures_dir=test_picture_storage)
+    older_than = datetime.now() - timedelta(days=30)
+
+    assert (
+        await compact_pictures(postgres, storage, older_than=older_than, dry_run=True)
+        == 4
+    )
+    assert len(list(test_picture_storage.glob("*.jpeg"))) == 10
+    # Each pack closes once it holds a picture, so every picture gets its own
+    assert await compact_pictures(postgres, storage, older_than, max_pack_bytes=1) == 3
+
+    packs = (await postgres.execute(select(DBPicturePack))).scalars().all()
+    assert len(packs) == 3
+    for picture in old_pictures:
+        await postgres.refresh(picture)
+        assert PackedLocation.parse(picture.waterbowl_picture).filename.startswith(
+            "water_"
+        )
+        assert (await storage.read(picture.waterbowl_picture))[
+            0
+        ] == test_water_bowl_picture_file.read_bytes()
+        assert (await storage.read(picture.food_picture))[
+            0
+        ] == test_food_bowl_picture_file.read_bytes()
+    for picture in [unannotated_picture, recent_picture, missing_picture]:
+        await postgres.refresh(picture)
+        assert PackedLocation.parse(picture.waterbowl_picture) is None
+    assert sorted(path.name for path in test_picture_storage.glob("*.jpeg")) == [
+        "food_recent.jpeg",
+        "food_unannotated.jpeg",
+        "water_recent.jpeg",
+        "water_unannotated.jpeg",
+    ]
+    assert sum(pack.size for pack in packs) == 3 * (
+        test_water_bowl_picture_file.stat().st_size
+        + test_food_bowl_picture_file.stat().st_size
+    )
+
+    # Packed pictures aren't packed again
+    assert await compact_pictures(postgres, storage, older_than) == 0
+
+
+@pytest.mark.asyncio
+async def test_interrupted_compaction_is_finished_by_the_next_run(
+    postgres,
+    add_picture,
+    test_picture_storage,
+    test_water_bowl_picture_file,
+    test_food_bowl_picture_file,
+):
+    water_bowl = test_picture_storage.joinpath("water.jpeg")
+    food_bowl = test_picture_storage.joinpath("food.jpeg")
+    shutil.copy(test_water_bowl_picture_file, water_bowl)
+    shutil.copy(test_food_bowl_picture_file, food_bowl)
+    picture = await add_picture(
+        water_bowl=str(water_bowl),
+        food_bowl=str(food_bowl),
+        timestamp=datetime.now() - timedelta(days=60),
+        human_water_no=1,
+    )
+    storage = LocalPictureStorage(pictures_dir=test_picture_storage)
+    older_than = datetime.now() - timedelta(days=30)
+
+    # Stopped after the pictures were pointed at the pack, before the originals were removed
+    with mock.patch.object(storage, "delete_pictures", side_effect=OSError):
+        with pytest.raises(OSError):
+            await compact_pictures(postgres, storage, older_than)
+    await postgres.rollback()
+    await postgres.refresh(picture)
+    assert PackedLocation.parse(picture.waterbowl_picture) is not None
+    pack = (await postgres.execute(select(DBPicturePack))).scalar_one()
+    assert sorted(pack.pending_deletions) == sorted([str(water_bowl), str(food_bowl)])
+    assert water_bowl.exists()
+
+    assert await compact_pictures(postgres, storage, older_than) == 0
+    await postgres.refresh(pack)
+    assert pack.pending_deletions is None
+    assert not water_bowl.exists()
+    assert not food_bowl.exists()
+    assert (await storage.read(picture.food_picture))[
+        0
+    ] == test_food_bowl_picture_file.read_bytes()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("failure", ["seal", "update"])
+async def test_failed_compaction_keeps_the_originals(
+    failure,
+    committed_postgres,
+    add_committed_picture,
+    test_picture_storage,
+    test_water_bowl_picture_file,
+    test_food_bowl_picture_file,
+):
+    # Like the app, every statement commits on its own here, so nothing a failed run wrote is rolled back
+    water_bowl = test_picture_storage.joinpath("water.jpeg")
+    food_bowl = test_picture_storage.joinpath("food.jpeg")
+    shutil.copy(test_water_bowl_picture_file, water_bowl)
+    shutil.copy(test_food_bowl_picture_file, food_bowl)
+    picture = await add_committed_picture(
+        water_bowl=str(water_bowl),
+        food_bowl=str(food_bowl),
+        timestamp=datetime.now() - timedelta(days=60),
+        human_water_no=1,
+    )
+    storage = LocalPictureStorage(pictures_dir=test_picture_storage)
+    older_than = datetime.now() - timedelta(days=30)
+
+    async with committed_postgres() as db:
+        if failure == "seal":
+            interruption = mock.patch.object(
+                PackWriter, "seal", side_effect=OSError("No space left on device")
+            )
+        else:
+            execute = db.execute
+
+            async def _execute(statement, *args, **kwargs):
+                if isinstance(statement, Update):
+                    raise ConnectionResetError
+                return await execute(statement, *args, **kwargs)
+
+            interruption = mock.patch.object(db, "execute", _execute)
+        with interruption, pytest.raises((OSError, ConnectionResetError)):
+            await compact_pictures(db, storage, older_than)
+
+    async with committed_postgres() as db:
+        packs = (await db.execute(select(DBPicturePack))).scalars().all()
+        assert all(pack.pending_deletions is None for pack in packs)
+        assert (await db.get(DBPicture, picture.id)).waterbowl_picture == str(
+            water_bowl
+        )
+    assert water_bowl.exists()
+    assert food_bowl.exists()
+
+    async with committed_postgres() as db:
+        assert await compact_pictures(db, storage, older_than) == 1
+        packed_picture = await db.get(DBPicture, picture.id)
+    assert (await storage.read(packed_picture.waterbowl_picture))[
+        0
+    ] == test_water_bowl_picture_file.read_bytes()
+    assert (await storage.read(packed_picture.food_picture))[
+        0
+    ] == test_food_bowl_picture_file.read_bytes()
+    assert not water_bowl.exists()
+
+
+@pytest.mark.asyncio
+async def test_pending_deletions_keep_crops_pictures_point_at(
+    postgres,
+    add_picture,
+    test_picture_storage,
+    test_water_bowl_picture_file,
+):
+    in_use = test_picture_storage.joinpath("in_use.jpeg")
+    left_over = test_picture_storage.joinpath("left_over.jpeg")
+    shutil.copy(test_water_bowl_picture_file, in_use)
+    shutil.copy(test_water_bowl_picture_file, left_over)
+    await add_picture(water_bowl=str(in_use))
+    pack = DBPicturePack(pending_deletions=[str(in_use), str(left_over)])
+    postgres.add(pack)
+    await postgres.commit()
+    storage = LocalPictureStorage(pictures_dir=test_picture_storage)
+
+    assert await compact_pictures(postgres, storage, datetime.now()) == 0
+    await postgres.refresh(pack)
+    assert pack.pending_deletions is None
+    assert in_use.exists()
+    assert not left_over.exists()
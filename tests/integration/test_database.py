@@ -0,0 +1,164 @@
+import pytest
+import pytest_asyncio
+from enums import PictureRetrieveLimits, PictureType
+from picture_service import PictureService
+from postgres.database import InstrumentedPool, database_url, engine, upgrade_schema
+from postgres.db_models import DBPicture, DBPictureMetadata
+from prometheus_client import REGISTRY
+from sampling import RandomOrderSampler
+from sqlalchemy import exc, inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+
+@pytest.mark.asyncio
+async def test_upgrade_schema_adds_missing_columns_and_indexes(postgres_connection):
+    table_name = DBPictureMetadata.__tablename__
+    await postgres_connection.execute(
+        text(f'ALTER TABLE "{table_name}" DROP COLUMN updated_at')
+    )
+    await postgres_connection.execute(
+        text(f'INSERT INTO "{table_name}" (water_in_bowl) VALUES (false)')
+    )
+
+    await postgres_connection.run_sync(upgrade_schema)
+
+    columns = await postgres_connection.run_sync(
+        lambda conn: {
+            column["name"] for column in inspect(conn).get_columns(table_name)
+        }
+    )
+    indexes = await postgres_connection.run_sync(
+        lambda conn: {index["name"] for index in inspect(conn).get_indexes(table_name)}
+    )
+    assert "updated_at" in columns
+    assert {index.name for index in DBPictureMetadata.__table__.indexes} <= indexes
+    updated_at = await postgres_connection.scalar(
+        text(f'SELECT updated_at FROM "{table_name}"')
+    )
+    assert updated_at is not None
+
+
+@pytest_asyncio.fixture
+async def seeded_pictures(postgres_connection):
+    """
+    A realistically sized table where most pictures are unlabelled and each annotation state is rare.
+    """
+    metadata_table = DBPictureMetadata.__tablename__
+    pictures_table = DBPicture.__tablename__
+    await postgres_connection.execute(
+        text(
+            f"""
+            INSERT INTO "{metadata_table}" (
+                water_in_bowl, food_in_bowl, cat_at_bowl,
+                human_water_yes, human_water_no, human_food_yes, human_food_no, human_cat_yes, human_cat_no
+            )
+            SELECT i % 200 = 0, i % 200 = 0, i % 200 = 0,
+                (i % 200 = 0)::int, (i % 200 = 1)::int, (i % 200 = 0)::int, (i % 200 = 1)::int,
+                (i % 200 = 0)::int, (i % 200 = 1)::int
+            FROM generate_series(1, 50000) AS i
+            """
+        )
+    )
+    await postgres_connection.execute(
+        text(
+            f"""
+            INSERT INTO "{pictures_table}" (metadata_id, waterbowl_picture, food_picture, picture_timestamp)
+            SELECT id, 'water.jpeg', 'food.jpeg', now() FROM "{metadata_table}"
+            """
+        )
+    )
+    await postgres_connection.execute(text(f'ANALYZE "{metadata_table}"'))
+    await postgres_connection.execute(text(f'ANALYZE "{pictures_table}"'))
+    yield postgres_connection
+
+
+async def explain(connection, statement) -> str:
+    compiled = statement.compile(
+        dialect=connection.dialect, compile_kwargs={"literal_binds": True}
+    )
+    plan = await connection.execute(text(f"EXPLAIN {compiled}"))
+    return "\n".join(row[0] for row in plan)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "picture_type, picture_class, index_suffix",
+    [
+        (PictureType.WATER_BOWL, True, "water_yes"),
+        (PictureType.WATER_BOWL, False, "water_no"),
+        (PictureType.FOOD_BOWL, True, "food_yes"),
+        (PictureType.FOOD_BOWL, False, "food_no"),
+        ("cat", True, "cat_yes"),
+        ("cat", False, "cat_no"),
+    ],
+)
+async def test_annotated_pictures_use_partial_indexes(
+    seeded_pictures, picture_type, picture_class, index_suffix
+):
+    picture_svc = PictureService(db=None)
+    statement = picture_svc._annotated_pictures_statement(
+        limit=100, picture_type=picture_type, picture_class=picture_class
+    )
+    plan = await explain(seeded_pictures, statement)
+    assert f"{DBPictureMetadata.__tablename__}_{index_suffix}" in plan
+    assert f"Seq Scan on {DBPictureMetadata.__tablename__}" not in plan
+
+
+@pytest.mark.asyncio
+async def test_human_annotated_filter_uses_partial_index(seeded_pictures):
+    criteria = PictureService._get_limit_criteria(PictureRetrieveLimits.HUMAN_ANNOTATED)
+    statement = RandomOrderSampler._filtered(criteria=criteria)
+    plan = await explain(seeded_pictures, statement)
+    assert f"{DBPictureMetadata.__tablename__}_water_annotated" in plan
+
+
+def sample_value(name: str) -> float:
+    return REGISTRY.get_sample_value(name) or 0.0
+
+
+@pytest.mark.asyncio
+async def test_pool_metrics_track_checkouts():
+    waits_before = sample_value("waterbowl_db_pool_wait_seconds_count")
+    checked_out_before = sample_value("waterbowl_db_pool_checked_out")
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+        assert sample_value("waterbowl_db_pool_checked_out") == checked_out_before + 1
+    assert sample_value("waterbowl_db_pool_checked_out") == checked_out_before
+    assert sample_value("waterbowl_db_pool_wait_seconds_count") == waits_before + 1
+
+
+@pytest.mark.asyncio
+async def test_pool_timeouts_are_counted():
+    small_engine = create_async_engine(
+        database_url,
+        poolclass=InstrumentedPool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=0.1,
+    )
+    timeouts_before = sample_value("waterbowl_db_pool_timeouts_total")
+    try:
+        async with small_engine.connect():
+            with pytest.raises(exc.TimeoutError):
+                async with small_engine.connect():
+                    pass
+    finally:
+        await small_engine.dispose()
+    assert sample_value("waterbowl_db_pool_timeouts_total") == timeouts_before + 1
+
+
+@pytest.mark.asyncio
+async def test_query_durations_are_recorded():
+    labels = {"statement": "SELECT"}
+    queries_before = (
+        REGISTRY.get_sample_value("waterbowl_db_query_seconds_count", labels) or 0
+    )
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+        with pytest.raises(exc.DBAPIError):
+            await conn.execute(text("SELECT * FROM missing_table"))
+        await conn.execute(text("  select 2"))
+    assert (
+        REGISTRY.get_sample_value("waterbowl_db_query_seconds_count", labels)
+        == queries_before + 2
+    )
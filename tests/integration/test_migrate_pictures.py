@@ -0,0 +1,106 @@
+import os
+import shutil
+from datetime import datetime
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from enums import PictureStorageLayout
+from migrate_pictures import migrate_picture_layout
+from storage import LocalPictureStorage
+
+
+@pytest.mark.asyncio
+async def test_migrate_picture_layout(
+    postgres,
+    add_picture,
+    test_picture_storage,
+    test_water_bowl_picture_file,
+    test_food_bowl_picture_file,
+):
+    flat_pictures = []
+    for index in range(3):
+        water_bowl = test_picture_storage.joinpath(f"water_{index}.jpeg")
+        food_bowl = test_picture_storage.joinpath(f"food_{index}.jpeg")
+        shutil.copy(test_water_bowl_picture_file, water_bowl)
+        shutil.copy(test_food_bowl_picture_file, food_bowl)
+        flat_pictures.append(
+            await add_picture(
+                water_bowl=str(water_bowl),
+                food_bowl=str(food_bowl),
+                timestamp=datetime(2024, 1, index + 1, 12, 30),
+            )
+        )
+    # Crops are missing, so this picture is left as it is
+    missing_picture = await add_picture(
+        water_bowl=str(test_picture_storage.joinpath("missing_water.jpeg")),
+        food_bowl=str(test_picture_storage.joinpath("missing_food.jpeg")),
+    )
+    storage = LocalPictureStorage(
+        pictures_dir=test_picture_storage, layout=PictureStorageLayout.SHARDED
+    )
+
+    assert await migrate_picture_layout(postgres, storage, dry_run=True) == 4
+    assert len(list(test_picture_storage.glob("*.jpeg"))) == 6
+    assert await migrate_picture_layout(postgres, storage, batch_size=2) == 3
+
+    for index, picture in enumerate(flat_pictures):
+        await postgres.refresh(picture)
+        shard = test_picture_storage.joinpath("2024", "01", f"{index + 1:02}", "12")
+        assert Path(picture.waterbowl_picture) == shard.joinpath(f"water_{index}.jpeg")
+        assert Path(picture.food_picture) == shard.joinpath(f"food_{index}.jpeg")
+        assert (
+            Path(picture.waterbowl_picture).read_bytes()
+            == test_water_bowl_picture_file.read_bytes()
+        )
+    await postgres.refresh(missing_picture)
+    assert missing_picture.waterbowl_picture.endswith("/missing_water.jpeg")
+    assert list(test_picture_storage.glob("*.jpeg")) == []
+    assert len(list(test_picture_storage.rglob("*.jpeg"))) == 6
+
+    # Pictures already in place are left alone
+    assert await migrate_picture_layout(postgres, storage) == 0
+
+
+@pytest.mark.asyncio
+async def test_interrupted_migration_is_finished_by_the_next_run(
+    postgres,
+    add_picture,
+    test_picture_storage,
+    test_water_bowl_picture_file,
+    test_food_bowl_picture_file,
+):
+    water_bowl = test_picture_storage.joinpath("water.jpeg")
+    food_bowl = test_picture_storage.joinpath("food.jpeg")
+    shutil.copy(test_water_bowl_picture_file, water_bowl)
+    shutil.copy(test_food_bowl_picture_file, food_bowl)
+    picture = await add_picture(
+        water_bowl=str(water_bowl),
+        food_bowl=str(food_bowl),
+        timestamp=datetime(2024, 1, 1, 12, 30),
+    )
+    # Never pointed at by a picture row, so left alone even though it is linked
+    unknown = test_picture_storage.joinpath("unknown.jpeg")
+    shutil.copy(test_water_bowl_picture_file, unknown)
+    os.link(unknown, test_picture_storage.joinpath("unknown_link.jpeg"))
+    storage = LocalPictureStorage(
+        pictures_dir=test_picture_storage, layout=PictureStorageLayout.SHARDED
+    )
+
+    # Stopped after the picture was pointed at its new location, before the old one was removed
+    with mock.patch.object(storage, "delete_pictures", side_effect=OSError):
+        with pytest.raises(OSError):
+            await migrate_picture_layout(postgres, storage)
+    await postgres.refresh(picture)
+    shard = test_picture_storage.joinpath("2024", "01", "01", "12")
+    assert Path(picture.waterbowl_picture) == shard.joinpath("water.jpeg")
+    assert water_bowl.exists()
+
+    assert await migrate_picture_layout(postgres, storage) == 0
+    assert not water_bowl.exists()
+    assert not food_bowl.exists()
+    assert Path(picture.food_picture).read_bytes() == (
+        test_food_bowl_picture_file.read_bytes()
+    )
+    assert unknown.exists()
+    assert test_picture_storage.joinpath("unknown_link.jpeg").exists()
@@ -1,11 +1,15 @@
 from datetime import datetime
 from pathlib import Path
+from unittest import mock
 
 import pytest
-from enums import PictureRetrieveLimits, PictureType
+from enums import PictureRetrieveLimits, PictureSamplingStrategy, PictureType
 from models import PictureUpdateRequest
 from picture_service import PictureService
 from postgres.db_models import DBPicture
+from sampling import get_picture_sampler
+from sqlalchemy import func, select
+from workers import WorkerPoolFullException, image_worker_pool
 
 
 @pytest.fixture
@@ -29,7 +33,7 @@ class TestPictureService:
             picture=picture_upload, timestamp=now.timestamp()
         )
 
-        stored_pictures = list(test_picture_storage.glob("*.jpeg"))
+        stored_pictures = list(test_picture_storage.rglob("*.jpeg"))
         assert len(stored_pictures) == 2
         for expected_picture in [
             Path(test_picture.waterbowl_picture),
@@ -39,6 +43,34 @@ class TestPictureService:
         assert now == test_picture.picture_timestamp
         assert test_picture.id == 1
 
+    @pytest.mark.asyncio
+    async def test_add_picture_batch_removes_saved_crops_on_failure(
+        self, postgres, picture_upload, test_picture_storage
+    ):
+        picture_svc = PictureService(db=postgres)
+        calls = 0
+
+        async def _flaky_submit(func, *args):
+            nonlocal calls
+            calls += 1
+            if calls == 2:
+                raise WorkerPoolFullException("Image worker pool is full.")
+            return func(*args)
+
+        with mock.patch.object(image_worker_pool, "submit", _flaky_submit):
+            with pytest.raises(WorkerPoolFullException):
+                await picture_svc.create_pictures_batch(
+                    [(picture_upload, datetime.now().timestamp())] * 3
+                )
+
+        assert list(test_picture_storage.rglob("*.jpeg")) == []
+        assert (
+            await postgres.scalar(
+                select(func.count(DBPicture.id))  # pylint: disable=not-callable
+            )
+            == 0
+        )
+
     @pytest.mark.asyncio
     async def test_get_picture(
         self,
@@ -104,6 +136,74 @@ class TestPictureService:
         else:
             assert annotated_picture.id == returned_picture.id
 
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("strategy", list(PictureSamplingStrategy))
+    @pytest.mark.parametrize(
+        "limit",
+        [PictureRetrieveLimits.HUMAN_ANNOTATED, PictureRetrieveLimits.NO_ANNOTATION],
+    )
+    async def test_sampling_strategies_respect_limits(
+        self, add_multiple_pictures, postgres, strategy, limit
+    ):
+        unannotated_pictures = await add_multiple_pictures(num_pictures=3)
+        annotated_pictures = await add_multiple_pictures(
+            num_pictures=3, human_water_no=1
+        )
+        expected_pictures = (
+            unannotated_pictures
+            if limit == PictureRetrieveLimits.NO_ANNOTATION
+            else annotated_pictures
+        )
+        expected_ids = {picture.id for picture in expected_pictures}
+
+        picture_svc = PictureService(db=postgres, sampler=get_picture_sampler(strategy))
+        returned_ids = set()
+        for _ in range(50):
+            returned_picture = await picture_svc.get_random_picture(limit=limit)
+            assert returned_picture.id in expected_ids
+            returned_ids.add(returned_picture.id)
+        # Every matching picture can be sampled, not just the first one after a gap
+        assert returned_ids == expected_ids
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("strategy", list(PictureSamplingStrategy))
+    async def test_sampling_strategies_without_matches(
+        self, add_picture, postgres, strategy
+    ):
+        await add_picture(human_water_yes=1)
+        picture_svc = PictureService(db=postgres, sampler=get_picture_sampler(strategy))
+        assert (
+            await picture_svc.get_random_picture(
+                limit=PictureRetrieveLimits.NO_ANNOTATION
+            )
+            is None
+        )
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("strategy", list(PictureSamplingStrategy))
+    async def test_get_random_pictures(
+        self, add_multiple_pictures, add_picture, postgres, strategy
+    ):
+        unannotated_pictures = await add_multiple_pictures(num_pictures=6)
+        await add_picture(human_water_yes=1)
+        excluded_id = unannotated_pictures[0].id
+        expected_ids = {picture.id for picture in unannotated_pictures[1:]}
+
+        picture_svc = PictureService(db=postgres, sampler=get_picture_sampler(strategy))
+        returned_ids = set()
+        for _ in range(20):
+            returned_pictures = await picture_svc.get_random_pictures(
+                count=3,
+                limit=PictureRetrieveLimits.NO_ANNOTATION,
+                exclude_ids=[excluded_id],
+            )
+            ids = [picture.id for picture in returned_pictures]
+            assert 0 < len(ids) <= 3
+            assert len(ids) == len(set(ids))
+            assert set(ids) <= expected_ids
+            returned_ids.update(ids)
+        assert returned_ids == expected_ids
+
     @pytest.mark.asyncio
     async def test_update_picture(
         self,
@@ -152,6 +252,58 @@ class TestPictureService:
         assert test_metadata_dict.get("cat_at_bowl") != updated_metadata.cat_at_bowl
         assert updated_metadata.cat_at_bowl is True
 
+    @pytest.mark.asyncio
+    async def test_update_metadata_batch(self, add_multiple_pictures, postgres):
+        test_pictures = await add_multiple_pictures(num_pictures=3)
+        picture_svc = PictureService(db=postgres)
+        missing_picture_id = max(picture.id for picture in test_pictures) + 1
+
+        updated_ids = await picture_svc.update_metadata_batch(
+            [
+                (test_pictures[0].id, PictureUpdateRequest(human_water_yes=1)),
+                (test_pictures[0].id, PictureUpdateRequest(human_water_yes=1)),
+                (test_pictures[1].id, PictureUpdateRequest(human_food_no=2)),
+                (missing_picture_id, PictureUpdateRequest(human_cat_yes=1)),
+            ]
+        )
+
+        assert updated_ids == {test_pictures[0].id, test_pictures[1].id}
+        first_metadata = await picture_svc.get_metadata(test_pictures[0].metadata_id)
+        await postgres.refresh(first_metadata)
+        # Repeated entries for a picture all count
+        assert first_metadata.human_water_yes == 2
+        assert first_metadata.water_in_bowl is True
+        second_metadata = await picture_svc.get_metadata(test_pictures[1].metadata_id)
+        await postgres.refresh(second_metadata)
+        assert second_metadata.human_food_no == 2
+        assert second_metadata.food_in_bowl is False
+        untouched_metadata = await picture_svc.get_metadata(
+            test_pictures[2].metadata_id
+        )
+        await postgres.refresh(untouched_metadata)
+        assert untouched_metadata.human_water_yes == 0
+
+    @pytest.mark.asyncio
+    async def test_update_metadata_batch_past_the_bind_limit(
+        self, add_multiple_pictures, postgres
+    ):
+        test_pictures = await add_multiple_pictures(num_pictures=2)
+        picture_svc = PictureService(db=postgres)
+        first_missing_id = max(picture.id for picture in test_pictures) + 1
+        # Seven values a picture, so a VALUES list of this many would need more than 32767 bind parameters
+        picture_ids = [picture.id for picture in test_pictures] + list(
+            range(first_missing_id, first_missing_id + 5000)
+        )
+
+        updated_ids = await picture_svc.update_metadata_batch(
+            [
+                (picture_id, PictureUpdateRequest(human_cat_no=1))
+                for picture_id in picture_ids
+            ]
+        )
+
+        assert updated_ids == {picture.id for picture in test_pictures}
+
     @pytest.mark.asyncio
     async def test_get_picture_none_available(
         self,
@@ -1,17 +1,27 @@
+import asyncio
+import io
 import json
+import shutil
 from datetime import datetime
 from pathlib import Path
 from typing import AsyncGenerator
+from unittest import mock
 from zipfile import ZipFile
 
 import aiofiles
 import pytest
 import pytest_asyncio
+from dataset_cache import dataset_cache
 from enums import PictureRetrieveLimits, PictureType
 from httpx import AsyncClient
+from image_cache import ImageCache, image_cache
 from models import Picture
+from moto import mock_aws
 from postgres.database import get_db
-from postgres.db_models import DBPicture
+from postgres.db_models import DBPicture, DBPictureMetadata
+from profiler import profile_store
+from prometheus_client import REGISTRY
+from storage import PackedLocation, S3PictureStorage, picture_storage
 
 from waterbowl_api.app import app
 
@@ -31,6 +41,21 @@ async def test_client(override_get_db) -> AsyncClient:
         yield async_client
 
 
+@pytest_asyncio.fixture
+async def concurrent_test_client(committed_postgres) -> AsyncClient:
+    async def _override():
+        db = committed_postgres()
+        try:
+            yield db
+        finally:
+            await db.close()
+
+    app.dependency_overrides[get_db] = _override
+    async with AsyncClient(app=app, base_url="http://parakeet.squak") as async_client:
+        yield async_client
+    app.dependency_overrides.pop(get_db)
+
+
 @pytest.mark.usefixtures("mock_picture_service_dirs")
 class TestRoutes:
     @pytest.mark.asyncio
@@ -56,7 +81,55 @@ class TestRoutes:
         picture = Picture(**pictures_response.json())
         assert picture.picture_timestamp.timestamp() == data.get("timestamp")
         for expected_picture in [picture.waterbowl_picture, picture.food_picture]:
-            assert Path(expected_picture) in test_picture_storage.glob("*.jpeg")
+            assert Path(expected_picture) in test_picture_storage.rglob("*.jpeg")
+
+    @pytest.mark.asyncio
+    async def test_upload_picture_batch(
+        self,
+        test_client: AsyncClient,
+        test_raw_picture_file: Path,
+        test_picture_storage: Path,
+        postgres,
+    ):
+        # Offsets the metadata ids from the picture ids, so a mismatched pairing would show
+        postgres.add(DBPictureMetadata())
+        await postgres.flush()
+        timestamps = [datetime.now().timestamp() + offset for offset in range(3)]
+        picture_data = test_raw_picture_file.read_bytes()
+        files = [
+            ("pictures", (f"frame_{i}.jpeg", picture_data, "image/jpeg"))
+            for i in range(len(timestamps))
+        ]
+        pictures_response = await test_client.post(
+            "/pictures/batch", data={"timestamps": timestamps}, files=files
+        )
+        assert pictures_response.status_code == 200
+        pictures = [Picture(**picture) for picture in pictures_response.json()]
+        assert [
+            picture.picture_timestamp.timestamp() for picture in pictures
+        ] == timestamps
+        assert len({picture.id for picture in pictures}) == len(timestamps)
+        stored_pictures = list(test_picture_storage.rglob("*.jpeg"))
+        assert len(stored_pictures) == 2 * len(timestamps)
+        for picture in pictures:
+            db_picture = await postgres.get(DBPicture, picture.id)
+            assert db_picture.picture_metadata.id == db_picture.metadata_id
+            assert Path(db_picture.waterbowl_picture) in stored_pictures
+            assert Path(db_picture.food_picture) in stored_pictures
+            assert db_picture.picture_metadata.human_water_yes == 0
+
+    @pytest.mark.asyncio
+    async def test_upload_picture_batch_needs_a_timestamp_per_picture(
+        self, test_client: AsyncClient, test_raw_picture_file: Path
+    ):
+        picture_data = test_raw_picture_file.read_bytes()
+        files = [("pictures", (f"frame_{i}.jpeg", picture_data)) for i in range(2)]
+        pictures_response = await test_client.post(
+            "/pictures/batch",
+            data={"timestamps": [datetime.now().timestamp()]},
+            files=files,
+        )
+        assert pictures_response.status_code == 422
 
     @pytest.mark.asyncio
     async def test_multiple_uploads(
@@ -86,7 +159,7 @@ class TestRoutes:
             picture_2.food_picture,
         ]
         stored_pictures_locations = [
-            str(picture_loc) for picture_loc in test_picture_storage.glob("*.jpeg")
+            str(picture_loc) for picture_loc in test_picture_storage.rglob("*.jpeg")
         ]
         assert len(saved_picture_locations) == len(stored_pictures_locations)
         for picture_location in [
@@ -107,6 +180,261 @@ class TestRoutes:
         returned_picture = json.loads(pictures_response.headers.get("PictureMetadata"))
         assert returned_picture["id"] == test_picture.id
 
+    @pytest.mark.asyncio
+    async def test_get_random_picture_is_cached(
+        self, test_client: AsyncClient, add_multiple_pictures
+    ):
+        test_pictures = await add_multiple_pictures(num_pictures=3)
+        pictures_response = await test_client.get("/pictures/")
+        served_id = json.loads(pictures_response.headers.get("PictureMetadata"))["id"]
+        [served_picture] = [
+            picture for picture in test_pictures if picture.id == served_id
+        ]
+        picture_data = Path(served_picture.waterbowl_picture).read_bytes()
+        assert pictures_response.content == picture_data
+        assert pictures_response.headers["Content-Type"] == "image/jpeg"
+        assert pictures_response.headers["Content-Length"] == str(len(picture_data))
+        assert pictures_response.headers["ETag"] == ImageCache.make_etag(picture_data)
+        assert served_picture.waterbowl_picture in image_cache
+
+        # The queue's remaining candidates are read into the cache after the response is sent
+        for picture in test_pictures:
+            if picture.id != served_id:
+                assert picture.waterbowl_picture in image_cache
+                assert picture.food_picture in image_cache
+
+    @pytest.mark.asyncio
+    async def test_get_picture_image(
+        self, test_client: AsyncClient, add_picture: AsyncGenerator[DBPicture, None]
+    ):
+        test_picture = await add_picture()
+        picture_data = Path(test_picture.food_picture).read_bytes()
+        params = {"picture_type": f"{PictureType.FOOD_BOWL}"}
+        image_response = await test_client.get(
+            f"/pictures/{test_picture.id}/image", params=params
+        )
+        assert image_response.status_code == 200
+        assert image_response.content == picture_data
+        assert image_response.headers["Content-Type"] == "image/jpeg"
+        assert "immutable" in image_response.headers["Cache-Control"]
+        etag = image_response.headers["ETag"]
+        last_modified = image_response.headers["Last-Modified"]
+
+        not_modified_response = await test_client.get(
+            f"/pictures/{test_picture.id}/image",
+            params=params,
+            headers={"If-None-Match": etag},
+        )
+        assert not_modified_response.status_code == 304
+        assert not_modified_response.content == b""
+        not_modified_response = await test_client.get(
+            f"/pictures/{test_picture.id}/image",
+            params=params,
+            headers={"If-Modified-Since": last_modified},
+        )
+        assert not_modified_response.status_code == 304
+
+        range_response = await test_client.get(
+            f"/pictures/{test_picture.id}/image",
+            params=params,
+            headers={"Range": "bytes=0-99"},
+        )
+        assert range_response.status_code == 206
+        assert range_response.content == picture_data[:100]
+        assert (
+            range_response.headers["Content-Range"] == f"bytes 0-99/{len(picture_data)}"
+        )
+
+        water_response = await test_client.get(f"/pictures/{test_picture.id}/image")
+        assert (
+            water_response.content == Path(test_picture.waterbowl_picture).read_bytes()
+        )
+        assert water_response.headers["ETag"] != etag
+
+        missing_response = await test_client.get(
+            f"/pictures/{test_picture.id + 1}/image"
+        )
+        assert missing_response.status_code == 404
+
+    @pytest.mark.asyncio
+    async def test_pictures_sent_from_disk_without_image_cache(
+        self, test_client: AsyncClient, add_picture: AsyncGenerator[DBPicture, None]
+    ):
+        test_picture = await add_picture()
+        picture_data = Path(test_picture.waterbowl_picture).read_bytes()
+        with mock.patch("blueprint.image_cache", ImageCache(max_bytes=0)):
+            image_response = await test_client.get(f"/pictures/{test_picture.id}/image")
+            range_response = await test_client.get(
+                f"/pictures/{test_picture.id}/image", headers={"Range": "bytes=0-9"}
+            )
+            cached_response = await test_client.get(
+                f"/pictures/{test_picture.id}/image",
+                headers={"If-None-Match": image_response.headers["ETag"]},
+            )
+            pictures_response = await test_client.get("/pictures/")
+        assert image_response.status_code == 200
+        assert image_response.content == picture_data
+        assert range_response.status_code == 206
+        assert range_response.content == picture_data[:10]
+        assert cached_response.status_code == 304
+        assert pictures_response.status_code == 200
+        assert pictures_response.content == picture_data
+        assert pictures_response.headers["ETag"] == image_response.headers["ETag"]
+        assert len(image_cache) == 0
+
+    @pytest.mark.asyncio
+    async def test_pictures_redirect_to_object_storage(
+        self, test_client: AsyncClient, add_picture: AsyncGenerator[DBPicture, None]
+    ):
+        test_picture = await add_picture(
+            water_bowl="s3://pictures/crops/water.jpeg",
+            food_bowl="s3://pictures/crops/food.jpeg",
+        )
+        with mock_aws():
+            s3_storage = S3PictureStorage(bucket="pictures", region="us-east-1")
+            with mock.patch("blueprint.picture_storage", s3_storage), mock.patch(
+                "blueprint.PICTURE_REDIRECTS", True
+            ):
+                image_response = await test_client.get(
+                    f"/pictures/{test_picture.id}/image"
+                )
+                pictures_response = await test_client.get("/pictures/")
+        assert image_response.status_code == 307
+        assert "/crops/water.jpeg?" in image_response.headers["Location"]
+        assert pictures_response.status_code == 307
+        assert "/crops/water.jpeg?" in pictures_response.headers["Location"]
+        assert (
+            json.loads(pictures_response.headers["PictureMetadata"])["id"]
+            == test_picture.id
+        )
+
+    @pytest.mark.asyncio
+    async def test_local_pictures_are_not_redirected_to_object_storage(
+        self, test_client: AsyncClient, add_picture: AsyncGenerator[DBPicture, None]
+    ):
+        test_picture = await add_picture(
+            water_bowl="pictures/2024/01/01/00/water_1.jpeg",
+            food_bowl="pictures/2024/01/01/00/food_1.jpeg",
+        )
+        with mock_aws():
+            s3_storage = S3PictureStorage(bucket="pictures", region="us-east-1")
+            with mock.patch("blueprint.picture_storage", s3_storage), mock.patch(
+                "image_cache.picture_storage", s3_storage
+            ), mock.patch("blueprint.PICTURE_REDIRECTS", True):
+                image_response = await test_client.get(
+                    f"/pictures/{test_picture.id}/image"
+                )
+                pictures_response = await test_client.get("/pictures/")
+        assert image_response.status_code == 404
+        assert pictures_response.status_code == 404
+
+    @pytest.mark.asyncio
+    async def test_batch_pictures_from_object_storage(
+        self,
+        test_client: AsyncClient,
+        add_picture: AsyncGenerator[DBPicture, None],
+        test_water_bowl_picture_file: Path,
+    ):
+        await add_picture(
+            water_bowl="s3://pictures/crops/water.jpeg",
+            food_bowl="s3://pictures/crops/food.jpeg",
+            human_water_yes=1,
+            water_in_bowl=True,
+        )
+        with mock_aws():
+            s3_storage = S3PictureStorage(bucket="pictures", region="us-east-1")
+            s3_storage._client.create_bucket(Bucket="pictures")
+            s3_storage._client.put_object(
+                Bucket="pictures",
+                Key="crops/water.jpeg",
+                Body=test_water_bowl_picture_file.read_bytes(),
+            )
+            with mock.patch("blueprint.picture_storage", s3_storage), mock.patch(
+                "packaging_service.picture_storage", s3_storage
+            ):
+                pictures_response = await test_client.get(
+                    "/batch-pictures/", params={"pictureType": "water_bowl"}
+                )
+        assert pictures_response.status_code == 200
+        with ZipFile(io.BytesIO(pictures_response.content)) as open_collection:
+            assert (
+                open_collection.read("water_bowl_true/water.jpeg")
+                == test_water_bowl_picture_file.read_bytes()
+            )
+
+    @pytest.mark.asyncio
+    async def test_packed_pictures(
+        self,
+        test_client: AsyncClient,
+        add_picture: AsyncGenerator[DBPicture, None],
+        test_water_bowl_picture_file: Path,
+        test_food_bowl_picture_file: Path,
+    ):
+        pack = picture_storage.create_pack()
+        water_offset, water_length = pack.append(str(test_water_bowl_picture_file))
+        food_offset, food_length = pack.append(str(test_food_bowl_picture_file))
+        pack.seal(picture_storage.pack_path(1))
+        test_picture = await add_picture(
+            water_bowl=str(PackedLocation(1, water_offset, water_length, "water.jpeg")),
+            food_bowl=str(PackedLocation(1, food_offset, food_length, "food.jpeg")),
+            human_water_yes=1,
+            water_in_bowl=True,
+        )
+
+        image_response = await test_client.get(
+            f"/pictures/{test_picture.id}/image",
+            params={"picture_type": PictureType.FOOD_BOWL},
+        )
+        assert image_response.status_code == 200
+        assert image_response.content == test_food_bowl_picture_file.read_bytes()
+        pictures_response = await test_client.get(
+            "/batch-pictures/", params={"pictureType": "water_bowl"}
+        )
+        assert pictures_response.status_code == 200
+        with ZipFile(io.BytesIO(pictures_response.content)) as open_collection:
+            assert (
+                open_collection.read("water_bowl_true/water.jpeg")
+                == test_water_bowl_picture_file.read_bytes()
+            )
+
+    @pytest.mark.asyncio
+    async def test_get_random_picture_serves_distinct_pictures(
+        self, test_client: AsyncClient, add_multiple_pictures
+    ):
+        test_pictures = await add_multiple_pictures(num_pictures=5)
+        served_ids = []
+        for _ in test_pictures:
+            pictures_response = await test_client.get("/pictures/")
+            assert pictures_response.status_code == 200
+            served_ids.append(
+                json.loads(pictures_response.headers.get("PictureMetadata"))["id"]
+            )
+        assert sorted(served_ids) == sorted(picture.id for picture in test_pictures)
+
+        # Once everything has been handed out recently, pictures are still served rather than nothing
+        pictures_response = await test_client.get("/pictures/")
+        assert pictures_response.status_code == 200
+
+    @pytest.mark.asyncio
+    async def test_annotated_picture_leaves_prefetch_queue(
+        self, test_client: AsyncClient, add_multiple_pictures
+    ):
+        test_pictures = await add_multiple_pictures(num_pictures=3)
+        pictures_response = await test_client.get("/pictures/")
+        served_id = json.loads(pictures_response.headers.get("PictureMetadata"))["id"]
+        for picture in test_pictures:
+            if picture.id != served_id:
+                patch_response = await test_client.patch(
+                    f"/pictures/{picture.id}/", json={"human_water_yes": 1}
+                )
+                assert patch_response.status_code == 200
+
+        pictures_response = await test_client.get("/pictures/")
+        assert (
+            json.loads(pictures_response.headers.get("PictureMetadata"))["id"]
+            == served_id
+        )
+
     @pytest.mark.asyncio
     async def test_get_random_picture_with_limit(
         self,
@@ -164,6 +492,40 @@ class TestRoutes:
         )
         assert test_picture.picture_metadata.human_water_yes == 4
 
+    @pytest.mark.asyncio
+    async def test_annotate_pictures_batch(
+        self, test_client: AsyncClient, add_multiple_pictures, postgres
+    ):
+        test_pictures = await add_multiple_pictures(num_pictures=2)
+        missing_picture_id = max(picture.id for picture in test_pictures) + 1
+        annotations = [
+            {"picture_id": test_pictures[0].id, "human_water_yes": 1},
+            {"picture_id": missing_picture_id, "human_water_yes": 1},
+            {"picture_id": test_pictures[1].id, "human_water_no": 1},
+            {"picture_id": test_pictures[0].id, "human_water_yes": 1},
+        ]
+        batch_response = await test_client.post(
+            "/annotations/batch", json={"annotations": annotations}
+        )
+        assert batch_response.status_code == 200
+        assert batch_response.json() == [
+            {"picture_id": test_pictures[0].id, "status": "updated"},
+            {"picture_id": missing_picture_id, "status": "not_found"},
+            {"picture_id": test_pictures[1].id, "status": "updated"},
+            {"picture_id": test_pictures[0].id, "status": "updated"},
+        ]
+        await postgres.refresh(test_pictures[0].picture_metadata)
+        assert test_pictures[0].picture_metadata.human_water_yes == 2
+
+    @pytest.mark.asyncio
+    async def test_annotate_pictures_batch_rejects_empty_batch(
+        self, test_client: AsyncClient
+    ):
+        batch_response = await test_client.post(
+            "/annotations/batch", json={"annotations": []}
+        )
+        assert batch_response.status_code == 422
+
     @pytest.mark.asyncio
     async def test_get_single_picture_returns_404(
         self,
@@ -241,3 +603,294 @@ class TestRoutes:
             filenames.remove(Path(expected_positive_picture.waterbowl_picture).name)
             assert Path(expected_negative_picture.waterbowl_picture).name in filenames
             assert "picture_data.csv" in filenames
+
+
+@pytest.mark.usefixtures("mock_picture_service_dirs")
+class TestConcurrentRoutes:
+    @pytest.mark.asyncio
+    async def test_parallel_batch_downloads(
+        self,
+        concurrent_test_client,
+        add_committed_picture,
+        test_water_bowl_picture_file,
+        tmp_path,
+    ):
+        async def _add_unique_picture(index: int, **kwargs) -> DBPicture:
+            water_bowl = tmp_path.joinpath(f"water_{index}.jpeg")
+            shutil.copy(test_water_bowl_picture_file, water_bowl)
+            return await add_committed_picture(water_bowl=str(water_bowl), **kwargs)
+
+        positive_pictures = [
+            await _add_unique_picture(i, human_water_yes=1, water_in_bowl=True)
+            for i in range(3)
+        ]
+        negative_pictures = [
+            await _add_unique_picture(i + 3, human_water_no=1, water_in_bowl=False)
+            for i in range(3)
+        ]
+
+        responses = await asyncio.gather(
+            *[
+                concurrent_test_client.get(
+                    "/batch-pictures/", params={"pictureType": "water_bowl"}
+                )
+                for _ in range(20)
+            ]
+        )
+
+        dataset_names = set()
+        for pictures_response in responses:
+            assert pictures_response.status_code == 200
+            dataset_names.add(pictures_response.headers["Content-Disposition"])
+            with ZipFile(io.BytesIO(pictures_response.read())) as open_collection:
+                assert open_collection.testzip() is None
+                names = open_collection.namelist()
+                assert (
+                    len([name for name in names if name.startswith("water_bowl_true/")])
+                    == len(positive_pictures) + 1
+                )
+                assert (
+                    len(
+                        [name for name in names if name.startswith("water_bowl_false/")]
+                    )
+                    == len(negative_pictures) + 1
+                )
+                picture_data = open_collection.read("picture_data.csv").decode()
+                assert len(picture_data.strip().splitlines()) == 1 + len(
+                    positive_pictures
+                ) + len(negative_pictures)
+        assert len(dataset_names) == len(responses)
+
+    @pytest.mark.asyncio
+    async def test_parallel_votes_are_not_lost(
+        self, concurrent_test_client, add_committed_picture, committed_postgres
+    ):
+        test_picture = await add_committed_picture()
+        votes = [{"human_water_yes": 1, "human_cat_no": 1}] * 60 + [
+            {"human_water_no": 1, "human_cat_yes": 1}
+        ] * 40
+
+        responses = await asyncio.gather(
+            *[
+                concurrent_test_client.patch(f"/pictures/{test_picture.id}/", json=vote)
+                for vote in votes
+            ]
+        )
+
+        assert all(response.status_code == 200 for response in responses)
+        async with committed_postgres() as session:
+            metadata = await session.get(DBPictureMetadata, test_picture.metadata_id)
+        assert metadata.human_water_yes == 60
+        assert metadata.human_water_no == 40
+        assert metadata.human_cat_yes == 40
+        assert metadata.human_cat_no == 60
+        assert metadata.water_in_bowl is True
+        assert metadata.cat_at_bowl is False
+
+
+@pytest.mark.usefixtures("mock_picture_service_dirs")
+class TestQueryCounts:
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize(
+        "method, path, make_body, missing_status",
+        [
+            ("GET", "/pictures/{picture_id}/", lambda _: None, 404),
+            ("GET", "/pictures/{picture_id}/metadata/", lambda _: None, 404),
+            (
+                "PATCH",
+                "/pictures/{picture_id}/",
+                lambda _: {"human_water_yes": 1},
+                404,
+            ),
+            (
+                "POST",
+                "/annotations/batch",
+                lambda picture_id: {
+                    "annotations": [{"picture_id": picture_id, "human_cat_no": 1}]
+                },
+                200,
+            ),
+        ],
+    )
+    @pytest.mark.parametrize("picture_exists", [True, False])
+    async def test_endpoints_run_one_query(
+        self,
+        concurrent_test_client,
+        add_committed_picture,
+        executed_statements,
+        method,
+        path,
+        make_body,
+        missing_status,
+        picture_exists,
+    ):
+        test_picture = await add_committed_picture()
+        picture_id = test_picture.id if picture_exists else test_picture.id + 1
+        executed_statements.clear()
+
+        response = await concurrent_test_client.request(
+            method, path.format(picture_id=picture_id), json=make_body(picture_id)
+        )
+
+        assert response.status_code == (200 if picture_exists else missing_status)
+        assert len(executed_statements) == 1, executed_statements
+
+    @pytest.mark.asyncio
+    async def test_upload_runs_one_query(
+        self,
+        concurrent_test_client,
+        committed_postgres,
+        executed_statements,
+        test_raw_picture_file: Path,
+    ):
+        with open(test_raw_picture_file, "rb") as test_picture:
+            pictures_response = await concurrent_test_client.post(
+                "/pictures/",
+                data={"timestamp": datetime.now().timestamp()},
+                files={"picture": test_picture},
+            )
+        assert pictures_response.status_code == 200
+        assert len(executed_statements) == 1, executed_statements
+
+
+class TestMetrics:
+    @pytest.mark.asyncio
+    async def test_requests_are_labelled_with_route_templates(
+        self, test_client: AsyncClient
+    ):
+        labels = {"method": "GET", "route": "/pictures/{picture_id}/", "status": "404"}
+        requests_before = (
+            REGISTRY.get_sample_value("waterbowl_http_request_seconds_count", labels)
+            or 0
+        )
+        for picture_id in [1001, 1002]:
+            pictures_response = await test_client.get(f"/pictures/{picture_id}/")
+            assert pictures_response.status_code == 404
+
+        assert (
+            REGISTRY.get_sample_value("waterbowl_http_request_seconds_count", labels)
+            == requests_before + 2
+        )
+        assert (
+            REGISTRY.get_sample_value(
+                "waterbowl_http_requests_in_flight",
+                {"method": "GET", "route": "/pictures/{picture_id}/"},
+            )
+            == 0
+        )
+
+    @pytest.mark.asyncio
+    async def test_metrics_endpoint(self, test_client: AsyncClient):
+        await test_client.get("/pictures/1001/")
+        metrics_response = await test_client.get("/metrics/")
+        assert metrics_response.status_code == 200
+        for metric in [
+            "waterbowl_http_request_seconds",
+            "waterbowl_db_query_seconds",
+            "waterbowl_db_pool_checked_out",
+        ]:
+            assert metric in metrics_response.text
+
+    @pytest.mark.asyncio
+    async def test_profiles_can_be_listed_and_downloaded(
+        self, test_client: AsyncClient, tmp_path
+    ):
+        with mock.patch.object(profile_store, "_profiles_dir", tmp_path), mock.patch(
+            "blueprint.PROFILING_ENABLED", True
+        ):
+            profile_store.save("20240101_GET_pictures_1500ms", "MainThread;main 3\n")
+            profiles_response = await test_client.get("/profiles/")
+            assert profiles_response.json() == [
+                {"name": "20240101_GET_pictures_1500ms.folded", "size": 18}
+            ]
+            profile_response = await test_client.get(
+                "/profiles/20240101_GET_pictures_1500ms.folded"
+            )
+            assert profile_response.text == "MainThread;main 3\n"
+            missing_response = await test_client.get("/profiles/missing.folded")
+            assert missing_response.status_code == 404
+
+    @pytest.mark.asyncio
+    async def test_profiles_are_hidden_while_profiling_is_off(
+        self, test_client: AsyncClient, tmp_path
+    ):
+        with mock.patch.object(profile_store, "_profiles_dir", tmp_path), mock.patch(
+            "blueprint.PROFILING_ENABLED", False
+        ):
+            profile_store.save("20240101_GET_pictures_1500ms", "MainThread;main 3\n")
+            assert (await test_client.get("/profiles/")).status_code == 404
+            profile_response = await test_client.get(
+                "/profiles/20240101_GET_pictures_1500ms.folded"
+            )
+            assert profile_response.status_code == 404
+
+
+@pytest.fixture
+def mock_dataset_cache_dir(tmp_path):
+    with mock.patch.object(dataset_cache, "_cache_dir", tmp_path.joinpath("cache")):
+        yield tmp_path.joinpath("cache")
+
+
+@pytest.mark.usefixtures("mock_picture_service_dirs")
+class TestDatasetCache:
+    @pytest.mark.asyncio
+    async def test_seeded_batch_pictures_are_cached(
+        self, test_client, add_picture, mock_dataset_cache_dir
+    ):
+        await add_picture(human_water_yes=1, water_in_bowl=True)
+        await add_picture(human_water_no=1, water_in_bowl=False)
+        params = {"seed": 42}
+
+        first_response = await test_client.get("/batch-pictures/", params=params)
+        assert first_response.status_code == 200
+        etag = first_response.headers["ETag"]
+        cached_archives = list(mock_dataset_cache_dir.glob("*.zip"))
+        assert len(cached_archives) == 1
+
+        second_response = await test_client.get("/batch-pictures/", params=params)
+        assert second_response.status_code == 200
+        assert second_response.headers["ETag"] == etag
+        assert second_response.read() == first_response.read()
+        with ZipFile(io.BytesIO(second_response.read())) as open_collection:
+            assert open_collection.testzip() is None
+
+        not_modified_response = await test_client.get(
+            "/batch-pictures/", params=params, headers={"If-None-Match": etag}
+        )
+        assert not_modified_response.status_code == 304
+        assert not_modified_response.headers["ETag"] == etag
+
+        other_seed_response = await test_client.get(
+            "/batch-pictures/", params={"seed": 7}
+        )
+        assert other_seed_response.headers["ETag"] != etag
+        assert len(list(mock_dataset_cache_dir.glob("*.zip"))) == 2
+
+    @pytest.mark.asyncio
+    async def test_seeded_batch_pictures_change_with_annotations(
+        self, test_client, add_picture, mock_dataset_cache_dir
+    ):
+        test_picture = await add_picture(human_water_yes=1, water_in_bowl=True)
+        params = {"seed": 42}
+        first_response = await test_client.get("/batch-pictures/", params=params)
+        etag = first_response.headers["ETag"]
+
+        await test_client.patch(
+            f"/pictures/{test_picture.id}/", json={"human_water_yes": 1}
+        )
+
+        modified_response = await test_client.get(
+            "/batch-pictures/", params=params, headers={"If-None-Match": etag}
+        )
+        assert modified_response.status_code == 200
+        assert modified_response.headers["ETag"] != etag
+
+    @pytest.mark.asyncio
+    async def test_unseeded_batch_pictures_are_not_cached(
+        self, test_client, add_picture, mock_dataset_cache_dir
+    ):
+        await add_picture(human_water_yes=1, water_in_bowl=True)
+        pictures_response = await test_client.get("/batch-pictures/")
+        assert pictures_response.status_code == 200
+        assert "ETag" not in pictures_response.headers
+        assert not mock_dataset_cache_dir.exists()
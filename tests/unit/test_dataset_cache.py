@@ -0,0 +1,71 @@
+import os
+from pathlib import Path
+
+import pytest
+from dataset_cache import DatasetCache
+
+
+@pytest.fixture
+def cache_dir(tmp_path) -> Path:
+    yield tmp_path.joinpath("cache")
+
+
+def test_make_key_is_stable():
+    assert DatasetCache.make_key(seed=1, limit=100) == DatasetCache.make_key(
+        limit=100, seed=1
+    )
+    assert DatasetCache.make_key(seed=1, limit=100) != DatasetCache.make_key(
+        seed=2, limit=100
+    )
+
+
+@pytest.mark.parametrize(
+    "if_none_match, matches",
+    [
+        (None, False),
+        ('"abc"', True),
+        ('W/"abc"', True),
+        ('"other", "abc"', True),
+        ("*", True),
+        ('"other"', False),
+    ],
+)
+def test_etag_matches(if_none_match, matches):
+    assert DatasetCache.etag_matches(if_none_match, "abc") is matches
+
+
+@pytest.mark.asyncio
+async def test_get_or_build_caches_archive(cache_dir):
+    cache = DatasetCache(cache_dir=cache_dir, max_bytes=1024)
+    assert cache.get("key") is None
+    archive = await cache.get_or_build("key", iter([b"zip", b"data"]))
+    assert archive.read_bytes() == b"zipdata"
+    assert cache.get("key") == archive
+    # Already cached, so the new chunks are never read
+    assert await cache.get_or_build("key", iter([b"other"])) == archive
+    assert archive.read_bytes() == b"zipdata"
+    assert not list(cache_dir.glob("*.partial"))
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_archives_are_evicted(cache_dir):
+    cache = DatasetCache(cache_dir=cache_dir, max_bytes=25)
+    first_archive = await cache.get_or_build("first", iter([b"0" * 10]))
+    second_archive = await cache.get_or_build("second", iter([b"0" * 10]))
+    os.utime(first_archive, (1, 1))
+    os.utime(second_archive, (2, 2))
+    # Reading the first archive makes the second one the least recently used
+    cache.get("first")
+
+    third_archive = await cache.get_or_build("third", iter([b"0" * 10]))
+
+    assert first_archive.exists()
+    assert not second_archive.exists()
+    assert third_archive.exists()
+
+
+@pytest.mark.asyncio
+async def test_newest_archive_is_kept_even_when_too_large(cache_dir):
+    cache = DatasetCache(cache_dir=cache_dir, max_bytes=5)
+    archive = await cache.get_or_build("large", iter([b"0" * 10]))
+    assert archive.exists()
@@ -0,0 +1,136 @@
+from email.utils import formatdate
+
+import pytest
+from http_caching import (
+    IMMUTABLE_CACHE_CONTROL,
+    RangeNotSatisfiableException,
+    byte_range,
+    file_etag,
+    immutable_image_response,
+)
+from image_cache import CachedImage, ImageCache
+from storage import PictureFileRange
+from zero_copy import ZeroCopyFileResponse
+
+LAST_MODIFIED = 1_700_000_000.5
+
+
+@pytest.fixture
+def image() -> CachedImage:
+    data = bytes(range(100))
+    yield CachedImage(
+        data=data, etag=ImageCache.make_etag(data), last_modified=LAST_MODIFIED
+    )
+
+
+@pytest.mark.parametrize(
+    "range_header, expected",
+    [
+        ("bytes=0-9", (0, 9)),
+        ("bytes=90-", (90, 99)),
+        ("bytes=90-500", (90, 99)),
+        ("bytes=-10", (90, 99)),
+        ("bytes=-500", (0, 99)),
+        ("bytes=10-5", None),
+        ("bytes=0-1,5-6", None),
+        ("bytes=-", None),
+        ("items=0-9", None),
+    ],
+)
+def test_byte_range(range_header, expected):
+    assert byte_range(range_header, 100) == expected
+
+
+@pytest.mark.parametrize("range_header", ["bytes=100-", "bytes=-0"])
+def test_unsatisfiable_byte_range(range_header):
+    with pytest.raises(RangeNotSatisfiableException):
+        byte_range(range_header, 100)
+
+
+def test_full_response_is_cacheable(image):
+    response = immutable_image_response(image)
+    assert response.status_code == 200
+    assert response.body == image.data
+    assert response.headers["ETag"] == image.etag
+    assert response.headers["Cache-Control"] == IMMUTABLE_CACHE_CONTROL
+    assert response.headers["Last-Modified"] == formatdate(LAST_MODIFIED, usegmt=True)
+    assert response.headers["Content-Length"] == "100"
+
+
+@pytest.mark.parametrize(
+    "conditions, status_code",
+    [
+        ({"if_none_match": '"other", W/"{etag}"'}, 304),
+        ({"if_none_match": '"other"'}, 200),
+        ({"if_modified_since": formatdate(LAST_MODIFIED, usegmt=True)}, 304),
+        ({"if_modified_since": formatdate(LAST_MODIFIED - 1, usegmt=True)}, 200),
+        ({"if_modified_since": "yesterday"}, 200),
+        # If-None-Match wins over If-Modified-Since
+        (
+            {
+                "if_none_match": '"other"',
+                "if_modified_since": formatdate(LAST_MODIFIED, usegmt=True),
+            },
+            200,
+        ),
+    ],
+)
+def test_conditional_requests(image, conditions, status_code):
+    conditions = {
+        header: value.format(etag=image.etag.strip('"'))
+        for header, value in conditions.items()
+    }
+    response = immutable_image_response(image, **conditions)
+    assert response.status_code == status_code
+    assert response.headers["ETag"] == image.etag
+    if status_code == 304:
+        assert response.body == b""
+        assert "Content-Length" not in response.headers
+
+
+def test_range_requests(image):
+    response = immutable_image_response(image, range_header="bytes=10-19")
+    assert response.status_code == 206
+    assert response.body == image.data[10:20]
+    assert response.headers["Content-Range"] == "bytes 10-19/100"
+    assert response.headers["Content-Length"] == "10"
+
+    response = immutable_image_response(image, range_header="bytes=200-")
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */100"
+
+
+def test_if_range_only_applies_to_the_same_picture(image):
+    response = immutable_image_response(
+        image, range_header="bytes=0-9", if_range=image.etag
+    )
+    assert response.status_code == 206
+    response = immutable_image_response(
+        image, range_header="bytes=0-9", if_range='"other"'
+    )
+    assert response.status_code == 200
+    assert response.body == image.data
+
+
+def test_picture_files_are_sent_from_disk(tmp_path):
+    pack_path = tmp_path.joinpath("00000001.pack")
+    pack_path.write_bytes(bytes(range(200)))
+    picture_file = PictureFileRange(
+        path=pack_path, offset=100, size=100, last_modified=LAST_MODIFIED
+    )
+
+    response = immutable_image_response(picture_file)
+    assert isinstance(response, ZeroCopyFileResponse)
+    assert (response.offset, response.size) == (100, 100)
+    assert response.headers["ETag"] == file_etag(picture_file)
+    assert response.headers["Content-Length"] == "100"
+
+    response = immutable_image_response(picture_file, range_header="bytes=10-19")
+    assert response.status_code == 206
+    assert (response.offset, response.size) == (110, 10)
+    assert response.headers["Content-Range"] == "bytes 10-19/100"
+
+    response = immutable_image_response(
+        picture_file, if_none_match=file_etag(picture_file)
+    )
+    assert response.status_code == 304
@@ -0,0 +1,58 @@
+import pytest
+from image_cache import ImageCache
+
+
+@pytest.fixture
+def picture_files(tmp_path):
+    pictures = []
+    for index in range(3):
+        picture = tmp_path.joinpath(f"picture_{index}.jpeg")
+        picture.write_bytes(bytes([index]) * 10)
+        pictures.append(picture)
+    yield pictures
+
+
+@pytest.mark.asyncio
+async def test_load_serves_hits_from_memory(picture_files):
+    cache = ImageCache(max_bytes=100)
+    image = await cache.load(picture_files[0])
+    assert image.data == bytes([0]) * 10
+    assert image.etag == ImageCache.make_etag(image.data)
+
+    picture_files[0].unlink()
+    assert await cache.load(picture_files[0]) == image
+    assert await cache.load(picture_files[0].with_name("missing.jpeg")) is None
+
+
+@pytest.mark.asyncio
+async def test_evicts_least_recently_used_by_size(picture_files):
+    cache = ImageCache(max_bytes=25)
+    await cache.load(picture_files[0])
+    await cache.load(picture_files[1])
+    await cache.load(picture_files[0])
+    await cache.load(picture_files[2])
+
+    assert picture_files[0] in cache
+    assert picture_files[1] not in cache
+    assert picture_files[2] in cache
+    assert cache.size == 20
+
+
+@pytest.mark.asyncio
+async def test_oversized_pictures_are_served_but_not_cached(picture_files):
+    cache = ImageCache(max_bytes=5)
+    assert (await cache.load(picture_files[0])).data == bytes([0]) * 10
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+@pytest.mark.asyncio
+async def test_warm_skips_missing_files(picture_files):
+    cache = ImageCache(max_bytes=100)
+    await cache.warm([picture_files[0], picture_files[0].with_name("missing.jpeg")])
+    assert len(cache) == 1
+    assert picture_files[0] in cache
+
+    disabled_cache = ImageCache(max_bytes=0)
+    await disabled_cache.warm(picture_files)
+    assert len(disabled_cache) == 0
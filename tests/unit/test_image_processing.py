@@ -0,0 +1,82 @@
+from io import BytesIO
+
+import pytest
+import tensorflow as tf
+from enums import (
+    CAMERA_FRAME_HEIGHT,
+    CAMERA_FRAME_WIDTH,
+    CROP_WINDOWS,
+    FOOD_BOWL_CROP,
+    WATER_BOWL_CROP,
+    ImageBackendType,
+)
+from image_processing import ImageBackend, check_crop_windows, get_image_backend
+from PIL import Image
+
+
+@pytest.fixture
+def raw_picture_data(test_raw_picture_file) -> bytes:
+    yield test_raw_picture_file.read_bytes()
+
+
+@pytest.fixture(params=list(ImageBackendType))
+def image_backend(request) -> ImageBackend:
+    yield get_image_backend(request.param)
+
+
+def test_crop_pictures_returns_every_window(raw_picture_data, image_backend):
+    crop_windows = {**CROP_WINDOWS, "cat": [0, 0, 100, 200]}
+    cropped_pictures = image_backend.crop_pictures(raw_picture_data, crop_windows)
+    assert list(cropped_pictures.keys()) == [WATER_BOWL_CROP, FOOD_BOWL_CROP, "cat"]
+    for name, (_, _, crop_height, crop_width) in crop_windows.items():
+        with Image.open(BytesIO(cropped_pictures[name])) as cropped_picture:
+            assert cropped_picture.format == "JPEG"
+            assert cropped_picture.mode == "L"
+            assert cropped_picture.size == (crop_width, crop_height)
+
+
+def test_crop_pictures_without_windows(raw_picture_data, image_backend):
+    assert image_backend.crop_pictures(raw_picture_data, {}) == {}
+
+
+def test_crop_pictures_rejects_windows_off_the_picture(raw_picture_data, image_backend):
+    # The test frame is 2592x1944, so this window runs 100 pixels past its right edge
+    with pytest.raises(ValueError, match="cat"):
+        image_backend.crop_pictures(raw_picture_data, {"cat": [0, 2492, 100, 200]})
+
+
+def test_check_crop_windows():
+    check_crop_windows(CROP_WINDOWS, CAMERA_FRAME_WIDTH, CAMERA_FRAME_HEIGHT)
+    check_crop_windows({"all": [0, 0, 1944, 2592]}, 2592, 1944)
+    for window in [[-1, 0, 10, 10], [0, 0, 0, 10], [1900, 0, 45, 10], [0, 2590, 10, 3]]:
+        with pytest.raises(ValueError):
+            check_crop_windows({"cat": window}, 2592, 1944)
+
+
+def test_tensorflow_crop_pictures_matches_individual_crops(raw_picture_data):
+    cropped_pictures = get_image_backend(ImageBackendType.TENSORFLOW).crop_pictures(
+        raw_picture_data, CROP_WINDOWS
+    )
+    for name, crop_window in CROP_WINDOWS.items():
+        expected_picture = tf.image.encode_jpeg(
+            tf.image.decode_and_crop_jpeg(
+                contents=raw_picture_data, crop_window=crop_window, channels=1
+            ),
+            format="grayscale",
+            quality=100,
+        ).numpy()
+        assert cropped_pictures[name] == expected_picture
+
+
+def test_backends_crop_the_same_region(raw_picture_data):
+    tf_pictures = get_image_backend(ImageBackendType.TENSORFLOW).crop_pictures(
+        raw_picture_data, CROP_WINDOWS
+    )
+    pillow_pictures = get_image_backend(ImageBackendType.PILLOW).crop_pictures(
+        raw_picture_data, CROP_WINDOWS
+    )
+    for name in CROP_WINDOWS:
+        tf_image = tf.cast(tf.io.decode_jpeg(tf_pictures[name]), tf.float32)
+        pillow_image = tf.cast(tf.io.decode_jpeg(pillow_pictures[name]), tf.float32)
+        # Both encoders are lossy, but the same crop should only differ by a few grey levels on average
+        assert float(tf.reduce_mean(tf.abs(tf_image - pillow_image))) < 2.0
@@ -1,7 +1,9 @@
 import csv
+import io
 import json
 import shutil
 from pathlib import Path
+from zipfile import ZIP_STORED, ZipFile
 
 import aiofiles.tempfile
 import pytest
@@ -106,3 +108,65 @@ async def test_generate_multiple_class_archive(test_water_bowl_picture_file: Pat
                     "filename": negative_picture.name,
                     "some": "metadata",
                 }
+
+
+def test_stream_dataset_zip_yields_bounded_chunks(
+    tmp_path: Path, test_water_bowl_picture_file: Path
+):
+    positive_picture = shutil.copy(
+        test_water_bowl_picture_file, tmp_path.joinpath("positive.jpeg")
+    )
+    negative_picture = shutil.copy(
+        test_water_bowl_picture_file, tmp_path.joinpath("negative.jpeg")
+    )
+    picture_metadata = [
+        {"filename": positive_picture.name, "some": "metadata"},
+        {"filename": negative_picture.name, "some": "metadata"},
+    ]
+    chunk_size = 4096
+    chunks = list(
+        ZipPackager.stream_dataset_zip(
+            positive_picture_files=[positive_picture],
+            negative_picture_files=[negative_picture],
+            picture_metadata=picture_metadata,
+            class_name=PictureType.WATER_BOWL,
+            chunk_size=chunk_size,
+        )
+    )
+
+    # Every chunk is at most one read of picture data plus zip headers, never a whole picture
+    assert len(chunks) > 2 * (test_water_bowl_picture_file.stat().st_size // chunk_size)
+    assert all(0 < len(chunk) <= chunk_size + 1024 for chunk in chunks)
+    with ZipFile(io.BytesIO(b"".join(chunks))) as archive:
+        assert archive.testzip() is None
+        assert sorted(archive.namelist()) == [
+            "picture_data.csv",
+            "water_bowl_false/",
+            "water_bowl_false/negative.jpeg",
+            "water_bowl_true/",
+            "water_bowl_true/positive.jpeg",
+        ]
+        for info in archive.infolist():
+            assert info.compress_type == ZIP_STORED
+        assert (
+            archive.read("water_bowl_true/positive.jpeg")
+            == test_water_bowl_picture_file.read_bytes()
+        )
+
+
+@pytest.mark.asyncio
+async def test_generate_dataset_zip_uses_unique_archives(test_water_bowl_picture_file):
+    kwargs = {
+        "positive_picture_files": [test_water_bowl_picture_file],
+        "negative_picture_files": [],
+        "picture_metadata": [{"filename": test_water_bowl_picture_file.name}],
+        "class_name": PictureType.WATER_BOWL,
+    }
+    async with ZipPackager.generate_dataset_zip(**kwargs) as first_dataset:
+        async with ZipPackager.generate_dataset_zip(**kwargs) as second_dataset:
+            assert first_dataset != second_dataset
+            assert first_dataset.parent != second_dataset.parent
+        assert not second_dataset.exists()
+        with ZipFile(first_dataset) as archive:
+            assert archive.testzip() is None
+    assert not first_dataset.exists()
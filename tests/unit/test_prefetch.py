@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from prefetch import UnannotatedPictureQueue
+
+
+def fake_pictures(*picture_ids: int) -> list[SimpleNamespace]:
+    return [
+        SimpleNamespace(
+            id=picture_id,
+            to_dict=lambda picture_id=picture_id: {
+                "id": picture_id,
+                "waterbowl_picture": f"water_{picture_id}.jpeg",
+                "food_picture": f"food_{picture_id}.jpeg",
+            },
+        )
+        for picture_id in picture_ids
+    ]
+
+
+@pytest.fixture
+def mock_get_random_pictures():
+    with mock.patch("prefetch.PictureService") as picture_service:
+        picture_service.return_value.get_random_pictures = mock.AsyncMock()
+        yield picture_service.return_value.get_random_pictures
+
+
+@pytest.mark.asyncio
+async def test_next_refills_and_pops_in_order(mock_get_random_pictures):
+    mock_get_random_pictures.return_value = fake_pictures(1, 2, 3)
+    queue = UnannotatedPictureQueue(size=4, recently_served_size=8)
+
+    assert (await queue.next(db=None))["id"] == 1
+    assert (await queue.next(db=None))["id"] == 2
+    assert len(queue) == 1
+    mock_get_random_pictures.assert_awaited_once()
+    assert mock_get_random_pictures.await_args.kwargs["count"] == 4
+
+
+@pytest.mark.asyncio
+async def test_discarded_pictures_are_skipped(mock_get_random_pictures):
+    mock_get_random_pictures.return_value = fake_pictures(1, 2, 3)
+    queue = UnannotatedPictureQueue(size=4, recently_served_size=8)
+    await queue.refill(db=None)
+
+    queue.discard(1)
+    queue.discard(3)
+    assert queue.pop()["id"] == 2
+    assert queue.pop() is None
+
+
+@pytest.mark.asyncio
+async def test_refill_excludes_queued_and_recently_served(mock_get_random_pictures):
+    mock_get_random_pictures.return_value = fake_pictures(1, 2)
+    queue = UnannotatedPictureQueue(size=4, recently_served_size=1)
+    await queue.refill(db=None)
+    queue.pop()
+    queue.pop()
+
+    mock_get_random_pictures.return_value = fake_pictures(3)
+    await queue.refill(db=None)
+    # Only the most recently served picture is remembered
+    assert mock_get_random_pictures.await_args.kwargs["exclude_ids"] == {2}
+    assert mock_get_random_pictures.await_args.kwargs["count"] == 4
+
+    mock_get_random_pictures.return_value = fake_pictures(4)
+    await queue.refill(db=None)
+    assert mock_get_random_pictures.await_args.kwargs["exclude_ids"] == {2, 3}
+    assert mock_get_random_pictures.await_args.kwargs["count"] == 3
+
+
+def test_needs_refill_at_half_capacity():
+    queue = UnannotatedPictureQueue(size=4, recently_served_size=0)
+    assert queue.needs_refill
+    assert not UnannotatedPictureQueue(size=0, recently_served_size=0).enabled
+
+
+@pytest.mark.asyncio
+async def test_top_up_warms_queued_pictures(mock_get_random_pictures):
+    mock_get_random_pictures.return_value = fake_pictures(1, 2)
+    queue = UnannotatedPictureQueue(size=4, recently_served_size=8)
+    await queue.refill(db=None)
+    queue.discard(2)
+
+    mock_get_random_pictures.return_value = []
+    with mock.patch("prefetch.image_cache.warm") as warm:
+        await queue.top_up(db=None)
+    assert list(warm.call_args.args[0]) == ["water_1.jpeg", "food_1.jpeg"]
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+import pytest
+from httpx import AsyncClient
+from middleware import ProfilingMiddleware
+from profiler import ProfileStore, StackSampler
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+
+def busy_wait(seconds: float) -> None:
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_stack_sampler_records_folded_stacks():
+    sampler = StackSampler(interval=0.001)
+    sampler.start()
+    busy_wait(0.1)
+    folded_stacks = sampler.stop()
+
+    lines = folded_stacks.splitlines()
+    assert lines
+    assert any("busy_wait (test_profiler.py" in line for line in lines)
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert stack.startswith("MainThread;") or ";" in stack
+        assert int(count) > 0
+
+
+def test_profile_store_keeps_newest_profiles(tmp_path):
+    store = ProfileStore(profiles_dir=tmp_path, max_profiles=2)
+    for index in range(3):
+        store.save(f"2024010{index}_GET_pictures_10ms", "main 1\n")
+
+    assert [profile.name for profile in store.list()] == [
+        "20240102_GET_pictures_10ms.folded",
+        "20240101_GET_pictures_10ms.folded",
+    ]
+    assert store.get("20240102_GET_pictures_10ms.folded")
+    assert store.get("20240100_GET_pictures_10ms.folded") is None
+    assert store.get("../20240102_GET_pictures_10ms.folded") is None
+
+
+@pytest.fixture
+def profiled_app(tmp_path):
+    async def slow(request):
+        busy_wait(0.05)
+        return PlainTextResponse("slow")
+
+    async def fast(request):
+        return PlainTextResponse("fast")
+
+    app = Starlette(routes=[Route("/slow", slow), Route("/fast", fast)])
+    store = ProfileStore(profiles_dir=tmp_path, max_profiles=10)
+    app.add_middleware(
+        ProfilingMiddleware,
+        store=store,
+        sample_rate=1,
+        threshold=0.04,
+        interval=0.001,
+    )
+    yield app, store
+
+
+@pytest.mark.asyncio
+async def test_profiling_middleware_saves_slow_requests(profiled_app):
+    app, store = profiled_app
+    async with AsyncClient(app=app, base_url="http://parakeet.squak") as client:
+        assert (await client.get("/fast")).status_code == 200
+        assert store.list() == []
+        assert (await client.get("/slow")).status_code == 200
+
+    [profile] = store.list()
+    assert "_GET_slow_" in profile.name
+    assert "busy_wait" in profile.read_text()
+
+
+@pytest.mark.asyncio
+async def test_profiling_header_forces_a_profile(profiled_app):
+    app, store = profiled_app
+    async with AsyncClient(app=app, base_url="http://parakeet.squak") as client:
+        await client.get("/fast", headers={"X-Profile-Request": "1"})
+
+    [profile] = store.list()
+    assert "_GET_fast_" in profile.name
@@ -0,0 +1,255 @@
+import os
+from datetime import datetime
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from enums import PictureStorageLayout
+from moto import mock_aws
+from storage import (
+    LocalPictureStorage,
+    PackedLocation,
+    PictureFileRange,
+    S3PictureStorage,
+)
+
+TAKEN_AT = datetime(2024, 3, 5, 7, 45)
+
+
+@pytest.mark.asyncio
+async def test_write_pictures_flat(tmp_path):
+    storage = LocalPictureStorage(
+        pictures_dir=tmp_path, layout=PictureStorageLayout.FLAT
+    )
+    saved_pictures = await storage.write_pictures(
+        {"water.jpeg": b"water", "food.jpeg": b"food"}, taken_at=TAKEN_AT
+    )
+
+    assert saved_pictures == {
+        "water.jpeg": str(tmp_path.joinpath("water.jpeg")),
+        "food.jpeg": str(tmp_path.joinpath("food.jpeg")),
+    }
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "food.jpeg",
+        "water.jpeg",
+    ]
+
+    await storage.delete_pictures(*saved_pictures.values())
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.asyncio
+async def test_write_pictures_sharded(tmp_path):
+    storage = LocalPictureStorage(pictures_dir=tmp_path)
+    saved_pictures = await storage.write_pictures(
+        {"water.jpeg": b"water"}, taken_at=TAKEN_AT
+    )
+
+    location = saved_pictures["water.jpeg"]
+    assert location == str(tmp_path.joinpath("2024", "03", "05", "07", "water.jpeg"))
+    assert await storage.existing_pictures([location, f"{location}.missing"]) == {
+        location
+    }
+    data, picture_info = await storage.read(location)
+    assert data == b"water"
+    assert picture_info.size == 5
+    assert picture_info.last_modified == os.stat(location).st_mtime
+    with pytest.raises(FileNotFoundError):
+        await storage.read(f"{location}.missing")
+    assert await storage.file_range(location) == PictureFileRange(
+        path=Path(location),
+        offset=0,
+        size=5,
+        last_modified=picture_info.last_modified,
+    )
+
+
+@pytest.mark.asyncio
+async def test_fsync_is_batched_per_write(tmp_path):
+    storage = LocalPictureStorage(
+        pictures_dir=tmp_path, fsync=True, layout=PictureStorageLayout.FLAT
+    )
+    with mock.patch("storage.os.fsync") as fsync:
+        await storage.write_pictures(
+            {"water.jpeg": b"water", "food.jpeg": b"food"}, taken_at=TAKEN_AT
+        )
+    # One sync per file and a single one for their directory
+    assert fsync.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_failed_write_leaves_nothing_behind(tmp_path):
+    storage = LocalPictureStorage(
+        pictures_dir=tmp_path, layout=PictureStorageLayout.FLAT
+    )
+    with mock.patch("storage.os.replace", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            await storage.write_pictures(
+                {"water.jpeg": b"water", "food.jpeg": b"food"}, taken_at=TAKEN_AT
+            )
+    assert not list(tmp_path.iterdir())
+
+
+def test_relocate_picture_is_repeatable(tmp_path):
+    storage = LocalPictureStorage(pictures_dir=tmp_path)
+    flat_picture = tmp_path.joinpath("water.jpeg")
+    flat_picture.write_bytes(b"water")
+    new_location = storage.location("water.jpeg", TAKEN_AT)
+
+    storage.relocate_picture(str(flat_picture), new_location)
+    storage.relocate_picture(str(flat_picture), new_location)
+    flat_picture.unlink()
+    storage.relocate_picture(str(flat_picture), new_location)
+
+    with open(new_location, "rb") as picture_file:
+        assert picture_file.read() == b"water"
+
+
+def test_packed_location_round_trip():
+    packed = PackedLocation(pack_id=3, offset=512, length=64, filename="water.jpeg")
+
+    assert str(packed) == "pack:3/512/64/water.jpeg"
+    assert PackedLocation.parse(str(packed)) == packed
+    assert Path(str(packed)).name == "water.jpeg"
+    assert PackedLocation.parse("/pictures/water.jpeg") is None
+
+
+@pytest.mark.asyncio
+async def test_packed_pictures(tmp_path):
+    storage = LocalPictureStorage(pictures_dir=tmp_path)
+    saved_pictures = await storage.write_pictures(
+        {"water.jpeg": b"water", "food.jpeg": b"food"}, taken_at=TAKEN_AT
+    )
+    pack = storage.create_pack()
+    water_offset, water_length = pack.append(saved_pictures["water.jpeg"])
+    food_offset, food_length = pack.append(saved_pictures["food.jpeg"])
+    pack.seal(storage.pack_path(1))
+    water = str(PackedLocation(1, water_offset, water_length, "water.jpeg"))
+    food = str(PackedLocation(1, food_offset, food_length, "food.jpeg"))
+    missing = str(PackedLocation(2, 0, 4, "missing.jpeg"))
+
+    assert [path.name for path in tmp_path.joinpath("packs").iterdir()] == [
+        "00000001.pack"
+    ]
+    assert (await storage.read(water))[0] == b"water"
+    assert await storage.file_range(food) == PictureFileRange(
+        path=storage.pack_path(1),
+        offset=food_offset,
+        size=4,
+        last_modified=storage.pack_path(1).stat().st_mtime,
+    )
+    with storage.open_picture(food) as (picture_file, picture_info):
+        assert picture_file.read(2) == b"fo"
+        assert picture_file.read() == b"od"
+        assert picture_info.size == 4
+    assert await storage.existing_pictures([water, food, missing]) == {water, food}
+    assert sorted([food, water], key=storage.read_order) == [water, food]
+    with pytest.raises(FileNotFoundError):
+        await storage.read(missing)
+    with pytest.raises(FileNotFoundError):
+        await storage.file_range(missing)
+
+    # Packed bytes are kept when the picture is deleted, only its originals go
+    await storage.delete_pictures(water, *saved_pictures.values())
+    assert (await storage.read(water))[0] == b"water"
+    assert not any(tmp_path.rglob("*.jpeg"))
+
+
+def test_discarded_pack_leaves_nothing_behind(tmp_path):
+    storage = LocalPictureStorage(pictures_dir=tmp_path)
+    tmp_path.joinpath("water.jpeg").write_bytes(b"water")
+    pack = storage.create_pack()
+    pack.append(str(tmp_path.joinpath("water.jpeg")))
+    pack.truncate(0)
+    assert pack.size == 0
+    pack.discard()
+
+    assert list(tmp_path.joinpath("packs").iterdir()) == []
+
+
+@pytest.fixture
+def s3_storage():
+    with mock_aws():
+        storage = S3PictureStorage(
+            bucket="pictures",
+            prefix="crops/",
+            region="us-east-1",
+            multipart_threshold=5 * 1024 * 1024,
+        )
+        # pylint: disable-next=protected-access
+        storage._client.create_bucket(Bucket="pictures")
+        yield storage
+
+
+@pytest.mark.asyncio
+async def test_s3_storage_round_trip(s3_storage):
+    saved_pictures = await s3_storage.write_pictures(
+        {"water.jpeg": b"water", "food.jpeg": b"food"}, taken_at=TAKEN_AT
+    )
+    location = saved_pictures["water.jpeg"]
+    assert location == "s3://pictures/crops/2024/03/05/07/water.jpeg"
+
+    data, picture_info = await s3_storage.read(location)
+    assert data == b"water"
+    assert picture_info.size == 5
+    assert await s3_storage.existing_pictures(
+        [*saved_pictures.values(), f"{location}.missing", "pictures/water.jpeg"]
+    ) == set(saved_pictures.values())
+    with pytest.raises(FileNotFoundError):
+        await s3_storage.read(f"{location}.missing")
+    with pytest.raises(FileNotFoundError):
+        await s3_storage.read("pictures/water.jpeg")
+
+    await s3_storage.delete_pictures(*saved_pictures.values())
+    assert await s3_storage.existing_pictures(saved_pictures.values()) == set()
+
+
+@pytest.mark.asyncio
+async def test_s3_storage_uploads_large_pictures_in_parts(s3_storage):
+    data = os.urandom(11 * 1024 * 1024)
+    location = (await s3_storage.write_pictures({"large.jpeg": data}, TAKEN_AT))[
+        "large.jpeg"
+    ]
+    # pylint: disable-next=protected-access
+    head = s3_storage._client.head_object(
+        Bucket="pictures", Key="crops/2024/03/05/07/large.jpeg"
+    )
+    # Multipart uploads get an ETag suffixed with their number of parts
+    assert head["ETag"].strip('"').endswith("-3")
+    assert (await s3_storage.read(location))[0] == data
+
+
+@pytest.mark.asyncio
+async def test_s3_storage_removes_uploads_of_a_failed_write(s3_storage):
+    # pylint: disable-next=protected-access
+    upload_fileobj = s3_storage._client.upload_fileobj
+    calls = 0
+
+    def _flaky_upload(*args, **kwargs):
+        nonlocal calls
+        calls += 1
+        if calls == 2:
+            raise OSError("connection reset")
+        return upload_fileobj(*args, **kwargs)
+
+    with mock.patch.object(s3_storage._client, "upload_fileobj", _flaky_upload):
+        with pytest.raises(OSError):
+            await s3_storage.write_pictures(
+                {"water.jpeg": b"water", "food.jpeg": b"food"}, taken_at=TAKEN_AT
+            )
+    # pylint: disable-next=protected-access
+    assert s3_storage._client.list_objects_v2(Bucket="pictures")["KeyCount"] == 0
+
+
+def test_s3_presigned_url(s3_storage):
+    url = s3_storage.presigned_url("s3://pictures/crops/water.jpeg")
+    assert "/crops/water.jpeg?" in url
+    assert "Signature=" in url or "X-Amz-Signature=" in url
+    # Saved before pictures moved to object storage, so there is nothing to sign
+    assert s3_storage.presigned_url("pictures/2024/01/01/00/water_1.jpeg") is None
+    assert (
+        LocalPictureStorage(pictures_dir=Path("pictures")).presigned_url(
+            "pictures/water.jpeg"
+        )
+        is None
+    )
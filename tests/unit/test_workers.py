@@ -0,0 +1,46 @@
+import asyncio
+import threading
+
+import pytest
+from enums import ImageWorkerType
+from workers import ImageWorkerPool, WorkerPoolFullException
+
+
+def _add(first: int, second: int) -> int:
+    return first + second
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "worker_type", [ImageWorkerType.THREAD, ImageWorkerType.PROCESS]
+)
+async def test_submit_returns_result(worker_type: ImageWorkerType):
+    pool = ImageWorkerPool(worker_type=worker_type, max_workers=1, max_queue_size=1)
+    try:
+        assert await pool.submit(_add, 2, 3) == 5
+        assert pool.active_jobs == 0
+    finally:
+        pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_submit_rejects_when_queue_full():
+    pool = ImageWorkerPool(
+        worker_type=ImageWorkerType.THREAD, max_workers=1, max_queue_size=1
+    )
+    release = threading.Event()
+    try:
+        running = asyncio.create_task(pool.submit(release.wait))
+        queued = asyncio.create_task(pool.submit(release.wait))
+        await asyncio.sleep(0)
+        assert pool.active_jobs == 2
+        assert pool.queue_depth == 1
+        with pytest.raises(WorkerPoolFullException):
+            await pool.submit(release.wait)
+        release.set()
+        await asyncio.gather(running, queued)
+        assert pool.active_jobs == 0
+        assert pool.queue_depth == 0
+    finally:
+        release.set()
+        pool.shutdown()
@@ -0,0 +1,77 @@
+import pytest
+from zero_copy import PATHSEND, ZEROCOPYSEND, ZeroCopyFileResponse
+
+DATA = bytes(range(256)) * 1024
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path.joinpath("data.bin")
+    path.write_bytes(DATA)
+    yield path
+
+
+async def send_response(response, extensions=None, method="GET") -> list[dict]:
+    messages = []
+
+    async def _send(message):
+        if message["type"] == ZEROCOPYSEND:
+            # The server reads from the file it is handed, which is closed once the send returns
+            message = {**message, "file": message["file"].read()}
+        messages.append(message)
+
+    scope = {"type": "http", "method": method, "extensions": extensions or {}}
+    await response(scope, None, _send)
+    return messages
+
+
+@pytest.mark.asyncio
+async def test_chunked_fallback(data_file):
+    messages = await send_response(
+        ZeroCopyFileResponse(data_file, offset=1000, size=100_000)
+    )
+
+    headers = dict(messages[0]["headers"])
+    assert headers[b"content-length"] == b"100000"
+    assert all(message["type"] == "http.response.body" for message in messages[1:])
+    assert b"".join(message["body"] for message in messages[1:]) == DATA[1000:101_000]
+    assert not messages[-1]["more_body"]
+
+
+@pytest.mark.asyncio
+async def test_whole_files_are_sent_by_path(data_file):
+    messages = await send_response(
+        ZeroCopyFileResponse(data_file), extensions={PATHSEND: {}}
+    )
+    assert dict(messages[0]["headers"])[b"content-length"] == str(len(DATA)).encode()
+    assert messages[1] == {"type": PATHSEND, "path": str(data_file)}
+
+    # pathsend can only send whole files, so part of one is read through Python
+    messages = await send_response(
+        ZeroCopyFileResponse(data_file, offset=10, size=10), extensions={PATHSEND: {}}
+    )
+    assert messages[1]["type"] == "http.response.body"
+    assert messages[1]["body"] == DATA[10:20]
+
+
+@pytest.mark.asyncio
+async def test_ranges_are_sent_as_files(data_file):
+    messages = await send_response(
+        ZeroCopyFileResponse(data_file, offset=10, size=10),
+        extensions={PATHSEND: {}, ZEROCOPYSEND: {}},
+    )
+    assert messages[1]["type"] == ZEROCOPYSEND
+    assert (messages[1]["offset"], messages[1]["count"]) == (10, 10)
+    assert messages[1]["file"] == DATA
+
+
+@pytest.mark.asyncio
+async def test_head_requests_send_no_body(data_file):
+    messages = await send_response(
+        ZeroCopyFileResponse(data_file, method="HEAD"), extensions={PATHSEND: {}}
+    )
+    assert messages[1] == {
+        "type": "http.response.body",
+        "body": b"",
+        "more_body": False,
+    }